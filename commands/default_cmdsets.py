@@ -43,6 +43,8 @@ class CharacterCmdSet(default_cmds.CharacterCmdSet):
         self.add(CmdKarma())           # key: karma, ka, xp
         self.add(CmdNuyen())           # key: nuyen, ny, nu
         self.add(CmdEssence())         # key: essence, ess, e
+        self.add(CmdAward())           # key: award
+        self.add(CmdLedger())          # key: @ledger
 
 
 class PlayerCmdSet(default_cmds.PlayerCmdSet):
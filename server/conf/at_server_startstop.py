@@ -16,13 +16,17 @@ at_server_cold_stop()
 
 """
 
+from sr5.scripts import start_ledger_scripts
+from sr5.writebehind import IcetrayQueue
+
 
 def at_server_start():
     """
     This is called every time the server starts up, regardless of
     how it was shut down.
     """
-    pass
+    start_ledger_scripts()
+    IcetrayQueue.start()
 
 
 def at_server_stop():
@@ -30,7 +34,8 @@ def at_server_stop():
     This is called just before the server is shut down, regardless
     of it is for a reload, reset or shutdown.
     """
-    pass
+    # Don't lose ledger entries that are still waiting to be written.
+    IcetrayQueue.stop()
 
 
 def at_server_reload_start():
@@ -71,6 +71,38 @@ BASE_CHARACTER_TYPECLASS = "sr5.character.DefaultShadowrunner"
 
 INLINEFUNC_ENABLED = True
 
+######################################################################
+# Shadowrun ledgers
+######################################################################
+
+# Icetray entries older than this many days are moved to the archive
+# (whole months at a time) by the ledger_archiver Script.
+SR5_LEDGER_ARCHIVE_AFTER = 365
+# Write icetray entries from a background thread in batches instead of on
+# the reactor thread as they're recorded. Pending entries are written every
+# SR5_LEDGER_WRITE_BEHIND_INTERVAL seconds, or as soon as
+# SR5_LEDGER_WRITE_BEHIND_BATCH of them are waiting, and always on stop or
+# reload.
+SR5_LEDGER_WRITE_BEHIND = False
+SR5_LEDGER_WRITE_BEHIND_INTERVAL = 0.05
+SR5_LEDGER_WRITE_BEHIND_BATCH = 500
+# Round ledger amounts to a fixed number of decimal places per currency and
+# do sums on whole minor units (integers) instead of decimals. The unit
+# columns are kept up to date either way, but amounts recorded while this is
+# off aren't rounded, so their units may not add up to a Ledger's rounded
+# total. After turning it on, run @ledger/reconcile and then @ledger/repair
+# to bring any such Ledgers into line with their history.
+SR5_LEDGER_FIXED_POINT = False
+SR5_LEDGER_PRECISION = {"nuyen": 0, "karma": 0, "essence": 2}
+# The most Ledgers and quick log entries kept in memory by the idmapper, and
+# the most quick log rings (one per owner and currency) kept by QuickLog. The
+# least recently used are dropped first and read again when needed.
+SR5_LEDGER_CACHE_MAX = 10000
+SR5_LOG_CACHE_MAX = 5000
+SR5_QUICK_LOG_RINGS = 1000
+# Where @ledger/export writes history exports.
+SR5_LEDGER_EXPORT_DIR = os.path.join(GAME_DIR, "server", "exports")
+
 ######################################################################
 # Django web features
 ######################################################################
@@ -0,0 +1,444 @@
+"""
+Benchmark
+
+Times the ledger's busy paths against a synthetic population of characters,
+Ledgers and history, and writes a JSON report that can be kept and compared
+with the report from another commit.
+
+Run it from `evennia shell`:
+
+    >>> from sr5 import benchmark
+    >>> report = benchmark.run(characters=500, path="ledger-bench.json")
+    >>> benchmark.compare("before.json", "ledger-bench.json")
+
+`benchmark.slots()` does the same for SlotsHandler, with one holder that has
+a great many slots and objects attached to them, and reports operations per
+second and database writes per operation.
+
+The population is built inside a transaction that is rolled back at the end,
+and the in-memory caches are emptied afterwards, so nothing is left behind.
+It is still a lot of writing, so point it at a development database and not
+a running game.
+
+"""
+
+import json
+import os
+import platform
+import random
+import subprocess
+from collections import OrderedDict
+from decimal import Decimal
+from timeit import default_timer
+from django.conf import settings
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from evennia.objects.models import ObjectDB
+from sr5 import economy, money
+from sr5.models import (AccountingIcetray, AccountingLog, Ledger, QuickLog,
+                        TxnKeys, ledger_key)
+from sr5.names import NameCache
+
+CURRENCIES = ("karma", "nuyen", "essence")
+# Synthetic characters are named with this, so they're easy to spot.
+PREFIX = "ledger-bench-"
+SLOTS_PREFIX = "slots-bench-"
+# Queries starting with these are counted as writes.
+WRITES = ("INSERT", "UPDATE", "DELETE")
+
+
+class Rollback(Exception):
+    "Raised to throw the synthetic population away."
+
+
+class Timer(object):
+    """
+    Collects the timings, query counts and write counts of one path.
+
+    Methods:
+        time(func, *args, **kwargs): Calls and times `func`, returning
+            whatever it returns.
+        summary(): Returns an OrderedDict of statistics for the report.
+    """
+
+    def __init__(self):
+        self.times = []
+        self.queries = 0
+        self.writes = 0
+
+    def time(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            start = default_timer()
+            result = func(*args, **kwargs)
+            self.times.append(default_timer() - start)
+        self.queries += len(queries)
+        self.writes += len([q for q in queries.captured_queries
+                            if q["sql"].lstrip().upper().startswith(WRITES)])
+        return result
+
+    def summary(self):
+        times = sorted(self.times)
+        count, total = len(times), sum(times)
+        if not count:
+            return OrderedDict([("count", 0)])
+
+        def percentile(fraction):
+            return times[min(count - 1, int(count * fraction))]
+
+        return OrderedDict([
+            ("count", count),
+            ("total", total),
+            ("mean", total / count),
+            ("p50", percentile(0.5)),
+            ("p95", percentile(0.95)),
+            ("max", times[-1]),
+            ("per_second", count / total if total else None),
+            ("queries", self.queries / float(count)),
+            ("writes", self.writes / float(count))
+        ])
+
+
+def _commit():
+    "The commit being measured, if the game directory is a git checkout."
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=devnull,
+                cwd=getattr(settings, "GAME_DIR", None)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _amount(rng, currency):
+    places = money.places(currency)
+    return Decimal(rng.randint(-500, 1000)).scaleb(0 - places)
+
+
+def _clear_caches():
+    QuickLog.rings.clear()
+    Ledger.registry.clear()
+    TxnKeys.recent.clear()
+    NameCache.cache.clear()
+    Ledger.flush_instance_cache(force=True)
+    AccountingLog.flush_instance_cache(force=True)
+
+
+def populate(characters, currencies, transactions, seed=0, chunk=5000):
+    """
+    Build the synthetic population with bulk inserts.
+
+    Every character gets a Ledger in each currency and `transactions` icetray
+    entries in each. The quick log gets twice `Ledger.log_max` entries per
+    Ledger, so that there is something to trim. The stored totals match the
+    history.
+
+    Returns:
+        owners (list): The dbrefs of the synthetic characters.
+    """
+    rng = random.Random(seed)
+    ObjectDB.objects.bulk_create(
+        [ObjectDB(db_key="{}{}".format(PREFIX, i),
+                  db_typeclass_path=settings.BASE_CHARACTER_TYPECLASS)
+         for i in range(characters)])
+    owners = ["#{}".format(pk) for pk in ObjectDB.objects.filter(
+        db_key__startswith=PREFIX).values_list('id', flat=True)]
+
+    ledgers, ices, logs = [], [], []
+    for owner in owners:
+        for currency in currencies:
+            total, gained = Decimal(0), Decimal(0)
+            for i in range(transactions):
+                value = _amount(rng, currency)
+                total += value
+                gained += max(value, 0)
+                fields = {"db_owner": owner,
+                          "db_currency": currency,
+                          "db_owner_key": ledger_key(owner),
+                          "db_currency_key": currency,
+                          "db_value": value,
+                          "db_units": money.to_units(value, currency),
+                          "db_reason": "Benchmark entry {}.".format(i),
+                          "db_origin": rng.choice(owners)}
+                ices.append(AccountingIcetray(**fields))
+                if transactions - i <= Ledger.log_max * 2:
+                    logs.append(AccountingLog(**fields))
+            if len(ices) >= chunk:
+                AccountingIcetray.objects.bulk_create(ices)
+                AccountingLog.objects.bulk_create(logs)
+                ices, logs = [], []
+
+            ledgers.append(Ledger(
+                db_owner=owner, db_currency=currency,
+                db_owner_key=ledger_key(owner), db_currency_key=currency,
+                db_initial=0, db_value=total, db_accrued=gained,
+                db_initial_units=0,
+                db_value_units=money.to_units(total, currency),
+                db_accrued_units=money.to_units(gained, currency)))
+
+    AccountingIcetray.objects.bulk_create(ices)
+    AccountingLog.objects.bulk_create(logs)
+    Ledger.objects.bulk_create(ledgers)
+    return owners
+
+
+def measure(owners, currencies, samples=200, seed=0):
+    """
+    Time each path against an existing population.
+
+    Returns:
+        results (OrderedDict): A `Timer.summary()` for each path.
+    """
+    from sr5.command import log_table
+
+    rng = random.Random(seed)
+    sample = [(rng.choice(owners), rng.choice(currencies))
+              for i in range(samples)]
+    timers = OrderedDict((name, Timer()) for name in (
+        "trim", "ice", "log_cold", "log_warm", "render", "totals", "top",
+        "buckets", "reconcile", "record"))
+
+    # Trimming goes first, while there's a backlog in the quick log.
+    timers["trim"].time(QuickLog.trim, Ledger.log_max)
+
+    for owner, currency in sample:
+        ledger = Ledger.fetch(owner, currency)
+        timers["ice"].time(ledger.ice)
+        QuickLog.forget(owner, currency)
+        timers["log_cold"].time(ledger.log)
+        timers["log_warm"].time(ledger.log)
+
+    # What `karma/log` and the other currency commands do, with names looked
+    # up from scratch each time.
+    for owner, currency in sample:
+        NameCache.cache.clear()
+        timers["render"].time(
+            lambda: log_table(Ledger.fetch(owner, currency).log()))
+
+    for i in range(max(1, samples // 20)):
+        timers["totals"].time(economy.totals)
+        timers["top"].time(economy.top, currencies[0])
+        timers["buckets"].time(economy.buckets, "day", currencies[0])
+        timers["reconcile"].time(Ledger.reconcile)
+
+    for owner, currency in sample:
+        ledger = Ledger.fetch(owner, currency)
+        timers["record"].time(ledger.record, _amount(rng, currency),
+                              "Benchmark record.", wait=True)
+
+    return OrderedDict((name, timer.summary())
+                       for name, timer in timers.items())
+
+
+def _header(population):
+    "The start of a report: what was measured, where and on what."
+    return OrderedDict([
+        ("commit", _commit()),
+        ("date", timezone.now().isoformat()),
+        ("database", connection.vendor),
+        ("python", platform.python_version()),
+        ("population", population)
+    ])
+
+
+def _write(report, path):
+    if path:
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+    return report
+
+
+def run(characters=5000, currencies=CURRENCIES, transactions=200,
+        samples=200, seed=0, path=None):
+    """
+    Build a population, time every path and throw the population away.
+
+    Args:
+        characters (int): How many characters to create.
+        currencies (tuple): The currencies each character has a Ledger in.
+        transactions (int): Icetray entries per Ledger.
+        samples (int): How many Ledgers each per-Ledger path is timed on.
+        seed (int): Seed for the random population and samples.
+        path (str, optional): Write the report here as JSON.
+
+    Returns:
+        report (OrderedDict): The commit, environment, population and the
+            results of every path.
+    """
+    report = _header(OrderedDict([
+        ("characters", characters),
+        ("currencies", list(currencies)),
+        ("transactions", transactions),
+        ("samples", samples),
+        ("seed", seed)]))
+
+    _clear_caches()
+    try:
+        with transaction.atomic():
+            start = default_timer()
+            owners = populate(characters, currencies, transactions, seed)
+            report["populate"] = default_timer() - start
+            report["results"] = measure(owners, currencies, samples, seed)
+            raise Rollback()
+    except Rollback:
+        pass
+    finally:
+        _clear_caches()
+
+    return _write(report, path)
+
+
+def populate_slots(objects):
+    """
+    Bulk create a holder and the objects to attach to it.
+
+    Returns:
+        holder, occupants (tuple): The holder and a list of the others.
+    """
+    ObjectDB.objects.bulk_create(
+        [ObjectDB(db_key="{}{}".format(SLOTS_PREFIX, i),
+                  db_typeclass_path=settings.BASE_OBJECT_TYPECLASS)
+         for i in range(objects + 1)])
+    created = list(ObjectDB.objects.filter(
+        db_key__startswith=SLOTS_PREFIX).order_by('id'))
+    return created[0], created[1:]
+
+
+def measure_slots(holder, occupants, categories, numbered, named=10,
+                  samples=200, seed=0):
+    """
+    Time each SlotsHandler operation on a holder with no slots yet.
+
+    The holder gets `categories` categories of `named` named slots each, and
+    a "pool" category of `numbered` numbered slots. Each occupant is attached
+    to one named slot and an equal share of half the pool.
+
+    Returns:
+        results (OrderedDict): A `Timer.summary()` for each operation.
+    """
+    from sr5.utils import SlotsHandler
+
+    rng = random.Random(seed)
+    handler = SlotsHandler(holder)
+    timers = OrderedDict((name, Timer()) for name in (
+        "add", "attach", "where", "conflicts", "replace", "defrag", "drop"))
+    names = ["slot-{}".format(i) for i in range(named)]
+    cats = ["cat-{}".format(i) for i in range(categories)]
+
+    for cat in cats:
+        timers["add"].time(handler.add, {cat: names})
+    timers["add"].time(handler.add, {"pool": [numbered]})
+
+    places = [(cat, name) for cat in cats for name in names]
+    rng.shuffle(places)
+    occupants = occupants[:len(places)]
+    share = max(1, numbered // (2 * len(occupants))) if occupants else 0
+    for obj, (cat, name) in zip(occupants, places):
+        timers["attach"].time(handler.attach, obj,
+                              {cat: [name], "pool": [share]})
+    if not occupants:
+        return OrderedDict((name, timer.summary())
+                           for name, timer in timers.items())
+
+    def sample():
+        return [rng.choice(occupants) for i in range(samples)]
+
+    for obj in sample():
+        timers["where"].time(handler.where, obj)
+    for i in range(samples):
+        timers["conflicts"].time(handler.conflicts,
+                                 {rng.choice(cats): names[:3]})
+    for obj in sample():
+        cat, name = rng.choice(places)
+        timers["replace"].time(handler.replace, obj, {cat: [name]})
+
+    # Dropping from the middle of the pool is what used to defragment it.
+    # Each object is put back afterwards so the pool stays full.
+    for obj in sample():
+        timers["defrag"].time(handler.drop, obj, {"pool": [1]})
+        handler.attach(obj, {"pool": [share]})
+
+    for obj in rng.sample(occupants, min(samples, len(occupants))):
+        timers["drop"].time(handler.drop, obj)
+
+    return OrderedDict((name, timer.summary())
+                       for name, timer in timers.items())
+
+
+def slots(categories=200, numbered=5000, objects=500, named=10, samples=200,
+          seed=0, path=None):
+    """
+    Build a slot holder, time every SlotsHandler operation on it and throw
+    it away.
+
+    Args:
+        categories (int): How many categories of named slots to add.
+        numbered (int): How many numbered slots the pool has.
+        objects (int): How many objects to attach.
+        named (int): Named slots per category.
+        samples (int): How many times each operation after `attach` is
+            timed.
+        seed (int): Seed for the random choices.
+        path (str, optional): Write the report here as JSON.
+
+    Returns:
+        report (OrderedDict): The commit, environment, population and the
+            results of every operation. `per_second` is operations per
+            second and `writes` is database writes per operation.
+    """
+    report = _header(OrderedDict([
+        ("categories", categories),
+        ("named", named),
+        ("numbered", numbered),
+        ("objects", objects),
+        ("samples", samples),
+        ("seed", seed)]))
+
+    created = []
+    try:
+        with transaction.atomic():
+            holder, occupants = populate_slots(objects)
+            created = [holder] + occupants
+            report["results"] = measure_slots(
+                holder, occupants, categories, numbered, named, samples,
+                seed)
+            raise Rollback()
+    except Rollback:
+        pass
+    finally:
+        for obj in created:
+            ObjectDB.flush_cached_instance(obj, force=True)
+
+    return _write(report, path)
+
+
+def compare(before, after, threshold=0.1):
+    """
+    Compare the mean times of two reports.
+
+    Args:
+        before, after (dict or str): Reports, or paths to report files.
+        threshold (float): How much slower a path has to be to count as a
+            regression, as a fraction.
+
+    Returns:
+        changes (list): `(path, before, after, ratio, regressed)` tuples for
+            every path in both reports.
+    """
+    reports = []
+    for report in (before, after):
+        if isinstance(report, basestring):
+            with open(report) as report_file:
+                report = json.load(report_file,
+                                   object_pairs_hook=OrderedDict)
+        reports.append(report["results"])
+
+    changes = []
+    for name, old in reports[0].items():
+        new = reports[1].get(name)
+        if not new or not old.get("mean") or "mean" not in new:
+            continue
+        ratio = new["mean"] / old["mean"]
+        changes.append((name, old["mean"], new["mean"], ratio,
+                        ratio > 1 + threshold))
+    return changes
@@ -0,0 +1,98 @@
+"""
+Cache
+
+A size-capped take on the idmapper. SharedMemoryModel keeps every instance it
+has ever loaded until the process restarts, which for the ledger tables means
+every log entry a staff audit has ever looked at. BoundedSharedMemoryModel
+keeps the same cache, but in least-recently-used order, and drops the oldest
+instances once it holds more than its maximum.
+
+Dropping an instance only means the next lookup reads it from the database
+again. Code that still holds the old instance keeps a working object, it just
+isn't the one later lookups return.
+
+"""
+
+from collections import namedtuple, OrderedDict
+from django.conf import settings
+from evennia.utils.idmapper.models import SharedMemoryModel
+
+
+CacheStats = namedtuple("CacheStats", ["model", "size", "limit", "hits",
+                                       "misses", "evictions"])
+
+
+class BoundedSharedMemoryModel(SharedMemoryModel):
+    """
+    A SharedMemoryModel whose idmapper cache holds at most `cache_limit()`
+    instances.
+
+    Attributes:
+        cache_setting (str): The name of the setting holding the maximum.
+        cache_default (int): The maximum if the setting isn't there.
+
+    Methods:
+        cache_limit(): Returns the current maximum.
+        cache_stats(): Returns a CacheStats namedtuple for the model.
+    """
+
+    cache_setting = None
+    cache_default = 10000
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def cache_limit(cls):
+        if cls.cache_setting:
+            return getattr(settings, cls.cache_setting, cls.cache_default)
+        return cls.cache_default
+
+    @classmethod
+    def _lru(cls):
+        # The idmapper makes the cache a plain dict, and again whenever it is
+        # flushed, so swap in an OrderedDict to keep track of recency.
+        cache = cls.__dbclass__.__instance_cache__
+        if not isinstance(cache, OrderedDict):
+            cache = OrderedDict(cache)
+            cls.__dbclass__.__instance_cache__ = cache
+        return cache
+
+    @classmethod
+    def _counts(cls):
+        if "_cache_counts" not in cls.__dbclass__.__dict__:
+            cls.__dbclass__._cache_counts = {"hits": 0, "misses": 0,
+                                             "evictions": 0}
+        return cls.__dbclass__._cache_counts
+
+    @classmethod
+    def get_cached_instance(cls, id):
+        cache = cls._lru()
+        instance = cache.pop(id, None)
+        if instance is None:
+            cls._counts()["misses"] += 1
+            return None
+        cache[id] = instance
+        cls._counts()["hits"] += 1
+        return instance
+
+    @classmethod
+    def cache_instance(cls, instance, new=False):
+        cache = cls._lru()
+        super(BoundedSharedMemoryModel, cls).cache_instance(instance, new=new)
+        pk = instance._get_pk_val()
+        if pk in cache:
+            cache[pk] = cache.pop(pk)
+
+        limit = cls.cache_limit()
+        while len(cache) > limit:
+            cache.popitem(last=False)
+            cls._counts()["evictions"] += 1
+
+    @classmethod
+    def cache_stats(cls):
+        "How full is the cache, and how well is it doing?"
+        counts = cls._counts()
+        return CacheStats(cls.__name__, len(cls._lru()), cls.cache_limit(),
+                          counts["hits"], counts["misses"],
+                          counts["evictions"])
@@ -29,6 +29,20 @@ from sr5.system import Stats
 from sr5.utils import (a_n, itemize, flatten, LedgerHandler, SlotsHandler,
                        validate, ureg)
 
+# Every character has the same body slots, so the layout is shared and each
+# character only stores what is attached to it. A cyberlimb that replaces a
+# whole limb can ask for the limb and gets all of its slots.
+SlotsHandler.register("body", [
+    "head", "torso", "right_upper_arm", "right_lower_arm", "right_hand",
+    "left_upper_arm", "left_lower_arm", "left_hand", "right_upper_leg",
+    "right_lower_leg", "right_foot", "left_upper_leg", "left_lower_leg",
+    "left_foot"], groups={
+    "right_arm": ["right_upper_arm", "right_lower_arm", "right_hand"],
+    "left_arm": ["left_upper_arm", "left_lower_arm", "left_hand"],
+    "right_leg": ["right_upper_leg", "right_lower_leg", "right_foot"],
+    "left_leg": ["left_upper_leg", "left_lower_leg", "left_foot"],
+    "skull": ["head"]})
+
 
 class ChargenScript(DefaultScript, Stats, LedgerHandler):
     """
@@ -72,6 +86,11 @@ class ChargenScript(DefaultScript, Stats, LedgerHandler):
     def slots(self):
         return SlotsHandler(self)
 
+    @property
+    def ledger_owner(self):
+        "Chargen works on the character's own Ledgers."
+        return self.obj
+
     def priority(self, category):
         return self.db.priorities.keys()[
             self.db.priorities.values().index(category)]
@@ -85,20 +104,17 @@ class ChargenScript(DefaultScript, Stats, LedgerHandler):
         self.desc = "Handles Character Creation"
         self.persistent = True
 
-        self.attributes.add("essence", Ledger(), category="ledgers")
-        self.ldb.essence.configure(self.obj, "essence", 6)
+        self.ldb.essence = 6
         # Don't touch the karma Ledger until the very end. Chargen will have
         # its own karma count that it uses for qualities and metatype. When the
         # player submits their sheet and locks it, then any metatype and
         # qualities will be written to the Ledger and they will be able to
         # spend karma on other stats.
-        self.attributes.add("karma", Ledger(), category="ledgers")
-        self.ldb.karma.configure(self.obj, "karma", 25)
-        self.attributes.add("nuyen", Ledger(), category="ledgers")
-        self.ldb.nuyen.configure(self.obj, "nuyen", 0)
+        self.ldb.karma = 25
+        self.ldb.nuyen = 0
 
         # Establish body slots
-        self.slots.add("body", 0, ["head", "torso", "right_upper_arm", "right_lower_arm", "right_hand", "left_upper_arm", "left_lower_arm", "left_hand", "right_upper_leg", "right_lower_leg", "right_foot", "left_upper_leg", "left_lower_leg", "left_foot"])
+        self.slots.add_layout("body")
 
         self.reset_all()
 
@@ -169,9 +185,8 @@ class ChargenScript(DefaultScript, Stats, LedgerHandler):
     def reset_resources(self):
         "Resets lifestyle and purchases."
         self.db.lifestyle = ""
-        self.ldb.nuyen.configure(self.obj, "nuyen", 0)
-        self.ldb.essence.configure(self.obj, "essence", 6)
-        # TODO: Also delete log entries.
+        self.ldb.nuyen = 0
+        self.ldb.essence = 6
         self.db.augments, self.db.gear = {}, {}
         # TODO: The above line is highly suspect.
 
@@ -343,12 +358,12 @@ class ChargenScript(DefaultScript, Stats, LedgerHandler):
                 pos += self.query_qualities(qual)['rank'][rank - 1]
             for qual, rank in negative.items():
                 neg += self.query_qualities(qual)['rank'][rank - 1]
-            current = self.db.karma.value - pos + neg
+            current = self.ldb.karma.value - pos + neg
 
             output = "In character creation, you begin with {} karma " \
                      "and can take up to 25 karma worth of positive " \
                      "qualities and up to 25 karma worth of negative " \
-                     "qualities.".format(self.db.karma.initial)
+                     "qualities.".format(self.ldb.karma.initial)
             if current < 0:
                 output += " |rYou have spent more karma than you have " \
                           "available. Please take on negative qualities " \
@@ -479,8 +494,6 @@ class ChargenScript(DefaultScript, Stats, LedgerHandler):
         # Write metatype
         char.db.metatype = self.db.metatype
         char.db.spec_attr = self.db.spec_attr
-        self.ldb.karma.record(0 - self.db.metakarma, "Metatype cost.",
-                              origin="Chargen")
 
         # Write attributes
         char.db.attr = self.db.attr
@@ -510,8 +523,13 @@ class ChargenScript(DefaultScript, Stats, LedgerHandler):
         for qual, rank in negative.items():
             neg += self.query_qualities(qual)['rank'][rank - 1]
 
-        self.ldb.karma.record(0 - pos, "Positive qualities.", origin="Chargen")
-        self.ldb.karma.record(neg, "Negative qualities.", origin="Chargen")
+        # Karma costs are written as one batch.
+        karma = self.ldb.karma
+        Ledger.record_many([
+            (karma, 0 - self.db.metakarma, "Metatype cost.", "Chargen"),
+            (karma, 0 - pos, "Positive qualities.", "Chargen"),
+            (karma, neg, "Negative qualities.", "Chargen")
+        ])
 
 
 class ChargenRoom(DefaultRoom):
@@ -795,7 +813,7 @@ class CmdSetMetatype(default_cmds.MuxCommand):
                     pos += self.query_qualities(qual)['rank'][rank - 1]
                 for qual, rank in negative.items():
                     neg += self.query_qualities(qual)['rank'][rank - 1]
-                karma = cg.db.karma.value - cg.db.metakarma - pos + neg
+                karma = cg.ldb.karma.value - cg.db.metakarma - pos + neg
 
                 if karma - metatype[2] < 0:
                     caller.msg(mf.tag + "You don't have enough karma to buy "
@@ -803,7 +821,7 @@ class CmdSetMetatype(default_cmds.MuxCommand):
                                "more karma ({} out of {} remaining)."
                                "".format(
                                     karma,
-                                    cg.db.karma.value
+                                    cg.ldb.karma.value
                                ))
                     return False
 
@@ -1419,16 +1437,19 @@ class CmdBuyAugment(default_cmds.MuxCommand):
 
                 return False
             else:
-                nuyen = 0 - subject.db.nuyen_logs[0].value
-                essence = 0 - subject.db.essence_logs[0].value
-                subject.db.nuyen_logs[0].delete()
-                subject.db.nuyen_logs[1].delete()
-                subject.db.essence_logs[0].delete()
-                subject.db.essence_logs[1].delete()
+                # Refund what the purchase entries recorded. The entries stay
+                # in the log, with the refund recorded after them.
+                refunds = {}
+                for c_name in ("nuyen", "essence"):
+                    entries = subject.attributes.get("logs_" + c_name,
+                                                     category="logs")
+                    refunds[c_name] = 0 - entries[1].db_value if entries else 0
+                nuyen, essence = refunds["nuyen"], refunds["essence"]
+                reason = "Sold {}.".format(subject.key)
                 subject.delete()
 
-                cg.db.nuyen.value += nuyen
-                cg.db.essence.value += essence
+                cg.ldb.nuyen.record(nuyen, reason, caller.dbref)
+                cg.ldb.essence.record(essence, reason, caller.dbref)
 
                 caller.msg(mf.tag + "The {} was returned to the store and {} nuyen and {} essence were refunded.".format(subject, nuyen, essence))
         else:
@@ -1498,7 +1519,7 @@ class CmdSetQuality(SemanticCommand):
                            "Consider taking negative qualities for more karma "
                            "({} out of {} remaining).".format(
                                 karma,
-                                cg.db.karma.value
+                                cg.ldb.karma.value
                            ))
                 return False
         elif query["type"] == "negative":
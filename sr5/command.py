@@ -6,25 +6,52 @@ Commands describe the input the player can do to the game.
 """
 
 import pyparsing as pp
-from decimal import Decimal
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
 import math
+import os
 import string
 import inspect
-import evennia
 from evennia import Command as BaseCommand
 from evennia import default_cmds
-from evennia.utils import evtable
+from django.conf import settings
+from django.utils import timezone
+from evennia.utils import evtable, logger
 from fuzzywuzzy import process
+from twisted.internet.threads import deferToThread
 from sr5.data.base_stats import *
 from sr5.data.metatypes import *
 from sr5.data.skills import *
 from sr5.data.qualities import *
+from sr5 import economy, export
+from sr5.models import AccountingLog, Ledger, QuickLog
 from sr5.msg_format import mf
+from sr5.names import NameCache
+from sr5.scripts import in_thread
+from sr5.writebehind import IcetrayQueue
 from sr5.utils import (a_n, itemize, flatten, LedgerHandler, SlotsHandler,
                        validate, ureg)
 from sr5.system import Stats
 
 
+def log_table(log_list):
+    """
+    Build the table shown by the ledger log commands. Origins are stored as
+    dbrefs and are turned into names with one lookup for the whole table.
+    """
+    names = NameCache.names([entry[5] for entry in log_list])
+    table = evtable.EvTable("Date", "Transaction", "Origin")
+    for entry in log_list:
+        date, owner, value, currency, reason, origin = entry[0:6]
+        table.add_row(
+            date.strftime("%c"),
+            "{} {}: {}".format(value, currency, reason),
+            names[origin]
+        )
+
+    return table
+
+
 class SemanticCommand(default_cmds.MuxCommand):
     """
     This is a replacement command parent that spits out a more semantically
@@ -528,24 +555,14 @@ class CmdKarma(default_cmds.MuxCommand):
 
         tag = "|Rsr5 > |n"
 
-        if not target.db.karma:
-            caller.msg(tag + "That target doesn't seem to have a karma log.")
+        if not target.ldb.karma:
+            return caller.msg(tag + "That target doesn't seem to have a "
+                              "karma log.")
 
         if not self.switches:
-            caller.msg(target.db.karma)
+            caller.msg(target.ldb.karma.display())
         elif "log" in self.switches:
-            table = evtable.EvTable("Date", "Transaction", "Origin")
-            log_list = target.db.karma.log()
-            for date, owner, value, currency, reason, origin in log_list:
-                # Origin comes in as a dbref and we need it to be a name.
-                origin = evennia.search_object(searchdata=origin)[0].name
-                table.add_row(
-                    date.strftime("%c"),
-                    "{} {}: {}".format(value, currency, reason),
-                    origin
-                )
-
-            caller.msg(table)
+            caller.msg(log_table(target.ldb.karma.log()))
         else:
             return False
 
@@ -583,24 +600,14 @@ class CmdNuyen(default_cmds.MuxCommand):
 
         tag = "|Rsr5 > |n"
 
-        if not target.db.karma:
-            caller.msg(tag + "That target doesn't seem to have a nuyen log.")
+        if not target.ldb.nuyen:
+            return caller.msg(tag + "That target doesn't seem to have a "
+                              "nuyen log.")
 
         if not self.switches:
-            caller.msg(target.db.nuyen)
+            caller.msg(target.ldb.nuyen.display())
         elif "log" in self.switches:
-            table = evtable.EvTable("Date", "Transaction", "Origin")
-            log_list = target.db.nuyen.log()
-            for date, owner, value, currency, reason, origin in log_list:
-                # Origin comes in as a dbref and we need it to be a name.
-                origin = evennia.search_object(searchdata=origin)[0].name
-                table.add_row(
-                    date.strftime("%c"),
-                    "{} {}: {}".format(value, currency, reason),
-                    origin
-                )
-
-            caller.msg(table)
+            caller.msg(log_table(target.ldb.nuyen.log()))
         else:
             return False
 
@@ -636,28 +643,255 @@ class CmdEssence(default_cmds.MuxCommand):
 
         tag = "|Rsr5 > |n"
 
-        if not target.db.karma:
-            caller.msg(tag + "That target doesn't seem to have an essence"
-                       "score.")
+        if not target.ldb.essence:
+            return caller.msg(tag + "That target doesn't seem to have an "
+                              "essence score.")
 
         if not self.switches:
-            caller.msg(target.db.essence)
+            caller.msg(target.ldb.essence.display())
         elif "log" in self.switches:
-            table = evtable.EvTable("Date", "Transaction", "Origin")
-            log_list = target.db.essence.log()
-            for date, owner, value, currency, reason, origin in log_list:
-                # Origin comes in as a dbref and we need it to be a name.
-                origin = evennia.search_object(searchdata=origin)[0].name
-                table.add_row(
-                    date.strftime("%c"),
-                    "{} {}: {}".format(value, currency, reason),
-                    origin
-                )
+            caller.msg(log_table(target.ldb.essence.log()))
+        else:
+            return False
+
+
+class CmdAward(default_cmds.MuxCommand):
+    """
+    Award a currency to any number of characters at once. A negative amount
+    will deduct it instead. All of the awards are recorded as one batch.
+
+    Usage:
+    > award <character>[, <character>...] = <amount> <reason>
+    > award/<currency> <character>[, <character>...] = <amount> <reason>
+
+    Karma is awarded unless another currency is given as a switch.
+    """
+
+    key = "award"
+    locks = "cmd:perm(Wizards)"
+    help_category = "Shadowrun 5e"
+
+    def func(self):
+        caller = self.caller
+        currency = self.switches[0].lower() if self.switches else "karma"
+
+        if not self.args or not self.rhs:
+            caller.msg(mf.tag + "Usage: award[/<currency>] <character>[, "
+                       "<character>...] = <amount> <reason>")
+            return False
+
+        amount, reason = (self.rhs.split(None, 1) + [""])[0:2]
+        if "," in amount:
+            # "1,000" and "0,5" both turn up, so neither guess is safe.
+            caller.msg(mf.tag + "Write the amount without commas, using a "
+                       "point for decimals, like 1000 or 0.5.")
+            return False
+        try:
+            amount = Decimal(amount)
+        except InvalidOperation:
+            caller.msg(mf.tag + "The amount has to be a number.")
+            return False
+        if not amount.is_finite():
+            caller.msg(mf.tag + "The amount has to be a finite number.")
+            return False
+        if not reason:
+            caller.msg(mf.tag + "You have to give a reason for the award.")
+            return False
 
+        entries, names = [], []
+        for name in self.lhslist:
+            target = caller.search(name, global_search=True)
+            if not target:
+                return False
+            ledger = Ledger.fetch(target, currency)
+            if not ledger:
+                caller.msg(mf.tag + "{} doesn't have a {} ledger.".format(
+                    target.key, currency))
+                return False
+            entries.append((ledger, amount, reason, caller.dbref))
+            names.append(target.key)
+
+        Ledger.record_many(entries)
+
+        caller.msg(mf.tag + "{} {} awarded to {} for: {}".format(
+            amount, currency, itemize(names), reason))
+
+
+class CmdLedger(default_cmds.MuxCommand):
+    """
+    Staff tools for looking after the ledger tables.
+
+    Usage:
+    > @ledger/reconcile
+    > @ledger/repair
+    > @ledger/economy [<currency>] [= <days>]
+    > @ledger/top <currency> [= <days>]
+    > @ledger/cache
+    > @ledger/flush
+    > @ledger/export[/jsonl][/gzip] [<character>] [= <currency>[, <from>[,
+      <to>]]]
+
+    Reconcile lists every ledger whose stored totals disagree with its
+    transaction history. Repair does the same and then sets those ledgers to
+    the totals their history gives. Both run in the background and report
+    back when they're done.
+
+    Economy shows how much of each currency came in and went out over the
+    last week, or the given number of days. Given a currency, it shows that
+    currency day by day instead. Top lists who earned the most of a currency
+    over the last 30 days, or the given number of days. Archived entries are
+    counted by whole months, so the day by day view leaves them out.
+
+    Cache shows how many Ledgers and quick log entries are held in memory,
+    and flush empties those caches. Nothing is lost by flushing; entries are
+    read from the database again as they're needed.
+
+    Export writes ledger history to a CSV file, or a JSON Lines file with
+    /jsonl, compressed with /gzip. It can be narrowed to one character, one
+    currency ("all" for every currency) and a range of dates in the form
+    YYYY-MM-DD, both ends included. The file is written in the background and
+    you'll be told where it is when it's done.
+    """
+
+    key = "@ledger"
+    locks = "cmd:perm(Wizards)"
+    help_category = "Shadowrun 5e"
+
+    def func(self):
+        caller = self.caller
+
+        if "reconcile" in self.switches or "repair" in self.switches:
+            self.reconcile()
+        elif "economy" in self.switches or "top" in self.switches:
+            days = self.rhs or (7 if "economy" in self.switches else 30)
+            try:
+                start = timezone.now() - timedelta(days=int(days))
+            except ValueError:
+                caller.msg(mf.tag + "The number of days has to be a number.")
+                return False
+            currency = self.lhs.strip().lower()
+
+            if "top" in self.switches:
+                if not currency:
+                    caller.msg(mf.tag + "Usage: @ledger/top <currency> "
+                               "[= <days>]")
+                    return False
+                rows = economy.top(currency, start=start)
+                names = NameCache.names([row.group for row in rows])
+                table = evtable.EvTable("Owner", "Earned", "Spent", "Entries")
+                for row in rows:
+                    table.add_row(names[row.group], row.gained, row.spent,
+                                  row.count)
+            elif currency:
+                table = evtable.EvTable("Day", "Earned", "Spent", "Net",
+                                        "Entries")
+                for row in economy.buckets("day", currency, start=start):
+                    table.add_row(row.group.strftime("%x"), row.gained,
+                                  row.spent, row.total, row.count)
+            else:
+                table = evtable.EvTable("Currency", "Earned", "Spent", "Net",
+                                        "Entries")
+                for row in economy.totals(start=start):
+                    table.add_row(row.group, row.gained, row.spent,
+                                  row.total, row.count)
+
+            caller.msg(mf.tag + "Since {}:".format(start.strftime("%c")))
+            caller.msg(table)
+        elif "cache" in self.switches:
+            table = evtable.EvTable("Model", "Cached", "Limit", "Hits",
+                                    "Misses", "Evicted")
+            for model in (Ledger, AccountingLog):
+                table.add_row(*model.cache_stats())
+            table.add_row("QuickLog rings", len(QuickLog.rings),
+                          getattr(settings, "SR5_QUICK_LOG_RINGS", 1000),
+                          "", "", "")
             caller.msg(table)
+        elif "flush" in self.switches:
+            QuickLog.rings.clear()
+            for model in (Ledger, AccountingLog):
+                model.flush_instance_cache(force=True)
+            caller.msg(mf.tag + "Ledger caches flushed.")
+        elif "export" in self.switches:
+            self.export()
         else:
+            caller.msg(mf.tag + "Usage: @ledger/reconcile, @ledger/repair, "
+                       "@ledger/economy, @ledger/top, @ledger/cache, "
+                       "@ledger/flush or @ledger/export")
             return False
 
+    def reconcile(self):
+        caller = self.caller
+        repair = "repair" in self.switches
+
+        def done(drift):
+            if not drift:
+                caller.msg(mf.tag + "Every ledger matches its history.")
+                return
+
+            table = evtable.EvTable("Owner", "Currency", "Value", "Expected",
+                                    "Accrued", "Expected")
+            for row in drift:
+                table.add_row(row.owner, row.currency, row.value,
+                              row.expected_value, row.accrued,
+                              row.expected_accrued)
+            caller.msg(table)
+            caller.msg(mf.tag + "{} ledger(s) {}.".format(
+                len(drift), "repaired" if repair else "out of step"))
+
+        def failed(failure):
+            logger.log_trace("Ledger reconcile failed: {}".format(
+                failure.getErrorMessage()))
+            caller.msg(mf.tag + "The ledger check failed: {}".format(
+                failure.getErrorMessage()))
+
+        # Every ledger is summed against its whole history, so this is done
+        # off the reactor thread.
+        in_thread(Ledger.reconcile, repair=repair).addCallbacks(done, failed)
+        caller.msg(mf.tag + "Checking every ledger against its history.")
+
+    def export(self):
+        caller = self.caller
+        owner = None
+        if self.lhs.strip():
+            owner = caller.search(self.lhs.strip(), global_search=True)
+            if not owner:
+                return False
+
+        options = [o.strip() for o in self.rhs.split(",")] \
+            if self.rhs else []
+        options += [""] * (3 - len(options))
+        currency = options[0].lower()
+        if currency == "all":
+            currency = ""
+        try:
+            start = export.parse_day(options[1])
+            end = export.parse_day(options[2], after=True)
+        except ValueError as err:
+            caller.msg(mf.tag + str(err))
+            return False
+
+        fmt = "jsonl" if "jsonl" in self.switches else "csv"
+        gzip = "gzip" in self.switches
+        path = os.path.join(export.export_dir(), export.filename(fmt, gzip))
+
+        # Exports can be millions of rows, so they're written off the
+        # reactor thread, once anything waiting to be written is in.
+        IcetrayQueue.flush()
+
+        def done(path):
+            caller.msg(mf.tag + "Ledger export written to {}.".format(path))
+
+        def failed(failure):
+            logger.log_trace("Ledger export failed: {}".format(
+                failure.getErrorMessage()))
+            caller.msg(mf.tag + "The ledger export failed: {}".format(
+                failure.getErrorMessage()))
+
+        deferToThread(export.write_in_thread, path, fmt=fmt, owner=owner,
+                      currency=currency, start=start, end=end,
+                      gzip=gzip).addCallbacks(done, failed)
+        caller.msg(mf.tag + "Exporting ledger history to {}.".format(path))
+
 
 class CmdBody(default_cmds.MuxCommand):
     """
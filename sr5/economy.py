@@ -0,0 +1,222 @@
+"""
+Economy
+
+Aggregate reports over the ledger history: how much of a currency came in
+and went out, who earned the most, and how that changed over time. Every
+report is a GROUP BY or two in the database, so none of them depend on how
+many entries there are.
+
+Entries moved to the archive by `Ledger.archive()` are counted through their
+monthly rollups. `totals()` and `top()` add in the rollups of every month that
+falls wholly inside the range asked for, except when grouping by origin,
+which the rollups don't keep. `buckets()` covers the live icetray only. With
+fixed-point money turned on, reports that stick to one currency at a time sum
+the integer unit columns instead of the decimals.
+
+"""
+
+from collections import namedtuple, OrderedDict
+from decimal import Decimal
+from django.db.models import (BigIntegerField, Case, Count, DecimalField, F,
+                              Q, Sum, When)
+from django.db.models.functions import Trunc
+from sr5 import money
+from sr5.models import AccountingIcetray, AccountingRollup, ledger_key, \
+    month_after, month_start
+from sr5.writebehind import IcetrayQueue
+
+
+Row = namedtuple("Row", ["group", "total", "gained", "spent", "count"])
+
+# The fields that a report can be grouped by.
+GROUPS = {"currency": "db_currency_key",
+          "owner": "db_owner_key",
+          "origin": "db_origin"}
+
+# The groups that archived entries can be counted in.
+ROLLUP_GROUPS = {"currency": "db_currency_key",
+                 "owner": "db_owner_key"}
+
+# The periods that `buckets()` can group by.
+PERIODS = ("year", "month", "day", "hour")
+
+
+def history(currency=None, start=None, end=None):
+    """
+    Return the icetray entries a report covers.
+
+    Args:
+        currency (str, optional): Only count this currency.
+        start (datetime, optional): Only count entries made at or after this.
+        end (datetime, optional): Only count entries made before this.
+    """
+    IcetrayQueue.flush()
+    query = AccountingIcetray.objects.all()
+    if currency:
+        query = query.filter(db_currency_key=ledger_key(currency))
+    if start is not None:
+        query = query.filter(db_date_created__gte=start)
+    if end is not None:
+        query = query.filter(db_date_created__lt=end)
+    return query
+
+
+def _aggregate(query, group, units=False):
+    if units:
+        field, output = 'db_units', BigIntegerField()
+        positive, negative = Q(db_units__gt=0), Q(db_units__lt=0)
+    else:
+        field, output = 'db_value', DecimalField()
+        positive, negative = Q(db_value__gt=0), Q(db_value__lt=0)
+
+    return query.values(group).annotate(
+        total=Sum(field),
+        gained=Sum(Case(When(positive, then=F(field)), default=0,
+                        output_field=output)),
+        spent=Sum(Case(When(negative, then=F(field)), default=0,
+                       output_field=output)),
+        count=Count('db_key'))
+
+
+def rollups(by, currency=None, start=None, end=None):
+    """
+    Sum up the archived rollups of every month that falls wholly between
+    `start` and `end`, in the same shape as the live history's sums.
+
+    Args:
+        by (str): One of the keys of `ROLLUP_GROUPS`.
+        currency, start, end: As for `history()`.
+    """
+    query = AccountingRollup.objects.all()
+    if currency:
+        query = query.filter(db_currency_key=ledger_key(currency))
+    if start is not None:
+        first = month_start(start)
+        if first < start:
+            first = month_after(start)
+        query = query.filter(db_month__gte=first.date())
+    if end is not None:
+        query = query.filter(db_month__lt=month_start(end).date())
+
+    units = _units_for(currency, by)
+    total, gained = ('db_total_units', 'db_gained_units') if units \
+        else ('db_total', 'db_gained')
+    group = ROLLUP_GROUPS[by]
+    return query.values(group).annotate(
+        total=Sum(total), gained=Sum(gained),
+        spent=Sum(F(total) - F(gained)), count=Sum('db_count')).order_by()
+
+
+def _merge(query, archived, group):
+    "Add archived rollup sums into the live history's sums, by group."
+    # Clearing the ordering keeps the model's default out of the GROUP BY.
+    merged = OrderedDict((row[group], dict(row)) for row in query.order_by())
+    for row in archived:
+        if row[group] not in merged:
+            merged[row[group]] = dict(row)
+            continue
+        for key in ('total', 'gained', 'spent', 'count'):
+            merged[row[group]][key] = ((merged[row[group]][key] or 0) +
+                                       (row[key] or 0))
+    return merged.values()
+
+
+def _rows(query, group, currency=None):
+    """
+    Turn aggregated rows into Rows. If `currency` is given, the sums are in
+    its minor units; "group" means each row's group is its currency.
+    """
+    output = []
+    for row in query:
+        if currency:
+            unit = row[group] if currency == "group" else currency
+            amount = lambda n: money.from_units(n, unit)
+        else:
+            amount = lambda n: Decimal(n or 0)
+        output.append(Row(row[group], amount(row['total']),
+                          amount(row['gained']), amount(row['spent']),
+                          row['count']))
+    return output
+
+
+def _units_for(currency, by=None):
+    "Which currency's units can a report be summed in, if any?"
+    if not money.fixed_point():
+        return None
+    if currency:
+        return currency
+    return "group" if by == "currency" else None
+
+
+def totals(by="currency", currency=None, start=None, end=None):
+    """
+    Sum up the history by currency, owner or origin.
+
+    Args:
+        by (str): One of the keys of `GROUPS`.
+        currency, start, end: Passed on to `history()`.
+
+    Returns:
+        rows (list): A Row for each group, in order of the group.
+    """
+    group = GROUPS[by]
+    units = _units_for(currency, by)
+    query = _aggregate(history(currency, start, end), group, bool(units))
+    if by in ROLLUP_GROUPS:
+        query = sorted(_merge(query, rollups(by, currency, start, end),
+                              group), key=lambda row: row[group])
+    else:
+        query = query.order_by(group)
+    return _rows(query, group, units)
+
+
+def top(currency, by="owner", limit=10, start=None, end=None, spent=False):
+    """
+    Find who earned (or spent) the most of a currency.
+
+    Args:
+        currency (str): The currency to rank by.
+        by (str): One of the keys of `GROUPS`.
+        limit (int): How many rows to return.
+        start, end: Passed on to `history()`.
+        spent (bool): Rank by spending instead of earning.
+
+    Returns:
+        rows (list): Up to `limit` Rows, biggest first.
+    """
+    group = GROUPS[by]
+    units = _units_for(currency)
+    query = _aggregate(history(currency, start, end), group, bool(units))
+    if by not in ROLLUP_GROUPS:
+        query = query.order_by('spent' if spent else '-gained', group)
+        return _rows(query[:limit], group, units)
+
+    # Archived months can change the order, so the ranking is done here.
+    rows = _merge(query, rollups(by, currency, start, end), group)
+    rows.sort(key=lambda row: row[group])
+    rows.sort(key=lambda row: row['spent'] if spent else -row['gained'])
+    return _rows(rows[:limit], group, units)
+
+
+def buckets(period="day", currency=None, start=None, end=None):
+    """
+    Sum up the live history by time. Archived entries aren't counted, since
+    their rollups are by month.
+
+    Args:
+        period (str): One of `PERIODS`.
+        currency, start, end: Passed on to `history()`.
+
+    Returns:
+        rows (list): A Row for each period with entries in it, oldest first.
+            The group of each Row is the datetime the period starts at.
+    """
+    if period not in PERIODS:
+        raise ValueError("period must be one of {}".format(
+            ", ".join(PERIODS)))
+
+    query = history(currency, start, end).annotate(
+        bucket=Trunc('db_date_created', period))
+    units = _units_for(currency)
+    return _rows(_aggregate(query, 'bucket', bool(units)).order_by('bucket'),
+                 'bucket', units)
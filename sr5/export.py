@@ -0,0 +1,201 @@
+"""
+Export
+
+Streams ledger history out as CSV or JSON Lines for economy audits. Rows are
+read a page at a time by `iter_history()` and written as they arrive, so an
+export of any size runs in constant memory. Archived entries come first, as
+in `Ledger.iter_ice_all()`.
+
+`@ledger/export` writes exports to files from a worker thread, and the staff
+view in `sr5.systemview` streams them to the browser.
+
+"""
+
+import csv
+import json
+import os
+import zlib
+from datetime import datetime, time, timedelta
+from itertools import chain
+from uuid import uuid4
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from sr5.models import (AccountingArchive, AccountingIcetray, LedgerEntry,
+                        iter_history, ledger_key, owner_ref)
+from sr5.writebehind import IcetrayQueue
+
+FORMATS = ("csv", "jsonl")
+CONTENT_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+# Rows are gathered into chunks of about this many bytes before being handed
+# on, so that neither files nor responses are written a line at a time.
+CHUNK_SIZE = 64 * 1024
+
+
+def history(owner=None, currency=None, start=None, end=None,
+            page_size=1000, flush=True):
+    """
+    Stream the archived and live history as LedgerEntry tuples, oldest
+    first.
+
+    Args:
+        owner (object or str, optional): Only export this owner's entries.
+        currency (str, optional): Only export this currency.
+        start (datetime, optional): Only export entries made at or after
+            this.
+        end (datetime, optional): Only export entries made before this.
+        page_size (int): How many rows to read per query.
+        flush (bool): Write pending icetray entries first. From a thread
+            other than the reactor, this waits for the reactor to do it.
+    """
+    if flush:
+        IcetrayQueue.flush()
+    queries = []
+    for model in (AccountingArchive, AccountingIcetray):
+        query = model.objects.all()
+        if owner:
+            query = query.filter(db_owner_key=ledger_key(owner_ref(owner)))
+        if currency:
+            query = query.filter(db_currency_key=ledger_key(currency))
+        queries.append(iter_history(query, start, end, page_size))
+    return chain(*queries)
+
+
+class _Echo(object):
+    "A file-like object that hands back whatever is written to it."
+    def write(self, value):
+        return value
+
+
+def _csv_lines(entries):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(LedgerEntry._fields)
+    for entry in entries:
+        # The csv module in Python 2 only writes bytes.
+        yield writer.writerow([unicode(value).encode("utf-8")
+                               for value in entry])
+
+
+def _jsonl_lines(entries):
+    for entry in entries:
+        row = entry._asdict()
+        row["date"] = row["date"].isoformat()
+        row["value"] = unicode(row["value"])
+        yield json.dumps(row) + "\n"
+
+
+def _chunks(lines, size=CHUNK_SIZE):
+    buffer, length = [], 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield "".join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def _gzip(chunks):
+    # wbits of 16 + MAX_WBITS makes zlib write a gzip header and trailer.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.flush()
+
+
+def export(fmt="csv", owner=None, currency=None, start=None, end=None,
+           gzip=False, flush=True):
+    """
+    Stream history in an export format.
+
+    Args:
+        fmt (str): One of `FORMATS`.
+        owner, currency, start, end, flush: Passed on to `history()`.
+        gzip (bool): Compress the output with gzip.
+
+    Returns:
+        chunks (iterator): Byte strings that make up the export, in order.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("format must be one of {}".format(
+            ", ".join(FORMATS)))
+
+    entries = history(owner, currency, start, end, flush=flush)
+    lines = _csv_lines(entries) if fmt == "csv" else _jsonl_lines(entries)
+    output = _chunks(lines)
+    return _gzip(output) if gzip else output
+
+
+def export_dir():
+    "Where `@ledger/export` writes its files."
+    return getattr(settings, "SR5_LEDGER_EXPORT_DIR",
+                   os.path.join(settings.GAME_DIR, "server", "exports"))
+
+
+def filename(fmt="csv", gzip=False):
+    """
+    Name an export after the time it was made. The time is only to the
+    second, so a random suffix keeps exports started together apart.
+    """
+    return "ledger-{}-{}.{}{}".format(
+        timezone.now().strftime("%Y%m%d-%H%M%S"), uuid4().hex[0:8], fmt,
+        ".gz" if gzip else "")
+
+
+def parse_day(text, after=False):
+    """
+    Turn a YYYY-MM-DD date into the datetime it starts at, or if `after` is
+    True, the datetime the next day starts at, so that an end date includes
+    its whole day. Blank text gives None.
+
+    Raises:
+        ValueError: If the text isn't a date.
+    """
+    if not text or not text.strip():
+        return None
+    day = parse_date(text.strip())
+    if day is None:
+        raise ValueError("Dates have to be in the form YYYY-MM-DD.")
+    if after:
+        day += timedelta(days=1)
+    moment = datetime.combine(day, time())
+    if settings.USE_TZ:
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def write(path, **kwargs):
+    """
+    Write an export to a file.
+
+    Args:
+        path (str): The file to write. Its directory is created if needed.
+        kwargs: Passed on to `export()`.
+
+    Returns:
+        path (str): The path written.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "wb") as export_file:
+        for chunk in export(**kwargs):
+            export_file.write(chunk)
+    return path
+
+
+def write_in_thread(path, **kwargs):
+    """
+    The body of `@ledger/export`'s worker thread. Streams the history into
+    the file at `path` a page at a time, then closes the thread's database
+    connection. The queue isn't flushed from here, so the caller does that
+    before starting the thread.
+    """
+    try:
+        return write(path, flush=False, **kwargs)
+    finally:
+        close_old_connections()
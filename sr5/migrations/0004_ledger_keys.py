@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from sr5.models import ledger_key
+
+
+def fill_keys(apps, schema_editor):
+    # Normalize in Python, the same way new rows are, rather than with the
+    # database's LOWER(), which can disagree about non-ASCII names. There is
+    # one update for each distinct name.
+    for name in ('AccountingIcetray', 'AccountingLog'):
+        model = apps.get_model('sr5', name)
+        for field in ('db_owner', 'db_currency'):
+            for value in model.objects.values_list(
+                    field, flat=True).distinct().order_by():
+                model.objects.filter(**{field: value}).update(
+                    **{field + '_key': ledger_key(value)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sr5', '0003_auto_20170805_0023'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountingicetray',
+            name='db_owner_key',
+            field=models.CharField(default='', editable=False, max_length=80),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='accountingicetray',
+            name='db_currency_key',
+            field=models.CharField(default='', editable=False, max_length=80),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='accountinglog',
+            name='db_owner_key',
+            field=models.CharField(default='', editable=False, max_length=80),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='accountinglog',
+            name='db_currency_key',
+            field=models.CharField(default='', editable=False, max_length=80),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_keys, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='accountingicetray',
+            index_together=set([('db_owner_key', 'db_currency_key',
+                                 'db_date_created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='accountinglog',
+            index_together=set([('db_owner_key', 'db_currency_key',
+                                 'db_date_created')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sr5', '0004_ledger_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('db_owner_key', models.CharField(max_length=80)),
+                ('db_currency_key', models.CharField(max_length=80)),
+                ('db_value', models.DecimalField(default=0)),
+                ('db_accrued', models.DecimalField(default=0)),
+                ('db_last_key', models.IntegerField(default=0)),
+                ('db_as_of', models.DateTimeField(verbose_name=b'as of')),
+                ('db_date_created', models.DateTimeField(auto_now_add=True, verbose_name=b'date created')),
+            ],
+            options={
+                'ordering': ('db_as_of',),
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='ledgercheckpoint',
+            index_together=set([('db_owner_key', 'db_currency_key', 'db_as_of')]),
+        ),
+    ]
+
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sr5', '0005_ledger_checkpoints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountingArchive',
+            fields=[
+                ('db_key', models.IntegerField(primary_key=True, serialize=False)),
+                ('db_owner', models.CharField(max_length=80)),
+                ('db_currency', models.CharField(max_length=80)),
+                ('db_value', models.DecimalField(default=0)),
+                ('db_reason', models.TextField(blank=True)),
+                ('db_origin', models.CharField(max_length=80)),
+                ('db_date_created', models.DateTimeField(editable=False, verbose_name=b'date created')),
+                ('db_owner_key', models.CharField(editable=False, max_length=80)),
+                ('db_currency_key', models.CharField(editable=False, max_length=80)),
+                ('db_month', models.DateField(db_index=True, verbose_name=b'month')),
+            ],
+            options={
+                'ordering': ('db_date_created',),
+            },
+        ),
+        migrations.CreateModel(
+            name='AccountingRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('db_owner_key', models.CharField(max_length=80)),
+                ('db_currency_key', models.CharField(max_length=80)),
+                ('db_month', models.DateField(verbose_name=b'month')),
+                ('db_total', models.DecimalField(default=0)),
+                ('db_gained', models.DecimalField(default=0)),
+                ('db_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('db_month',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='accountingrollup',
+            unique_together=set([('db_owner_key', 'db_currency_key', 'db_month')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='accountingarchive',
+            index_together=set([('db_owner_key', 'db_currency_key', 'db_date_created')]),
+        ),
+    ]
+
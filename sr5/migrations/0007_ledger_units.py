@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from sr5 import money
+
+
+def fill(model, currency_field, fields):
+    """
+    Fill in the unit columns from the amounts, given as pairs of
+    `(amount field, unit field)`, with `money.to_units()`, so that old rows
+    are rounded the same way as new ones. There is one update for each
+    distinct amount in each currency.
+    """
+    for currency in model.objects.values_list(
+            currency_field, flat=True).distinct().order_by():
+        rows = model.objects.filter(**{currency_field: currency})
+        for field, units in fields:
+            for value in rows.values_list(
+                    field, flat=True).distinct().order_by():
+                rows.filter(**{field: value}).update(
+                    **{units: money.to_units(value, currency)})
+
+
+def fill_units(apps, schema_editor):
+    for name in ("AccountingIcetray", "AccountingLog", "AccountingArchive"):
+        model = apps.get_model("sr5", name)
+        fill(model, "db_currency_key", [("db_value", "db_units")])
+
+    fill(apps.get_model("sr5", "AccountingRollup"), "db_currency_key",
+         [("db_total", "db_total_units"), ("db_gained", "db_gained_units")])
+    fill(apps.get_model("sr5", "Ledger"), "db_currency",
+         [(field, field + "_units")
+          for field in ("db_initial", "db_value", "db_accrued")])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sr5', '0006_ledger_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountingarchive',
+            name='db_units',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='accountingicetray',
+            name='db_units',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='accountinglog',
+            name='db_units',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='accountingrollup',
+            name='db_gained_units',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='accountingrollup',
+            name='db_total_units',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ledger',
+            name='db_accrued_units',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ledger',
+            name='db_initial_units',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ledger',
+            name='db_value_units',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_units, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sr5', '0007_ledger_units'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountingarchive',
+            name='db_txn_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=80, null=True),
+        ),
+        migrations.AddField(
+            model_name='accountingicetray',
+            name='db_txn_key',
+            field=models.CharField(blank=True, editable=False, max_length=80, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='accountinglog',
+            name='db_txn_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=80, null=True),
+        ),
+    ]
+
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, Count, F, Sum, When
+from sr5.models import ledger_key, month_start
+
+
+def drop_duplicates(apps, schema_editor=None):
+    """
+    Chargen used to make new Ledgers every time it started, so an owner can
+    have several for one currency. Keep only the newest of each, and only the
+    history recorded since it was made; what came before belonged to the
+    Ledgers it replaced. Checkpoints and rollups are sums of the history, so
+    they're dropped or summed again to match.
+    """
+    Ledger = apps.get_model('sr5', 'Ledger')
+    Archive = apps.get_model('sr5', 'AccountingArchive')
+    Rollup = apps.get_model('sr5', 'AccountingRollup')
+
+    ledgers = {}
+    for pk, owner, currency, created in Ledger.objects.values_list(
+            'id', 'db_owner', 'db_currency', 'db_date_created').order_by('id'):
+        ledgers.setdefault((ledger_key(owner), ledger_key(currency)),
+                           []).append((pk, created))
+
+    for (owner, currency), found in ledgers.items():
+        if len(found) < 2:
+            continue
+        since = found[-1][1]
+        Ledger.objects.filter(id__in=[pk for pk, created in found[:-1]]) \
+            .delete()
+
+        keys = {'db_owner_key': owner, 'db_currency_key': currency}
+        for name in ('AccountingIcetray', 'AccountingLog',
+                     'AccountingArchive'):
+            apps.get_model('sr5', name).objects.filter(
+                db_date_created__lt=since, **keys).delete()
+        apps.get_model('sr5', 'LedgerCheckpoint').objects.filter(
+            **keys).delete()
+
+        # Earlier months are gone entirely, and the month the newest Ledger
+        # was made in is summed again from what's left of it.
+        month = month_start(since).date()
+        Rollup.objects.filter(db_month__lte=month, **keys).delete()
+        sums = Archive.objects.filter(db_month=month, **keys).aggregate(
+            total=Sum('db_value'),
+            gained=Sum(Case(When(db_value__gt=0, then=F('db_value')),
+                            default=0, output_field=models.DecimalField())),
+            total_units=Sum('db_units'),
+            gained_units=Sum(Case(When(db_units__gt=0, then=F('db_units')),
+                                  default=0,
+                                  output_field=models.BigIntegerField())),
+            count=Count('db_key'))
+        if sums['count']:
+            Rollup.objects.create(
+                db_month=month, db_total=sums['total'],
+                db_gained=sums['gained'] or 0,
+                db_total_units=sums['total_units'],
+                db_gained_units=sums['gained_units'] or 0,
+                db_count=sums['count'], **keys)
+
+
+def fill_keys(apps, schema_editor):
+    drop_duplicates(apps, schema_editor)
+
+    # Normalize in Python, the same way the log keys were in 0004.
+    Ledger = apps.get_model('sr5', 'Ledger')
+    for field in ('db_owner', 'db_currency'):
+        for value in Ledger.objects.values_list(
+                field, flat=True).distinct().order_by():
+            Ledger.objects.filter(**{field: value}).update(
+                **{field + '_key': ledger_key(value)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sr5', '0009_ledger_transfers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ledger',
+            name='db_currency_key',
+            field=models.CharField(default='', editable=False, max_length=80),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='ledger',
+            name='db_owner_key',
+            field=models.CharField(default='', editable=False, max_length=80),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_keys, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='ledger',
+            unique_together=set([('db_owner_key', 'db_currency_key')]),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from django.db import migrations, models
+
+BATCH_KEY = re.compile(r"^(.*):(\d+)$")
+
+
+def split_keys(apps, schema_editor=None):
+    """
+    Batch entries used to be keyed with the batch's key followed by ":" and
+    their position. Split those into the key and index, and mark every other
+    keyed entry as a `record()` one. A key only counts as a batch's when its
+    first entry, ":0", is there too.
+    """
+    tables = [apps.get_model('sr5', name) for name in
+              ('AccountingIcetray', 'AccountingArchive', 'AccountingLog')]
+
+    keys = set()
+    for model in tables:
+        keys.update(model.objects.filter(
+            db_txn_key__isnull=False).values_list('db_txn_key', flat=True))
+    batches = set(key[:-2] for key in keys if key.endswith(":0"))
+
+    for model in tables:
+        model.objects.filter(db_txn_key__isnull=False).update(
+            db_txn_kind="record", db_txn_index=0)
+        found = model.objects.filter(db_txn_key__regex=r":[0-9]+$")
+        for pk, key in found.values_list('pk', 'db_txn_key'):
+            match = BATCH_KEY.match(key)
+            if match and match.group(1) in batches:
+                model.objects.filter(pk=pk).update(
+                    db_txn_key=match.group(1), db_txn_kind="batch",
+                    db_txn_index=int(match.group(2)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sr5', '0010_ledger_registry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accountingicetray',
+            name='db_txn_key',
+            field=models.CharField(blank=True, editable=False, max_length=80, null=True),
+        ),
+        migrations.AddField(
+            model_name='accountingarchive',
+            name='db_txn_index',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='accountingarchive',
+            name='db_txn_kind',
+            field=models.CharField(blank=True, editable=False, max_length=8, null=True),
+        ),
+        migrations.AddField(
+            model_name='accountingicetray',
+            name='db_txn_index',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='accountingicetray',
+            name='db_txn_kind',
+            field=models.CharField(blank=True, editable=False, max_length=8, null=True),
+        ),
+        migrations.AddField(
+            model_name='accountinglog',
+            name='db_txn_index',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='accountinglog',
+            name='db_txn_kind',
+            field=models.CharField(blank=True, editable=False, max_length=8, null=True),
+        ),
+        migrations.RunPython(split_keys, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='accountingicetray',
+            unique_together=set([('db_txn_key', 'db_txn_kind', 'db_txn_index')]),
+        ),
+    ]
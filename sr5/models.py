@@ -5,11 +5,98 @@ This file contains custom database models.
 
 """
 
+from collections import deque, namedtuple, OrderedDict
+from datetime import timedelta
 from decimal import Decimal
-from django.db import models
-from django.db.models import Q
-import evennia
-from evennia.utils.idmapper.models import SharedMemoryModel
+from itertools import chain
+from uuid import uuid4
+from django.conf import settings
+from django.db import connection, IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Max, Q, Sum, When
+from django.utils import timezone
+from sr5 import money
+from sr5.cache import BoundedSharedMemoryModel
+from sr5.names import NameCache
+from sr5.writebehind import IcetrayQueue
+
+
+def owner_ref(owner):
+    "Ledgers are owned by dbref, or by any string for owners without one."
+    try:
+        return owner.dbref
+    except AttributeError:
+        return owner
+
+
+def ledger_key(name):
+    """
+    Normalize an owner or currency name into the form stored in the `_key`
+    columns, so that lookups can be exact matches against an index.
+    """
+    return unicode(name).lower()
+
+
+Balance = namedtuple("Balance", ["value", "accrued"])
+
+Drift = namedtuple("Drift", ["pk", "owner", "currency", "value", "accrued",
+                             "expected_value", "expected_accrued"])
+
+# One row of ledger history. Indexes match the lists built by `as_list()`
+# with ("date", "owner", "value", "currency", "reason", "origin"), so code
+# that reads those lists by position can take these as well.
+LedgerEntry = namedtuple("LedgerEntry", ["date", "owner", "value", "currency",
+                                         "reason", "origin", "key"])
+
+HISTORY_FIELDS = ("db_date_created", "db_owner", "db_value", "db_currency",
+                  "db_reason", "db_origin", "db_key")
+
+
+def iter_history(query, start=None, end=None, page_size=500):
+    """
+    Walk a history queryset oldest first, one page at a time.
+
+    Pages are fetched by keyset on (db_date_created, db_key) rather than by
+    offset, so each page is an indexed range scan and rows written while the
+    walk is underway don't shift it. Rows come back as `LedgerEntry` tuples
+    straight from `values_list()`; no model instances are built.
+
+    Args:
+        query: A queryset of AccountingIcetray, AccountingArchive or
+            AccountingLog rows.
+        start: Only include rows created at or after this datetime.
+        end: Only include rows created before this datetime.
+        page_size: How many rows to fetch per query.
+    """
+    if start is not None:
+        query = query.filter(db_date_created__gte=start)
+    if end is not None:
+        query = query.filter(db_date_created__lt=end)
+    query = query.order_by("db_date_created", "db_key").values_list(
+        *HISTORY_FIELDS)
+
+    page = query
+    while True:
+        count = 0
+        row = None
+        for row in page[:page_size].iterator():
+            count += 1
+            yield LedgerEntry._make(row)
+        if count < page_size:
+            return
+        page = query.filter(
+            Q(db_date_created__gt=row[0]) |
+            Q(db_date_created=row[0], db_key__gt=row[6]))
+
+
+def display_entry(entry, show_owner=False):
+    "Format one log entry, with names in place of dbrefs."
+    names = NameCache.names([entry.db_owner, entry.db_origin])
+    output = "{} | {} {} for {} | from {}".format(
+        entry.db_date_created, entry.db_value, entry.db_currency,
+        entry.db_reason, names[entry.db_origin])
+    if show_owner:
+        output = "{} | {}".format(names[entry.db_owner], output)
+    return output
 
 
 class AccountingIcetray(models.Model):
@@ -26,6 +113,16 @@ class AccountingIcetray(models.Model):
         db_reason: The impetus behind the transaction.
         db_origin: Who or what caused the transaction, code-wise?
         db_date_created: The timestamp of the log.
+        db_owner_key, db_currency_key: Normalized copies of the owner and
+            currency, kept up to date on save and used for lookups.
+        db_units: The value in whole minor units of the currency.
+        db_txn_key: An optional key given by whoever recorded the entry, so
+            that retries of the same transaction are only recorded once.
+        db_txn_kind: "record" for a key given to `Ledger.record()`, or
+            "batch" for one given to a whole batch of entries.
+        db_txn_index: The entry's position in its batch, or 0 for a single
+            entry. The key, kind and index are unique together.
+        db_transfer: An id shared by every entry of one `Ledger.transfer()`.
 
     Methods:
         as_list(args): Receives any number of string arguments matching the
@@ -41,9 +138,29 @@ class AccountingIcetray(models.Model):
     db_origin = models.CharField(max_length=80)
     db_date_created = models.DateTimeField('date created', editable=False,
                                            auto_now_add=True, db_index=True)
+    db_owner_key = models.CharField(max_length=80, editable=False)
+    db_currency_key = models.CharField(max_length=80, editable=False)
+    db_units = models.BigIntegerField(default=0, editable=False)
+    db_txn_key = models.CharField(max_length=80, null=True, blank=True,
+                                  editable=False)
+    db_txn_kind = models.CharField(max_length=8, null=True, blank=True,
+                                   editable=False)
+    db_txn_index = models.PositiveIntegerField(null=True, blank=True,
+                                               editable=False)
+    db_transfer = models.CharField(max_length=32, null=True, blank=True,
+                                   db_index=True, editable=False)
 
     class Meta:
         ordering = ('db_date_created',)
+        index_together = [('db_owner_key', 'db_currency_key',
+                           'db_date_created')]
+        unique_together = [('db_txn_key', 'db_txn_kind', 'db_txn_index')]
+
+    def save(self, *args, **kwargs):
+        self.db_owner_key = ledger_key(self.db_owner)
+        self.db_currency_key = ledger_key(self.db_currency)
+        self.db_units = money.to_units(self.db_value, self.db_currency)
+        super(AccountingIcetray, self).save(*args, **kwargs)
 
     def as_list(self, *args):
         "Take any number of field names and output the contents as a list."
@@ -71,23 +188,10 @@ class AccountingIcetray(models.Model):
 
     def display(self, show_owner=False):
         "Display all information about each entry."
-        if show_owner:
-            owner = evennia.search_object(searchdata=self.db_owner)
-        else:
-            owner = []
-        origin = evennia.search_object(searchdata=self.db_origin)
-        if owner:
-            owner = owner[0]
-        if origin:
-            origin = origin[0]
-
-        return "{} | {} {} for {} | {} has {} {}" \
-               "".format(self.db_date_created, self.db_value, self.db_currency,
-                         self.db_reason, self.db_owner, self.db_accrued,
-                         self.db_currency)
+        return display_entry(self, show_owner)
 
 
-class AccountingLog(SharedMemoryModel):
+class AccountingLog(BoundedSharedMemoryModel):
     """
     Cached log entries for the top most recent transactions. These should be
     identical to the most recent AccountingIcetray entries for each person.
@@ -100,6 +204,12 @@ class AccountingLog(SharedMemoryModel):
         reason: The impetus behind the transaction.
         origin: Who or what caused the transaction, code-wise?
         date_created: The timestamp of the log.
+        owner_key, currency_key: Normalized copies of the owner and currency,
+            kept up to date on save and used for lookups.
+        units: The value in whole minor units of the currency.
+        txn_key, txn_kind, txn_index: The transaction key of the matching
+            icetray entry, if any, with its kind and position.
+        transfer: The transfer the entry is part of, if any.
 
     Methods:
         as_list(args): Receives any number of string arguments matching the
@@ -115,9 +225,32 @@ class AccountingLog(SharedMemoryModel):
     db_origin = models.CharField(max_length=80)
     db_date_created = models.DateTimeField('date created', editable=False,
                                            auto_now_add=True, db_index=True)
+    db_owner_key = models.CharField(max_length=80, editable=False)
+    db_currency_key = models.CharField(max_length=80, editable=False)
+    db_units = models.BigIntegerField(default=0, editable=False)
+    db_txn_key = models.CharField(max_length=80, null=True, blank=True,
+                                  db_index=True, editable=False)
+    db_txn_kind = models.CharField(max_length=8, null=True, blank=True,
+                                   editable=False)
+    db_txn_index = models.PositiveIntegerField(null=True, blank=True,
+                                               editable=False)
+    db_transfer = models.CharField(max_length=32, null=True, blank=True,
+                                   db_index=True, editable=False)
 
     class Meta:
         ordering = ('db_date_created',)
+        index_together = [('db_owner_key', 'db_currency_key',
+                           'db_date_created')]
+
+    # The most instances the idmapper keeps. See `sr5.cache`.
+    cache_setting = "SR5_LOG_CACHE_MAX"
+    cache_default = 5000
+
+    def save(self, *args, **kwargs):
+        self.db_owner_key = ledger_key(self.db_owner)
+        self.db_currency_key = ledger_key(self.db_currency)
+        self.db_units = money.to_units(self.db_value, self.db_currency)
+        super(AccountingLog, self).save(*args, **kwargs)
 
     def as_list(self, *args):
         "Take any number of field names and output the contents as a list."
@@ -143,28 +276,341 @@ class AccountingLog(SharedMemoryModel):
         return output
 
     def display(self, show_owner=False):
-        if show_owner:
-            owner = evennia.search_object(searchdata=self.db_owner)
+        "Display all information about each entry."
+        return display_entry(self, show_owner)
+
+
+class LedgerCheckpoint(models.Model):
+    """
+    A snapshot of a Ledger's totals, so that past balances can be worked out
+    from the nearest snapshot instead of from the start of the icetray.
+
+    Keys:
+        db_owner_key, db_currency_key: The normalized owner and currency of
+            the Ledger.
+        db_value: The Ledger's value once every entry up to `db_last_key` is
+            counted.
+        db_accrued: The Ledger's accrued total at the same point.
+        db_last_key: The key of the newest AccountingIcetray entry counted.
+        db_as_of: The timestamp of that entry.
+        db_date_created: When the checkpoint was written.
+    """
+
+    db_owner_key = models.CharField(max_length=80)
+    db_currency_key = models.CharField(max_length=80)
+    db_value = models.DecimalField(default=0)
+    db_accrued = models.DecimalField(default=0)
+    db_last_key = models.IntegerField(default=0)
+    db_as_of = models.DateTimeField('as of')
+    db_date_created = models.DateTimeField('date created', editable=False,
+                                           auto_now_add=True)
+
+    class Meta:
+        ordering = ('db_as_of',)
+        index_together = [('db_owner_key', 'db_currency_key', 'db_as_of')]
+
+    def __unicode__(self):
+        return u"{} / {} as of {}".format(self.db_value, self.db_accrued,
+                                          self.db_as_of)
+
+
+class AccountingArchive(models.Model):
+    """
+    Icetray entries that have aged out of AccountingIcetray. Rows keep the key
+    they had in the icetray and are tagged with the month they were made in,
+    so a whole month can be found, exported or dropped at once.
+
+    Keys:
+        The same as AccountingIcetray, plus:
+        db_month: The first day of the month the entry was made in.
+    """
+
+    db_key = models.IntegerField(primary_key=True)
+    db_owner = models.CharField(max_length=80)
+    db_currency = models.CharField(max_length=80)
+    db_value = models.DecimalField(default=0)
+    db_reason = models.TextField(blank=True)
+    db_origin = models.CharField(max_length=80)
+    db_date_created = models.DateTimeField('date created', editable=False)
+    db_owner_key = models.CharField(max_length=80, editable=False)
+    db_currency_key = models.CharField(max_length=80, editable=False)
+    db_units = models.BigIntegerField(default=0, editable=False)
+    db_txn_key = models.CharField(max_length=80, null=True, blank=True,
+                                  db_index=True, editable=False)
+    db_txn_kind = models.CharField(max_length=8, null=True, blank=True,
+                                   editable=False)
+    db_txn_index = models.PositiveIntegerField(null=True, blank=True,
+                                               editable=False)
+    db_transfer = models.CharField(max_length=32, null=True, blank=True,
+                                   db_index=True, editable=False)
+    db_month = models.DateField('month', db_index=True)
+
+    class Meta:
+        ordering = ('db_date_created',)
+        index_together = [('db_owner_key', 'db_currency_key',
+                           'db_date_created')]
+
+
+class AccountingRollup(models.Model):
+    """
+    The totals of one owner's archived entries in one currency for one month.
+
+    Keys:
+        db_owner_key, db_currency_key: The normalized owner and currency.
+        db_month: The first day of the month.
+        db_total: The sum of every entry.
+        db_gained: The sum of the positive entries.
+        db_total_units, db_gained_units: The same sums in minor units.
+        db_count: How many entries there were.
+    """
+
+    db_owner_key = models.CharField(max_length=80)
+    db_currency_key = models.CharField(max_length=80)
+    db_month = models.DateField('month')
+    db_total = models.DecimalField(default=0)
+    db_gained = models.DecimalField(default=0)
+    db_total_units = models.BigIntegerField(default=0)
+    db_gained_units = models.BigIntegerField(default=0)
+    db_count = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ('db_month',)
+        unique_together = [('db_owner_key', 'db_currency_key', 'db_month')]
+
+
+def month_start(when):
+    "Return the first moment of the month `when` falls in."
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def month_after(when):
+    "Return the first moment of the month after the one `when` falls in."
+    return month_start(month_start(when) + timedelta(days=32))
+
+
+def sum_deltas(query, currency=None):
+    """
+    Add up a queryset of history rows in one aggregate query.
+
+    Args:
+        query: A queryset of AccountingIcetray or AccountingArchive rows.
+        currency (str, optional): The currency all of the rows are in. With
+            fixed-point money turned on, this lets the sums be done on the
+            unit columns.
+
+    Returns:
+        (total, gained): The sum of every value, and the sum of only the
+            positive ones, as Decimals.
+    """
+    if currency and money.fixed_point():
+        sums = query.aggregate(
+            total=Sum('db_units'),
+            gained=Sum(Case(When(db_units__gt=0, then=F('db_units')),
+                            default=0, output_field=models.BigIntegerField())))
+        return (money.from_units(sums['total'], currency),
+                money.from_units(sums['gained'], currency))
+
+    sums = query.aggregate(
+        total=Sum('db_value'),
+        gained=Sum(Case(When(db_value__gt=0, then=F('db_value')),
+                        default=0, output_field=models.DecimalField())))
+    return (Decimal(sums['total'] or 0), Decimal(sums['gained'] or 0))
+
+
+class TxnKeys(object):
+    """
+    The transaction keys recorded most recently, and what they recorded. Most
+    retries come right after the original, so this answers them without
+    asking the database. The unique index on the icetray's transaction key,
+    kind and index catches the rest.
+
+    Attributes:
+        recent (OrderedDict): What `Ledger.record()` or
+            `Ledger.record_many()` returned, keyed by `(kind, transaction
+            key)` with kind "record" or "batch", least recently used first.
+        size (int): How many keys to remember.
+    """
+
+    recent = OrderedDict()
+    size = 1000
+
+    @classmethod
+    def get(cls, kind, key):
+        found = cls.recent.pop((kind, key), None)
+        if found is not None:
+            cls.recent[(kind, key)] = found
+        return found
+
+    @classmethod
+    def remember(cls, kind, key, result):
+        """
+        Remember what a key recorded once the current transaction commits,
+        so that a rolled back transaction is never remembered.
+        """
+        def store():
+            cls.recent.pop((kind, key), None)
+            cls.recent[(kind, key)] = result
+            while len(cls.recent) > cls.size:
+                cls.recent.popitem(last=False)
+        transaction.on_commit(store)
+
+
+class QuickLog(object):
+    """
+    The in-memory front for AccountingLog. Every (owner, currency) pair gets a
+    fixed-size ring holding its most recent entries, so showing them costs no
+    queries, and trimming what falls off is one statement.
+
+    Rings are built lazily from the database the first time a pair is used
+    after a server start, and only change once a transaction has committed.
+    Rings are process-local, which is fine since only the Server process
+    writes to the ledger tables. Only the most recently
+    used `SR5_QUICK_LOG_RINGS` rings are kept; the rest are rebuilt if they
+    are needed again.
+
+    Attributes:
+        rings: An OrderedDict of `deque`s keyed by `(owner, currency)`, least
+            recently used first.
+
+    Methods:
+        entries(owner, currency, size): Returns the ring for the pair, oldest
+            entry first, warming it from the database if necessary.
+        push(entry, size): Trims the owner of a freshly saved AccountingLog
+            entry in one statement, and adds the entry to its ring when the
+            transaction commits.
+        forget(owner, currency): Drops a ring so that it is rebuilt on the
+            next use.
+        trim(size, owners): Trims the quick log of every owner, or of the
+            given owners, in one statement. The sweeper Script runs this for
+            everyone, and `Ledger.record_many()` for the owners in a batch.
+    """
+
+    rings = OrderedDict()
+
+    @classmethod
+    def _pair(cls, owner, currency):
+        return (ledger_key(owner), ledger_key(currency))
+
+    @classmethod
+    def entries(cls, owner, currency, size):
+        """
+        Return the ring for this owner and currency, building it if needed.
+        Inside a transaction the entries are read from the database instead,
+        which sees the transaction's own writes, and nothing is kept: a ring
+        built there could hold entries that are rolled back.
+        """
+        pair = cls._pair(owner, currency)
+        in_transaction = connection.in_atomic_block
+        ring = None if in_transaction else cls.rings.pop(pair, None)
+        if ring is not None and ring.maxlen == size:
+            cls.rings[pair] = ring
+            return ring
+
+        query = AccountingLog.objects.filter(
+            db_owner_key=pair[0],
+            db_currency_key=pair[1]
+        ).order_by('-db_key')
+        ring = deque(reversed(query[:size]), maxlen=size)
+
+        # Anything older than the ring is left over from before it existed.
+        if len(ring) == size:
+            AccountingLog.objects.filter(
+                db_owner_key=pair[0],
+                db_currency_key=pair[1],
+                db_key__lt=ring[0].db_key
+            ).delete()
+
+        if not in_transaction:
+            cls.rings[pair] = ring
+            while len(cls.rings) > getattr(settings, "SR5_QUICK_LOG_RINGS",
+                                           1000):
+                cls.rings.popitem(last=False)
+        return ring
+
+    @classmethod
+    def push(cls, entry, size):
+        """
+        Trim a saved entry's owner in the database, and add the entry to its
+        ring once the transaction commits, so that a rolled back entry never
+        shows up in the ring.
+        """
+        pair = cls._pair(entry.db_owner, entry.db_currency)
+        cls._delete_older(size, [entry.db_owner])
+
+        def append():
+            ring = cls.rings.get(pair)
+            # A ring built since the commit already has the entry.
+            if ring is not None and ring.maxlen == size and \
+                    (not ring or ring[-1].db_key < entry.db_key):
+                ring.append(entry)
+        transaction.on_commit(append)
+
+    @classmethod
+    def forget(cls, owner, currency):
+        "Drop the ring for this owner and currency."
+        cls.rings.pop(cls._pair(owner, currency), None)
+
+    @classmethod
+    def trim(cls, size, owners=None):
+        """
+        Delete every quick log entry that isn't among the `size` most recent
+        for its owner and currency, in one statement. If `owners` is given,
+        only those owners are trimmed; otherwise everyone is. The trimmed
+        owners' rings are dropped once the transaction commits, to be built
+        again on their next use.
+        """
+        deleted = cls._delete_older(size, owners)
+        if owners:
+            trimmed = set(ledger_key(o) for o in owners)
+            transaction.on_commit(lambda: cls._forget_owners(trimmed))
         else:
-            owner = []
-        origin = evennia.search_object(searchdata=self.db_origin)
-        if owner:
-            owner = owner[0]
-        if origin:
-            origin = origin[0]
+            transaction.on_commit(cls.rings.clear)
+        return deleted
+
+    @classmethod
+    def _forget_owners(cls, owners):
+        for pair in [p for p in cls.rings if p[0] in owners]:
+            del cls.rings[pair]
+
+    @classmethod
+    def _delete_older(cls, size, owners=None):
+        """
+        Delete what `trim()` does, leaving the rings alone.
 
-        return "{} | {} {} for {} | {}" \
-               "".format(self.db_date_created, self.db_value, self.db_currency,
-                         self.db_reason, self.db_accrued)
+        An entry goes if `size` or more entries of its owner and currency are
+        newer. Some backends won't let a delete select from its own table, so
+        the doomed keys are gathered in a derived table first. The quick log
+        is kept short, so counting the newer entries stays cheap.
+        """
+        names = {"log": connection.ops.quote_name(
+            AccountingLog._meta.db_table)}
+        where, params = "", []
+        if owners:
+            owners = list(set(ledger_key(o) for o in owners))
+            where = "a.db_owner_key IN ({}) AND ".format(
+                ", ".join(["%s"] * len(owners)))
+            params = owners
+        sql = "DELETE FROM {log} WHERE db_key IN (" \
+              "SELECT db_key FROM (SELECT a.db_key FROM {log} AS a " \
+              "WHERE {where}(SELECT COUNT(*) FROM {log} AS b " \
+              "WHERE b.db_owner_key = a.db_owner_key " \
+              "AND b.db_currency_key = a.db_currency_key " \
+              "AND b.db_key > a.db_key) >= %s) AS doomed)".format(
+                  where=where, **names)
 
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [size])
+            return cursor.rowcount
 
-class Ledger(SharedMemoryModel):
+
+class Ledger(BoundedSharedMemoryModel):
     """
     The manager model for the account system.
 
-    Instantiate this on another object with an owner (usually an object
-    with a dbref, but it can be a string; whatever it is, it should be
-    unique) and a currency name.
+    Each owner (usually an object with a dbref, but it can be a string;
+    whatever it is, it should be unique) has at most one Ledger per currency.
+    Look them up with `fetch()` or `for_owner()`, or through the `ldb`
+    property of `sr5.utils.LedgerHandler`, rather than storing them.
 
     Attributes:
         owner: The character whose resource is being tracked.
@@ -172,18 +618,46 @@ class Ledger(SharedMemoryModel):
         initial: How much of the thing was there in the beginning?
         value: How much of the thing is there now?
         accrued: How much of the thing has the character gained?
+        initial_units, value_units, accrued_units: The same amounts in whole
+            minor units of the currency. See `sr5.money`.
+        owner_key, currency_key: Normalized copies of the owner and currency,
+            kept up to date on save. Together they are unique.
         date_created: The timestamp of the log.
 
         Methods:
             __str__()
             __unicode__(): Displays the status of the Ledger.
 
+            fetch(owner, currency, initial=None): Returns the owner's Ledger
+                for a currency, creating it if `initial` is given.
+            for_owner(owner): Returns all of an owner's Ledgers by currency.
             configure(owner, currencyName, initialValue=0): Set up the values
-                for the Ledger.
+                for the Ledger, starting an existing one over with an
+                adjustment entry.
             display(): Returns the status of the Ledger.
             record(): Makes logs of a transaction on both log models and
-                deletes the oldest AccountingLog transaction for this owner and
-                currency.
+                pushes it onto the QuickLog ring, which deletes the oldest
+                AccountingLog transactions for this owner and currency.
+            record_many(entries): Records a batch of transactions against
+                any number of Ledgers in one database transaction.
+            transfer(source, credits, reason): Moves an amount from one
+                Ledger to one or more others in one database transaction,
+                with every side's entries linked by a shared id.
+            checkpoint(): Saves the Ledger's totals as a LedgerCheckpoint.
+                `record()` does this every `checkpoint_every` transactions.
+            balance_at(when): Returns the Ledger's value and accrued total at
+                a past moment, counting up from the nearest checkpoint.
+            reconcile(repair=False): Compares every Ledger's totals with its
+                icetray history and returns those that disagree, optionally
+                setting them right.
+            archive(before): Moves icetray entries from whole months before
+                `before` into AccountingArchive and sums them up in
+                AccountingRollup.
+            iter_ice(start, end, page_size): Yields the AccountingIcetray
+                logs belonging to this Ledger as LedgerEntry tuples, oldest
+                first, without loading the whole history.
+            iter_ice_all(start, end, page_size): Yields every
+                AccountingIcetray log the same way.
             ice(): Returns a list of AccountingIcetray logs belonging to this
                 Ledger.
             ice_all(): Returns a list of all AccountingIcetray logs.
@@ -197,10 +671,29 @@ class Ledger(SharedMemoryModel):
     db_initial = models.DecimalField(default=0)
     db_value = models.DecimalField(default=0)
     db_accrued = models.DecimalField(default=0)
+    db_initial_units = models.BigIntegerField(default=0)
+    db_value_units = models.BigIntegerField(default=0)
+    db_accrued_units = models.BigIntegerField(default=0)
+    db_owner_key = models.CharField(max_length=80, editable=False)
+    db_currency_key = models.CharField(max_length=80, editable=False)
     db_date_created = models.DateTimeField('date created', editable=False,
                                            auto_now_add=True)
 
+    class Meta:
+        unique_together = [('db_owner_key', 'db_currency_key')]
+
+    # The pks of every owner's Ledgers that have been looked up, as
+    # {owner key: {currency key: pk}}. The Ledgers themselves are held by the
+    # idmapper.
+    registry = {}
+    # The most instances the idmapper keeps. See `sr5.cache`.
+    cache_setting = "SR5_LEDGER_CACHE_MAX"
+    cache_default = 10000
+
     log_max = 5
+    checkpoint_every = 100
+    # Differences smaller than this are rounding, not drift.
+    drift_tolerance = 0.000001
 
     # def __str__(self):
     #     return self.display()
@@ -208,102 +701,845 @@ class Ledger(SharedMemoryModel):
     # def __unicode__(self):
     #     return unicode(self.display())
 
+    def save(self, *args, **kwargs):
+        old = (self.db_owner_key, self.db_currency_key)
+        self.db_owner_key = ledger_key(self.db_owner)
+        self.db_currency_key = ledger_key(self.db_currency)
+        self.db_initial_units = money.to_units(self.db_initial,
+                                               self.db_currency)
+        self.db_value_units = money.to_units(self.db_value, self.db_currency)
+        self.db_accrued_units = money.to_units(self.db_accrued,
+                                               self.db_currency)
+        # Field wrappers save only the field they set.
+        fields = kwargs.get("update_fields")
+        if fields:
+            fields = set(fields)
+            if fields & set(["db_owner", "db_currency"]):
+                fields.update(["db_owner_key", "db_currency_key"])
+            if fields & set(["db_initial", "db_value", "db_accrued",
+                             "db_currency"]):
+                fields.update(["db_initial_units", "db_value_units",
+                               "db_accrued_units"])
+            kwargs["update_fields"] = list(fields)
+        super(Ledger, self).save(*args, **kwargs)
+
+        if old != (self.db_owner_key, self.db_currency_key):
+            self.registry.get(old[0], {}).pop(old[1], None)
+        owned = self.registry.get(self.db_owner_key)
+        if owned is not None:
+            owned[self.db_currency_key] = self.pk
+
+    def delete(self, *args, **kwargs):
+        # History is matched to a Ledger by owner and currency, so it goes
+        # too, or a new Ledger for the pair would inherit it.
+        pk = self.pk
+        IcetrayQueue.flush()
+        with transaction.atomic():
+            self._clear_history()
+            super(Ledger, self).delete(*args, **kwargs)
+        # Forget the Ledger, so the owner can be given a new one.
+        owned = self.registry.get(self.db_owner_key)
+        if owned and owned.get(self.db_currency_key) == pk:
+            del owned[self.db_currency_key]
+
+    @classmethod
+    def for_owner(cls, owner):
+        """
+        Find all of an owner's Ledgers. The first lookup for an owner is one
+        indexed query, and later ones come from the cache.
+
+        Args:
+            owner (object or str): The owner, or their dbref.
+
+        Returns:
+            ledgers (dict): The owner's Ledgers, keyed by currency key.
+        """
+        key = ledger_key(owner_ref(owner))
+        owned = cls.registry.get(key)
+        if owned is None:
+            ledgers = list(cls.objects.filter(db_owner_key=key))
+            cls.registry[key] = dict((ledger.db_currency_key, ledger.pk)
+                                     for ledger in ledgers)
+            return dict((ledger.db_currency_key, ledger)
+                        for ledger in ledgers)
+
+        output, missing = {}, []
+        for currency, pk in owned.items():
+            ledger = cls.get_cached_instance(pk)
+            if ledger is None:
+                missing.append(pk)
+            else:
+                output[currency] = ledger
+        if missing:
+            # Flushed from the idmapper, so load them again together.
+            for ledger in cls.objects.filter(pk__in=missing):
+                output[ledger.db_currency_key] = ledger
+        return output
+
+    @classmethod
+    def fetch(cls, owner, currency, initial=None):
+        """
+        Find an owner's Ledger for a currency.
+
+        Args:
+            owner (object or str): The owner, or their dbref.
+            currency (str): The currency, in any case.
+            initial (number, optional): If the owner has no Ledger for the
+                currency, create one starting at this amount.
+
+        Returns:
+            ledger (Ledger or None): The Ledger, or None if there isn't one
+                and `initial` wasn't given.
+        """
+        ledger = cls.for_owner(owner).get(ledger_key(currency))
+        if ledger is None and initial is not None:
+            ledger = cls()
+            try:
+                with transaction.atomic():
+                    ledger.configure(owner, currency, initial)
+            except IntegrityError:
+                # Another process created it first.
+                cls.registry.pop(ledger_key(owner_ref(owner)), None)
+                ledger = cls.for_owner(owner).get(ledger_key(currency))
+        return ledger
+
     def configure(self, owner, currencyName, initialValue=0):
-        try:
-            self.owner = owner.dbref
-        except AttributeError:
-            self.owner = owner
-        self.currency = currencyName
-        self.initial = initialValue
-        self.value = initialValue
-        self.accrued = initialValue
+        """
+        Set the Ledger up to start at `initialValue`. A Ledger that already
+        exists is started over by recording the difference between its value
+        and `initialValue` as an adjustment, so its history is kept and still
+        adds up to its totals.
+        """
+        initialValue = self._amount(initialValue)[0]
+        if self.pk:
+            if (ledger_key(owner_ref(owner)), ledger_key(currencyName)) != \
+                    (self.db_owner_key, self.db_currency_key):
+                raise ValueError("A Ledger can't be moved to another owner "
+                                 "or currency.")
+            current = Ledger.objects.filter(pk=self.pk).values_list(
+                'db_value', flat=True)[0]
+            if initialValue != current:
+                self.record(initialValue - current,
+                            "Started over at {}.".format(initialValue))
+            return
+
+        self.db_owner = owner_ref(owner)
+        self.db_currency = currencyName
+        self.db_initial = self.db_value = self.db_accrued = initialValue
+        self.save()
+
+    def _clear_history(self):
+        """
+        Delete every entry, rollup and checkpoint recorded for the Ledger.
+        Only `delete()` does this; history is otherwise never thrown away.
+        """
+        keys = {"db_owner_key": ledger_key(self.db_owner),
+                "db_currency_key": ledger_key(self.db_currency)}
+        for model in (AccountingIcetray, AccountingArchive, AccountingRollup,
+                      LedgerCheckpoint, AccountingLog):
+            model.objects.filter(**keys).delete()
+        QuickLog.forget(self.db_owner, self.db_currency)
+        self._since_checkpoint = 0
+
+    def _amount(self, value):
+        "Normalize an amount, returning it as a Decimal and in minor units."
+        value = money.to_decimal(value)
+        if money.fixed_point():
+            value = money.quantize(value, self.db_currency)
+        return (value, money.to_units(value, self.db_currency))
 
     def display(self):
-        owner = evennia.search_object(searchdata=self.db_owner)
-        if owner:
-            owner = owner[0]
+        owner = NameCache.name(self.db_owner)
 
         return "{}'s {} Ledger:\n" \
-               "{} / {}".format(str(owner).title(), self.db_currency,
+               "{} / {}".format(owner.title(), self.db_currency,
                                 self.db_value, self.db_accrued)
 
-    def record(self, value, reason, origin=""):
-        "Record the transaction and alter totals."
+    def record(self, value, reason, origin="", wait=False, txn_key=None):
+        """
+        Record the transaction and alter totals.
+
+        Args:
+            value (number): How much to add. Negative values are spent.
+            reason (str): What the transaction was for.
+            origin (str, optional): Who or what caused it. Defaults to the
+                owner.
+            wait (bool, optional): Write the icetray entry before returning
+                even if write-behind is on. Callers that keep the returned
+                entries around should set this.
+            txn_key (str, optional): A key naming this transaction, up to 80
+                characters. If a transaction with the same key has already
+                been recorded, nothing is recorded again and the original
+                entries are returned, so a retried command or web request
+                can safely call this twice. Keyed entries are always written
+                before returning.
+
+        Returns:
+            entries (tuple): The `(AccountingLog, AccountingIcetray)` entries.
+                For a repeated `txn_key` the AccountingLog entry is None if it
+                has since fallen off the quick log.
+        """
+        if txn_key:
+            original = self._original(txn_key)
+            if original:
+                return original
+            # The unique index can only catch a duplicate that is written now.
+            wait = True
+
         if not origin:
             origin = self.owner
-        if isinstance(value, float):
-            value = Decimal(value)
-
-        # Update the current value, and if the transaction is positive add to
-        # the running total.
-        self.value += value
-        if value > 0:
-            self.accrued += value
-
-        # Deposit entries in each of the log tables. AccountingLog is based on
-        # SharedMemoryModel and thus cached for rapid retrieval of recent
-        # entries, while Accounting Icetray is based on the Django model for
-        # long-term storage of every entry ever.
-        entry_log = AccountingLog()
-        entry_log.owner = self.db_owner
-        entry_log.currency = self.db_currency
-        entry_log.value = value
-        entry_log.reason = reason
-        entry_log.origin = origin
-
-        entry_ice = AccountingIcetray(db_owner=self.db_owner,
-                                      db_currency=self.db_currency,
-                                      db_value=value,
-                                      db_reason=reason,
-                                      db_origin=origin)
-        entry_ice.save()
-
-        # Retrieve the entries in the quick log, so that we can check how many
-        # there are and drop old ones that go over the cap.
-        quick_log_query = AccountingLog.objects.filter(
-            db_owner__iexact=self.db_owner,
-            db_currency__iexact=self.db_currency
-        )
+        value, units = self._amount(value)
+        gained = (value, units) if value > 0 else (0, 0)
+
+        try:
+            with transaction.atomic():
+                # Deposit entries in each of the log tables. Accounting
+                # Icetray is based on the Django model for long-term storage
+                # of every entry ever, while AccountingLog is based on
+                # SharedMemoryModel and thus cached for rapid retrieval of
+                # recent entries. The icetray entry goes first, so a repeated
+                # transaction key fails before anything else has changed. It
+                # is written in the same transaction unless write-behind is
+                # on, in which case it's queued instead.
+                entry_ice = AccountingIcetray(
+                    db_owner=self.db_owner,
+                    db_currency=self.db_currency,
+                    db_owner_key=ledger_key(self.db_owner),
+                    db_currency_key=ledger_key(self.db_currency),
+                    db_value=value,
+                    db_units=units,
+                    db_reason=reason,
+                    db_origin=origin,
+                    **self._txn_fields(txn_key, "record"))
+                IcetrayQueue.add([entry_ice], wait=wait)
+
+                # Update the current value, and if the transaction is positive
+                # add to the running total. This happens in the database, so
+                # that transactions arriving together can't overwrite each
+                # other.
+                self._apply([(self, value, gained[0], units, gained[1])])
+
+                entry_log = AccountingLog.objects.create(
+                    db_owner=self.db_owner,
+                    db_currency=self.db_currency,
+                    db_value=value,
+                    db_reason=reason,
+                    db_origin=origin,
+                    **self._txn_fields(txn_key, "record"))
 
-        i = 0
-        for log in quick_log_query:
-            i += 1
-            if i < len(quick_log_query) - self.log_max:
-                log.delete()    # Delete old logs over the max.
+                # Push the entry onto the quick log ring. Anything that falls
+                # off the end is removed with a single delete, no matter how
+                # many transactions the owner has made.
+                QuickLog.push(entry_log, self.log_max)
+        except IntegrityError:
+            # Another process recorded the same key first.
+            original = self._original(txn_key) if txn_key else None
+            if not original:
+                raise
+            return original
+
+        if txn_key:
+            TxnKeys.remember("record", txn_key, (entry_log, entry_ice))
+        self._count_toward_checkpoint(1)
 
         return (entry_log, entry_ice)
 
-    def ice(self):
-        "Display all log entries for the owner."
-        query = AccountingIcetray.objects.filter(
-            db_owner__iexact=self.db_owner,
-            db_currency__iexact=self.db_currency
+    @staticmethod
+    def _txn_fields(txn_key, kind, index=0):
+        "The transaction key fields of an entry, matched exactly on lookup."
+        if not txn_key:
+            return {"db_txn_key": None, "db_txn_kind": None,
+                    "db_txn_index": None}
+        return {"db_txn_key": txn_key, "db_txn_kind": kind,
+                "db_txn_index": index}
+
+    @classmethod
+    def _original(cls, txn_key):
+        """
+        Find what a transaction key recorded, in the recent keys first and
+        then in the icetray and the archive. Returns None if the key hasn't
+        been used.
+        """
+        original = TxnKeys.get("record", txn_key)
+        if original is not None:
+            return original
+
+        keys = cls._txn_fields(txn_key, "record")
+        for model in (AccountingIcetray, AccountingArchive):
+            entry_ice = model.objects.filter(**keys).first()
+            if entry_ice is not None:
+                break
+        else:
+            return None
+        entry_log = AccountingLog.objects.filter(**keys).first()
+        TxnKeys.remember("record", txn_key, (entry_log, entry_ice))
+        return (entry_log, entry_ice)
+
+    @classmethod
+    def record_many(cls, entries, txn_key=None):
+        """
+        Record a batch of transactions, possibly against many Ledgers, at once.
+        The log entries are written with one insert per log table, each Ledger
+        total is updated with one statement, and all of it happens inside a
+        single database transaction.
+
+        Args:
+            entries (iterable): Tuples in the form
+                `(ledger, value, reason, origin)`. `origin` is optional and
+                defaults to the Ledger's owner, as in `record()`.
+            txn_key (str, optional): A key naming the whole batch, as in
+                `record()`. Every entry is stored under the key along with
+                its position in the batch. Batch keys and `record()` keys
+                are kept apart, so the same key can name one of each.
+
+        Returns:
+            entries (list): The AccountingIcetray entries, in order. For a
+                repeated `txn_key` these are the entries recorded originally.
+                Only a keyed batch is read back once it's written, so the
+                entries of a batch without a `txn_key` may have no keys of
+                their own yet.
+        """
+        return cls._record_batch(entries, txn_key)
+
+    @classmethod
+    def transfer(cls, source, credits, reason, origin="", overdraw=False,
+                 txn_key=None):
+        """
+        Move an amount from one Ledger to one or more others, such as a
+        character paying a shop or splitting a payout with their team.
+
+        The debit and every credit are recorded like `record_many()`: one
+        insert per log table and one update per Ledger, all in a single
+        database transaction, so a transfer is either applied in full or
+        not at all. Every entry is tagged with the same `db_transfer` id. The
+        icetray entries are written before returning even if write-behind is
+        on, so both sides of a transfer always land together.
+
+        Args:
+            source (Ledger): The Ledger paying.
+            credits (iterable): Tuples in the form `(ledger, value)`, one for
+                each Ledger being paid. Every value must be positive, and
+                every Ledger must be in the source's currency.
+            reason (str): What the transfer was for.
+            origin (str, optional): Who or what caused it. Defaults to the
+                source's owner.
+            overdraw (bool, optional): Allow the source to end up below zero.
+            txn_key (str, optional): A key naming the transfer, as in
+                `record_many()`.
+
+        Returns:
+            entries (list): The AccountingIcetray entries, the debit first and
+                then each credit in order.
+
+        Raises:
+            ValueError: If a credit is invalid, or if the source can't cover
+                the transfer and `overdraw` is False.
+        """
+        origin = origin or source.owner
+        currency = ledger_key(source.db_currency)
+        entries, total = [], 0
+        for ledger, value in credits:
+            value = ledger._amount(value)[0]
+            if ledger.pk == source.pk:
+                raise ValueError("A Ledger can't transfer to itself.")
+            if ledger_key(ledger.db_currency) != currency:
+                raise ValueError("Can't transfer {} into a {} Ledger.".format(
+                    source.db_currency, ledger.db_currency))
+            if value <= 0:
+                raise ValueError("Transfers must be of positive amounts.")
+            entries.append((ledger, value, reason, origin))
+            total += value
+        if not entries:
+            return []
+
+        entries.insert(0, (source, 0 - total, reason, origin))
+        return cls._record_batch(entries, txn_key, transfer=uuid4().hex,
+                                 guarded=() if overdraw else (source.pk,))
+
+    @classmethod
+    def _record_batch(cls, entries, txn_key=None, transfer=None, guarded=()):
+        """
+        Write the entries for `record_many()` and `transfer()`. Ledgers
+        whose pk is in `guarded` can't be taken below zero.
+        """
+        if txn_key:
+            original = cls._original_batch(txn_key)
+            if original:
+                return original
+
+        ices, logs, totals = [], [], OrderedDict()
+
+        for index, entry in enumerate(entries):
+            ledger, value, reason = entry[0:3]
+            origin = entry[3] if len(entry) > 3 and entry[3] else ledger.owner
+            value, units = ledger._amount(value)
+
+            # [ledger, delta, gained, delta in units, gained in units, count]
+            total = totals.setdefault(ledger.pk, [ledger, 0, 0, 0, 0, 0])
+            total[1] += value
+            total[3] += units
+            if value > 0:
+                total[2] += value
+                total[4] += units
+            total[5] += 1
+
+            # bulk_create() skips save(), so the keys are filled in here.
+            fields = {"db_owner": ledger.db_owner,
+                      "db_currency": ledger.db_currency,
+                      "db_owner_key": ledger_key(ledger.db_owner),
+                      "db_currency_key": ledger_key(ledger.db_currency),
+                      "db_value": value,
+                      "db_units": units,
+                      "db_reason": reason,
+                      "db_origin": origin,
+                      "db_transfer": transfer}
+            fields.update(cls._txn_fields(txn_key, "batch", index))
+            ices.append(AccountingIcetray(**fields))
+            logs.append(AccountingLog(**fields))
+
+        if not ices:
+            return []
+
+        try:
+            with transaction.atomic():
+                IcetrayQueue.add(ices, wait=bool(txn_key or transfer))
+                AccountingLog.objects.bulk_create(logs)
+
+                cls._apply([total[0:5] for total in totals.values()],
+                           guarded)
+
+                QuickLog.trim(cls.log_max,
+                              owners=[t[0].db_owner for t in totals.values()])
+        except IntegrityError:
+            original = cls._original_batch(txn_key) if txn_key else None
+            if not original:
+                raise
+            return original
+
+        if txn_key or transfer:
+            # bulk_create() doesn't fill in keys on every backend, so entries
+            # that were written now are read back to return them saved.
+            if txn_key:
+                query = AccountingIcetray.objects.filter(
+                    db_txn_key=txn_key, db_txn_kind="batch").order_by(
+                    'db_txn_index')
+            else:
+                query = AccountingIcetray.objects.filter(
+                    db_transfer=transfer).order_by('db_key')
+            ices = list(query)
+        if txn_key:
+            TxnKeys.remember("batch", txn_key, ices)
+        for total in totals.values():
+            total[0]._count_toward_checkpoint(total[5])
+
+        return ices
+
+    @classmethod
+    def _original_batch(cls, txn_key):
+        """
+        Find the entries a batch's transaction key recorded, in the icetray
+        and the archive.
+        """
+        original = TxnKeys.get("batch", txn_key)
+        if original is not None:
+            return original
+
+        # Archived entries are all older than live ones, so they come first.
+        original = [entry for model in (AccountingArchive, AccountingIcetray)
+                    for entry in model.objects.filter(
+                        db_txn_key=txn_key, db_txn_kind="batch").order_by(
+                        'db_txn_index')]
+        if original:
+            TxnKeys.remember("batch", txn_key, original)
+        return original
+
+    @classmethod
+    def _apply(cls, changes, guarded=()):
+        """
+        Add to Ledger totals in the database and read the results back.
+
+        Each Ledger is updated with F() expressions, so concurrent changes to
+        the same Ledger add up instead of overwriting each other, and the new
+        totals are then read back into the instances with one query. Call it
+        inside a transaction.
+
+        Args:
+            changes (list): Tuples in the form
+                `(ledger, delta, gained, delta in units, gained in units)`.
+            guarded (iterable, optional): Pks of Ledgers that can't go below
+                zero. The check is part of the update itself, so it holds
+                even against concurrent changes.
+
+        Raises:
+            ValueError: If a guarded Ledger would go below zero. Raised
+                inside the transaction, so nothing is applied.
+        """
+        for ledger, delta, gained, units, gained_units in changes:
+            query = cls.objects.filter(pk=ledger.pk)
+            if ledger.pk in guarded and delta < 0:
+                if money.fixed_point():
+                    query = query.filter(db_value_units__gte=0 - units)
+                else:
+                    query = query.filter(db_value__gte=0 - delta)
+            updated = query.update(
+                db_value=F('db_value') + delta,
+                db_accrued=F('db_accrued') + gained,
+                db_value_units=F('db_value_units') + units,
+                db_accrued_units=F('db_accrued_units') + gained_units)
+            if not updated and ledger.pk in guarded:
+                raise ValueError("{} doesn't have {} {} to spend.".format(
+                    NameCache.name(ledger.db_owner), 0 - delta,
+                    ledger.db_currency))
+
+        fresh = dict((row[0], row[1:]) for row in cls.objects.filter(
+            pk__in=[change[0].pk for change in changes]
+        ).values_list('pk', 'db_value', 'db_accrued', 'db_value_units',
+                      'db_accrued_units'))
+        # Update the instances without saving them again.
+        for change in changes:
+            ledger = change[0]
+            (ledger.db_value, ledger.db_accrued, ledger.db_value_units,
+             ledger.db_accrued_units) = fresh[ledger.pk]
+
+    def _count_toward_checkpoint(self, count):
+        # The count lives on the cached instance only. If the instance is
+        # flushed the count starts over, and the checkpoint Script covers
+        # whatever is missed.
+        self._since_checkpoint = getattr(self, "_since_checkpoint", 0) + count
+        if self._since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def _history(self, model=AccountingIcetray):
+        return model.objects.filter(
+            db_owner_key=ledger_key(self.db_owner),
+            db_currency_key=ledger_key(self.db_currency)
         )
-        output = []
 
-        for entry in query:
-            output.append(entry.as_list("date", "owner", "value", "currency",
-                                        "reason", "origin"))
+    def _sum_history(self, after=0, through=None, when=None):
+        "Sum the archived and live history after the key `after`."
+        total, gained = Decimal(0), Decimal(0)
+        for model in (AccountingArchive, AccountingIcetray):
+            query = self._history(model).filter(db_key__gt=after)
+            if through is not None:
+                query = query.filter(db_key__lte=through)
+            if when is not None:
+                query = query.filter(db_date_created__lte=when)
+            sums = sum_deltas(query, self.db_currency)
+            total += sums[0]
+            gained += sums[1]
+        return (total, gained)
 
-        return output
+    def _nearest_checkpoint(self, when=None):
+        query = LedgerCheckpoint.objects.filter(
+            db_owner_key=ledger_key(self.db_owner),
+            db_currency_key=ledger_key(self.db_currency)
+        )
+        if when is not None:
+            query = query.filter(db_as_of__lte=when)
+        return query.order_by('-db_as_of', '-db_last_key').first()
 
-    def ice_all(self):
-        "Display all log entries for everyone."
-        query = AccountingIcetray.objects.all()
-        output = []
+    def checkpoint(self, flush=True):
+        """
+        Save the Ledger's totals, as counted from the icetray, to a new
+        LedgerCheckpoint.
 
-        for entry in query:
-            output.append(entry.as_list("date", "owner", "value", "currency",
-                                        "reason", "origin"))
+        Args:
+            flush (bool): Write pending icetray entries first. From a thread,
+                flush before starting it and pass False.
 
-        return output
+        Returns:
+            checkpoint (LedgerCheckpoint or None): The new checkpoint, or None
+                if nothing has been recorded since the last one.
+        """
+        self._since_checkpoint = 0
+        if flush:
+            IcetrayQueue.flush()
+        last = self._nearest_checkpoint()
+        after = last.db_last_key if last else 0
+        for model in (AccountingIcetray, AccountingArchive):
+            newest = self._history(model).filter(db_key__gt=after).order_by(
+                '-db_key').values_list('db_key', 'db_date_created').first()
+            if newest:
+                break
+        else:
+            return None
+
+        total, gained = self._sum_history(after, through=newest[0])
+        if last:
+            value, accrued = last.db_value, last.db_accrued
+        else:
+            value, accrued = self.db_initial, self.db_initial
+
+        return LedgerCheckpoint.objects.create(
+            db_owner_key=ledger_key(self.db_owner),
+            db_currency_key=ledger_key(self.db_currency),
+            db_value=value + total,
+            db_accrued=accrued + gained,
+            db_last_key=newest[0],
+            db_as_of=newest[1])
+
+    @classmethod
+    def checkpoint_all(cls, flush=True):
+        """
+        Checkpoint every Ledger with entries newer than its last checkpoint.
+        Which Ledgers those are is worked out with one aggregate query each
+        over the icetray, the archive and the checkpoints, so Ledgers that
+        haven't changed cost nothing more.
+
+        Args:
+            flush (bool): Write pending icetray entries first. From a thread,
+                flush before starting it and pass False.
+
+        Returns:
+            written (int): The number of checkpoints written.
+        """
+        if flush:
+            IcetrayQueue.flush()
+        pair = ('db_owner_key', 'db_currency_key')
+        newest = {}
+        for model in (AccountingArchive, AccountingIcetray):
+            for owner, currency, key in model.objects.values_list(
+                    *pair).annotate(Max('db_key')).order_by():
+                newest[(owner, currency)] = max(
+                    key, newest.get((owner, currency), 0))
+        counted = dict(((owner, currency), key) for owner, currency, key in
+                       LedgerCheckpoint.objects.values_list(*pair).annotate(
+                           Max('db_last_key')).order_by())
+        changed = set(key for key, last in newest.items()
+                      if last > counted.get(key, 0))
+
+        written = 0
+        for ledger in cls.objects.all().iterator():
+            if (ledger.db_owner_key, ledger.db_currency_key) in changed and \
+                    ledger.checkpoint(flush=False):
+                written += 1
+        return written
+
+    def balance_at(self, when):
+        """
+        Work out the Ledger's totals at a past moment.
+
+        Args:
+            when (datetime): The moment to look at. Entries created at or
+                before it are counted.
+
+        Returns:
+            balance (Balance): A `(value, accrued)` namedtuple.
+        """
+        IcetrayQueue.flush()
+        last = self._nearest_checkpoint(when)
+        if last:
+            value, accrued = last.db_value, last.db_accrued
+        else:
+            value, accrued = self.db_initial, self.db_initial
+
+        total, gained = self._sum_history(last.db_last_key if last else 0,
+                                          when=when)
+        return Balance(Decimal(value) + total, Decimal(accrued) + gained)
+
+    @classmethod
+    def reconcile(cls, repair=False):
+        """
+        Check every Ledger's stored totals against its icetray history.
+
+        The history is summed with one GROUP BY over the icetray and the
+        monthly rollups of the archive, and compared with the Ledgers in the
+        same statement, so only the Ledgers that have drifted ever come back
+        to Python. With fixed-point money turned on, the comparison is done
+        exactly, on the unit columns.
+
+        Args:
+            repair (bool): If True, set each drifted Ledger's value and
+                accrued total to what its history says they should be.
+
+        Returns:
+            drift (list): A Drift namedtuple for each Ledger that disagrees
+                with its history.
+        """
+        IcetrayQueue.flush()
+        fixed = money.fixed_point()
+        names = {
+            "l": connection.ops.quote_name(cls._meta.db_table),
+            "i": connection.ops.quote_name(AccountingIcetray._meta.db_table),
+            "r": connection.ops.quote_name(AccountingRollup._meta.db_table),
+            "suffix": "_units" if fixed else "",
+            "entry": "db_units" if fixed else "db_value"
+        }
+        sql = "SELECT l.id, l.db_owner, l.db_currency, l.db_value{suffix}, " \
+              "l.db_accrued{suffix}, " \
+              "l.db_initial{suffix} + COALESCE(s.total, 0), " \
+              "l.db_initial{suffix} + COALESCE(s.gained, 0) " \
+              "FROM {l} AS l LEFT JOIN (" \
+              "SELECT db_owner_key, db_currency_key, SUM(total) AS total, " \
+              "SUM(gained) AS gained FROM (" \
+              "SELECT db_owner_key, db_currency_key, " \
+              "SUM({entry}) AS total, " \
+              "SUM(CASE WHEN {entry} > 0 THEN {entry} ELSE 0 END) " \
+              "AS gained FROM {i} GROUP BY db_owner_key, db_currency_key " \
+              "UNION ALL SELECT db_owner_key, db_currency_key, " \
+              "db_total{suffix}, db_gained{suffix} FROM {r}) AS h " \
+              "GROUP BY db_owner_key, db_currency_key) AS s " \
+              "ON s.db_owner_key = l.db_owner_key " \
+              "AND s.db_currency_key = l.db_currency_key " \
+              "WHERE ABS(l.db_value{suffix} - l.db_initial{suffix} " \
+              "- COALESCE(s.total, 0)) > %s " \
+              "OR ABS(l.db_accrued{suffix} - l.db_initial{suffix} " \
+              "- COALESCE(s.gained, 0)) > %s".format(**names)
+        tolerance = 0 if fixed else cls.drift_tolerance
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [tolerance, tolerance])
+            # Raw results skip the field converters, so normalize numbers.
+            if fixed:
+                drift = [Drift(*(row[0:3] + tuple(
+                    money.from_units(n, row[2]) for n in row[3:])))
+                    for row in cursor.fetchall()]
+            else:
+                drift = [Drift(*(row[0:3] + tuple(
+                    Decimal(str(n)) for n in row[3:])))
+                    for row in cursor.fetchall()]
+
+        if repair:
+            with transaction.atomic():
+                for row in drift:
+                    cls.objects.filter(pk=row.pk).update(
+                        db_value=row.expected_value,
+                        db_accrued=row.expected_accrued,
+                        db_value_units=money.to_units(row.expected_value,
+                                                      row.currency),
+                        db_accrued_units=money.to_units(row.expected_accrued,
+                                                        row.currency))
+            # The updates bypass the idmapper, so fix up cached Ledgers too.
+            for row in drift:
+                ledger = cls.get_cached_instance(row.pk)
+                if ledger:
+                    ledger.db_value = row.expected_value
+                    ledger.db_accrued = row.expected_accrued
+                    ledger.db_value_units = money.to_units(row.expected_value,
+                                                           row.currency)
+                    ledger.db_accrued_units = money.to_units(
+                        row.expected_accrued, row.currency)
+
+        return drift
+
+    @classmethod
+    def archive(cls, before=None):
+        """
+        Move old icetray entries into AccountingArchive, one month at a time,
+        writing an AccountingRollup for each owner, currency and month.
+
+        Only whole months are archived, so a month's rollups are complete
+        once written. Each month is copied, summed and deleted with a
+        handful of statements inside its own transaction.
+
+        Args:
+            before (datetime, optional): Archive entries from months that end
+                on or before this. Defaults to `SR5_LEDGER_ARCHIVE_AFTER` days
+                (365 unless set) ago.
+
+        Returns:
+            archived (int): The number of entries moved.
+        """
+        if before is None:
+            before = timezone.now() - timedelta(
+                days=getattr(settings, "SR5_LEDGER_ARCHIVE_AFTER", 365))
+        before = month_start(before)
+        archived = 0
+        IcetrayQueue.flush()
+
+        while True:
+            oldest = AccountingIcetray.objects.filter(
+                db_date_created__lt=before
+            ).order_by('db_date_created').values_list(
+                'db_date_created', flat=True).first()
+            if oldest is None:
+                return archived
+            archived += cls._archive_month(month_start(oldest))
+
+    @classmethod
+    def _archive_month(cls, month):
+        end = month_after(month)
+        rows = AccountingIcetray.objects.filter(db_date_created__gte=month,
+                                                db_date_created__lt=end)
+        fields = ("db_key", "db_owner", "db_currency", "db_value",
+                  "db_reason", "db_origin", "db_date_created",
+                  "db_owner_key", "db_currency_key", "db_units",
+                  "db_txn_key", "db_txn_kind", "db_txn_index",
+                  "db_transfer")
+        archive = connection.ops.quote_name(AccountingArchive._meta.db_table)
+        icetray = connection.ops.quote_name(AccountingIcetray._meta.db_table)
+        sql = "INSERT INTO {a} ({f}, db_month) SELECT {f}, %s FROM {i} " \
+              "WHERE db_date_created >= %s AND db_date_created < %s".format(
+                  a=archive, i=icetray, f=", ".join(fields))
+        params = [connection.ops.adapt_datefield_value(month.date()),
+                  connection.ops.adapt_datetimefield_value(month),
+                  connection.ops.adapt_datetimefield_value(end)]
+
+        with transaction.atomic():
+            sums = rows.values('db_owner_key', 'db_currency_key').annotate(
+                total=Sum('db_value'),
+                gained=Sum(Case(When(db_value__gt=0, then=F('db_value')),
+                                default=0,
+                                output_field=models.DecimalField())),
+                total_units=Sum('db_units'),
+                gained_units=Sum(Case(When(db_units__gt=0,
+                                           then=F('db_units')),
+                                      default=0,
+                                      output_field=models.BigIntegerField())),
+                count=Count('db_key')).order_by()
+            for row in sums:
+                rollup, created = AccountingRollup.objects.get_or_create(
+                    db_owner_key=row['db_owner_key'],
+                    db_currency_key=row['db_currency_key'],
+                    db_month=month.date())
+                AccountingRollup.objects.filter(pk=rollup.pk).update(
+                    db_total=F('db_total') + row['total'],
+                    db_gained=F('db_gained') + (row['gained'] or 0),
+                    db_total_units=F('db_total_units') + row['total_units'],
+                    db_gained_units=F('db_gained_units') +
+                    (row['gained_units'] or 0),
+                    db_count=F('db_count') + row['count'])
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                archived = cursor.rowcount
+            rows.delete()
+
+        return archived
+
+    def iter_ice(self, start=None, end=None, page_size=500):
+        """
+        Stream log entries for the owner, oldest first. Archived entries are
+        all older than live ones, so they simply come first.
+        """
+        IcetrayQueue.flush()
+        return chain(
+            iter_history(self._history(AccountingArchive), start, end,
+                         page_size),
+            iter_history(self._history(), start, end, page_size))
+
+    @classmethod
+    def iter_ice_all(cls, start=None, end=None, page_size=500):
+        "Stream log entries for everyone, oldest first."
+        IcetrayQueue.flush()
+        return chain(
+            iter_history(AccountingArchive.objects.all(), start, end,
+                         page_size),
+            iter_history(AccountingIcetray.objects.all(), start, end,
+                         page_size))
+
+    def ice(self, start=None, end=None):
+        "Display all log entries for the owner."
+        return list(self.iter_ice(start, end))
+
+    def ice_all(self, start=None, end=None):
+        "Display all log entries for everyone."
+        return list(self.iter_ice_all(start, end))
 
     def log(self):
         "Display quick log entries for the owner."
-        query = AccountingLog.objects.filter(
-            db_owner__iexact=self.db_owner,
-            db_currency__iexact=self.db_currency
-        )
+        query = QuickLog.entries(self.db_owner, self.db_currency,
+                                 self.log_max)
         output = []
 
         for entry in query:
@@ -322,3 +1558,4 @@ class Ledger(SharedMemoryModel):
                                         "reason", "origin"))
 
         return output
+
@@ -0,0 +1,61 @@
+"""
+Money
+
+Fixed-point helpers for the ledgers. Alongside its decimal value, every
+ledger amount is stored as a whole number of minor units: single nuyen,
+hundredths of a point of essence, and so on, as set per currency in
+`SR5_LEDGER_PRECISION`. With `SR5_LEDGER_FIXED_POINT` turned on, amounts are
+rounded to their currency's precision as they are recorded, and sums are
+done on the unit columns with integer math instead of on the decimals.
+
+Amounts recorded with it off keep any digits below their currency's
+precision, so turning it on can leave Ledgers whose unit totals disagree with
+their history. `Ledger.reconcile(repair=True)` sets them right.
+
+"""
+
+from decimal import Decimal, ROUND_HALF_EVEN
+from django.conf import settings
+
+# Decimal places kept for each currency, unless the settings say otherwise.
+PRECISION = {"nuyen": 0, "karma": 0, "essence": 2}
+DEFAULT_PLACES = 2
+
+
+def fixed_point():
+    "Is fixed-point money turned on?"
+    return getattr(settings, "SR5_LEDGER_FIXED_POINT", False)
+
+
+def places(currency):
+    "How many decimal places does the currency keep?"
+    precision = getattr(settings, "SR5_LEDGER_PRECISION", PRECISION)
+    return precision.get(unicode(currency).lower(), DEFAULT_PLACES)
+
+
+def to_decimal(value):
+    """
+    Turn a number into a Decimal. Floats go through their shortest string
+    form, so 0.1 becomes Decimal("0.1") and not its binary expansion.
+    """
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+
+def to_units(value, currency):
+    "Convert an amount of a currency into whole minor units."
+    return int(to_decimal(value).scaleb(places(currency)).to_integral_value(
+        rounding=ROUND_HALF_EVEN))
+
+
+def from_units(units, currency):
+    "Convert whole minor units of a currency back into a Decimal amount."
+    return Decimal(int(units or 0)).scaleb(0 - places(currency))
+
+
+def quantize(value, currency):
+    "Round an amount to the precision its currency keeps."
+    return from_units(to_units(value, currency), currency)
@@ -0,0 +1,94 @@
+"""
+Names
+
+Ledgers store owners and origins as dbrefs. This turns them back into display
+names in bulk, one query per batch of unknown dbrefs, and remembers the
+answers in a small LRU that forgets an object when it is renamed or deleted.
+
+"""
+
+from collections import OrderedDict
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from evennia.objects.models import ObjectDB
+from evennia.utils.utils import dbref
+
+
+class NameCache(object):
+    """
+    A dbref -> name cache shared by every ledger display.
+
+    Attributes:
+        cache (OrderedDict): Names keyed by dbref number, least recently used
+            first.
+        size (int): How many names to hold before dropping the oldest.
+
+    Methods:
+        names(refs): Returns a dict of each ref in `refs` to a display name.
+        name(ref): Returns the display name of one ref.
+        forget(ref): Drops a ref from the cache.
+    """
+
+    cache = OrderedDict()
+    size = 1000
+
+    @classmethod
+    def names(cls, refs):
+        """
+        Resolve any number of dbrefs with at most one query.
+
+        Args:
+            refs (iterable): Dbref strings like "#12". Anything that isn't a
+                dbref, like "Chargen", is its own name.
+
+        Returns:
+            names (dict): Each ref mapped to a name. Dbrefs that don't match
+                an object map to themselves.
+        """
+        output, missing = {}, {}
+        for ref in refs:
+            num = dbref(ref) if ref else None
+            if not num:
+                output[ref] = ref
+            elif num in cls.cache:
+                output[ref] = cls.cache.pop(num)
+                cls.cache[num] = output[ref]
+            else:
+                missing.setdefault(num, []).append(ref)
+
+        if missing:
+            found = dict(ObjectDB.objects.filter(
+                id__in=missing.keys()).values_list('id', 'db_key'))
+            for num, same_refs in missing.items():
+                for ref in same_refs:
+                    output[ref] = found.get(num, ref)
+                if num in found:
+                    cls.cache[num] = found[num]
+            while len(cls.cache) > cls.size:
+                cls.cache.popitem(last=False)
+
+        return output
+
+    @classmethod
+    def name(cls, ref):
+        "Resolve a single dbref."
+        return cls.names([ref])[ref]
+
+    @classmethod
+    def forget(cls, ref):
+        cls.cache.pop(dbref(ref) if isinstance(ref, basestring) else ref, None)
+
+
+# Typeclasses are proxies of ObjectDB and send signals as themselves, so these
+# listen to every sender and pick out the objects.
+@receiver(post_save)
+def _forget_renamed(sender, instance, update_fields=None, **kwargs):
+    if isinstance(instance, ObjectDB) and instance.id in NameCache.cache:
+        if not update_fields or "db_key" in update_fields:
+            NameCache.forget(instance.id)
+
+
+@receiver(post_delete)
+def _forget_deleted(sender, instance, **kwargs):
+    if isinstance(instance, ObjectDB):
+        NameCache.forget(instance.id)
@@ -15,6 +15,7 @@ from evennia.utils import spawner
 # functions could potentially live in this file, and it should only import
 # what it needs when it needs it.
 from sr5.data import ware
+from sr5.models import Ledger, ledger_key
 from sr5.msg_format import mf
 from sr5.utils import (a_n, itemize, flatten, LedgerHandler, SlotsHandler,
                        validate, ureg)
@@ -218,13 +219,12 @@ class Extra(DefaultObject):
         if costs:
             c.update({"costs": costs})
 
-        ledgers = buyer.attributes.get(category="ledgers", return_obj=True)
-        ledgers = [(l.key.lower(), l.value) for l in ledgers]
+        # The buyer's Ledgers, keyed by currency, from the Ledger registry.
+        ledgers = Ledger.for_owner(buyer)
 
-        aff = dict([(l.currency.lower(), l.value) for k, l in ledgers])
+        aff = dict([(k, l.value) for k, l in ledgers.items()])
 
         wiz.msg(repr(ledgers))
-        wiz.msg(repr(ledgers[0][1].currency))
         wiz.msg(repr(aff))
 
         can_afford = [(currency, False)
@@ -272,23 +272,25 @@ class Extra(DefaultObject):
                 item_slots = item[1].get('slots', False)
 
             if dest_slots and item_slots:
-                all_slots = dest_slots.all()
-                # Filter `all_slots` for slots named in `item_slots` that
-                # contain something.
+                # Find what is already in the slots that `item_slots` asks
+                # for, including the slots covered by groups like an arm.
                 try:
-                    conflicts = {
-                        cat: {s: i for s in is_list
-                              for i in all_slots[cat].values()
-                              if all_slots[cat][s]}
-                        for cat, is_list in item_slots.items()
-                    }
+                    conflicts = dest_slots.conflicts(item_slots)
                 except KeyError:
                     caller.msg(mf.tag + "You don't have sufficient slots for "
                                "that.")
-                conflicts = {c: s for c, s in conflicts.items() if s}
-                if conflicts:
-                    conflict_objs = [obj for c in conflicts.values()
-                                     for obj in c.values()]
+                    return False
+                conflict_objs = []
+                for taken in conflicts.values():
+                    for obj in taken.values():
+                        if obj not in conflict_objs:
+                            conflict_objs.append(obj)
+
+                if conflicts and mode == "normal":
+                    caller.msg(mf.tag + "You'll have to remove {} "
+                               "first.".format(itemize(
+                                   [str(obj) for obj in conflict_objs])))
+                    return False
 
                 if mode == "chargen":
                     # Cleanly replace anything already in the slot. Since stats
@@ -346,10 +348,12 @@ class Extra(DefaultObject):
             seller = " from {}".format(seller)
         reason = "Purchased {}{}.".format(purchase.key, seller)
 
-        results = [(c_name, ledger.record(0 - cost, reason, buyer.dbref))
+        # The entries are kept on the purchase, so they have to be written
+        # now rather than behind.
+        results = [(c_name, ledgers[ledger_key(c_name)].record(
+                        0 - cost, reason, buyer.dbref, wait=True))
                    for c_name, cost in costs.items()
-                   for l_name, ledger in ledgers
-                   if c_name.lower() == l_name.lower()]
+                   if ledger_key(c_name) in ledgers]
 
         for n, r in results:
             purchase.attributes.set("logs_" + n, r, category="logs")
@@ -515,39 +519,39 @@ class Cyberlimb(Augment):
                                      grade, c_agi=0, c_str=0):
         # TODO: Costs and capacity are no longer as tightly associated as
         # they once were. Maybe I should reconsider this.
-        slots = [s.lower() for s in slots["body"]]
         costs = {"nuyen": 0}
         capacity = 0
-        # This function doesn't actually care about left or right.
-        if "right_arm" in slots or "left_arm" in slots:
-            slots += ["right_upper_arm"]
-        elif "right_leg" in slots or "left_leg" in slots:
-            slots += "right_upper_leg"
+        # Whole limbs can be asked for by name, so expand them into the slots
+        # they cover. This function doesn't actually care about left or right.
+        slots = SlotsHandler.layout("body").expand(
+            [s.lower() for s in slots["body"]])
 
         if synthetic:
             source = Synthetic
         else:
             source = Obvious
 
+        # Check the largest part of a limb first, since a full limb covers
+        # the smaller parts as well.
         if [s for s in slots if "upper_arm" in s]:
             costs["nuyen"] = source.full_arm["cost"]
             capacity = source.full_arm["capacity"]
-        elif [s for s in slots if "lower_arm" in s]:
-            costs["nuyen"] = source.lower_arm["cost"]
-            capacity = source.lower_arm["capacity"]
-        elif [s for s in slots if "hand" in s or "foot" in s]:
-            costs["nuyen"] = source.hand_foot["cost"]
-            capacity = source.hand_foot["capacity"]
         elif [s for s in slots if "upper_leg" in s]:
             costs["nuyen"] = source.full_leg["cost"]
             capacity = source.full_leg["capacity"]
+        elif [s for s in slots if "lower_arm" in s]:
+            costs["nuyen"] = source.lower_arm["cost"]
+            capacity = source.lower_arm["capacity"]
         elif [s for s in slots if "lower_leg" in s]:
             costs["nuyen"] = source.lower_leg["cost"]
             capacity = source.lower_leg["capacity"]
+        elif [s for s in slots if "hand" in s or "foot" in s]:
+            costs["nuyen"] = source.hand_foot["cost"]
+            capacity = source.hand_foot["capacity"]
         elif [s for s in slots if "torso" in s]:
             costs["nuyen"] = source.torso["cost"]
             capacity = source.torso["capacity"]
-        elif [s for s in slots if "skull" in s]:
+        elif [s for s in slots if "skull" in s or "head" in s]:
             costs["nuyen"] = source.skull["cost"]
             capacity = source.skull["capacity"]
 
@@ -0,0 +1,136 @@
+"""
+Scripts
+
+Global Scripts that keep the ledger tables in shape. They are created by
+`start_ledger_scripts()`, which is called from `at_server_start()`.
+
+"""
+
+import evennia
+from django.db import close_old_connections
+from evennia import DefaultScript
+from evennia.utils import logger
+from twisted.internet.threads import deferToThread
+from sr5.models import Ledger, QuickLog
+from sr5.writebehind import IcetrayQueue
+
+
+class QuickLogSweeper(DefaultScript):
+    """
+    Periodically trims the AccountingLog quick log back down to
+    `Ledger.log_max` entries for every owner and currency. `Ledger.record()`
+    already trims as it goes, so this only cleans up after code that writes to
+    the quick log directly or after `Ledger.log_max` has been lowered.
+    """
+
+    def at_script_creation(self):
+        self.key = "quick_log_sweeper"
+        self.desc = "Trims the ledger quick log"
+        self.interval = 60 * 60
+        self.persistent = True
+
+    def at_repeat(self):
+        QuickLog.trim(Ledger.log_max)
+
+
+class LedgerCheckpointer(DefaultScript):
+    """
+    Writes a LedgerCheckpoint for every Ledger that has changed since its last
+    one. `Ledger.record()` checkpoints busy Ledgers as it goes; this makes
+    sure quiet ones get a recent checkpoint too, so `Ledger.balance_at()`
+    never has far to count. The checkpoints are written off the reactor
+    thread.
+    """
+
+    def at_script_creation(self):
+        self.key = "ledger_checkpointer"
+        self.desc = "Checkpoints ledger balances"
+        self.interval = 60 * 60 * 24
+        self.persistent = True
+
+    def at_repeat(self):
+        IcetrayQueue.flush()
+        in_thread(Ledger.checkpoint_all, flush=False).addErrback(
+            lambda failure: logger.log_trace(
+                "Ledger checkpoints failed: {}".format(
+                    failure.getErrorMessage())))
+
+
+class LedgerReconciler(DefaultScript):
+    """
+    Checks every Ledger's totals against its icetray history once a night and
+    logs any that have drifted. Nothing is changed; use `@ledger/repair` to
+    set them right. The check runs off the reactor thread.
+    """
+
+    def at_script_creation(self):
+        self.key = "ledger_reconciler"
+        self.desc = "Reports ledgers that disagree with their history"
+        self.interval = 60 * 60 * 24
+        self.persistent = True
+
+    def at_repeat(self):
+        def report(drift):
+            for row in drift:
+                logger.log_warn(
+                    "Ledger #{} ({} {}) has drifted: value {} (expected {}), "
+                    "accrued {} (expected {}).".format(
+                        row.pk, row.owner, row.currency, row.value,
+                        row.expected_value, row.accrued,
+                        row.expected_accrued))
+
+        in_thread(Ledger.reconcile).addCallbacks(
+            report, lambda failure: logger.log_trace(
+                "Ledger reconcile failed: {}".format(
+                    failure.getErrorMessage())))
+
+
+class LedgerArchiver(DefaultScript):
+    """
+    Moves icetray entries older than `SR5_LEDGER_ARCHIVE_AFTER` days into the
+    archive, a month at a time, so that the live icetray stays small. The
+    entries are moved off the reactor thread.
+    """
+
+    def at_script_creation(self):
+        self.key = "ledger_archiver"
+        self.desc = "Archives old icetray entries"
+        self.interval = 60 * 60 * 24
+        self.persistent = True
+
+    def at_repeat(self):
+        in_thread(Ledger.archive).addErrback(
+            lambda failure: logger.log_trace(
+                "Ledger archiving failed: {}".format(
+                    failure.getErrorMessage())))
+
+
+def in_thread(func, *args, **kwargs):
+    """
+    Call `func` with the given arguments in a worker thread, so that a
+    whole-table job doesn't hold up the game, and close the thread's database
+    connection when it's done.
+
+    Returns:
+        deferred (Deferred): Fires with what `func` returned.
+    """
+    def run():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return deferToThread(run)
+
+
+def start_ledger_scripts():
+    "Make sure that each global ledger Script exists."
+    scripts = {
+        "quick_log_sweeper": "sr5.scripts.QuickLogSweeper",
+        "ledger_checkpointer": "sr5.scripts.LedgerCheckpointer",
+        "ledger_reconciler": "sr5.scripts.LedgerReconciler",
+        "ledger_archiver": "sr5.scripts.LedgerArchiver",
+    }
+
+    for key, typeclass in scripts.items():
+        if not evennia.search_script(key):
+            evennia.create_script(typeclass, key=key)
@@ -1,8 +1,11 @@
 # URL patterns for the character app
 
 from django.conf.urls import url
-from sr5.systemview.views import skill_view
+from sr5.systemview.views import economy_view, ledger_export_view, \
+    skill_view
 
 urlpatterns = [
-    url(r'^skills', skill_view, name="skill_view")
+    url(r'^skills', skill_view, name="skill_view"),
+    url(r'^economy', economy_view, name="economy_view"),
+    url(r'^ledger-export', ledger_export_view, name="ledger_export_view")
 ]
@@ -1,12 +1,17 @@
 # Views for our character app
 
-from django.http import Http404
+from datetime import timedelta
+from django.http import Http404, HttpResponseBadRequest, \
+    StreamingHttpResponse
 from django.shortcuts import render
 from django.conf import settings
+from django.utils import timezone
 
 from evennia.utils.search import object_search
 from evennia.utils.utils import inherits_from
 from sr5.data.skills import Skills
+from sr5 import economy, export
+from sr5.names import NameCache
 
 def skill_view(request):
     # Templates can have difficulty displaying complex data structures. Use this function if the information needs to be simplified so that it can be easily digested.
@@ -17,3 +22,56 @@ def skill_view(request):
                    'skill_groups': Skills.groups,
                    'skill_attr': Skills.attr}
                  )
+
+
+def economy_view(request):
+    # Staff only. Everything here is aggregated in the database, so the page
+    # costs the same few queries no matter how big the icetray gets.
+    if not request.user.is_staff:
+        raise Http404("I couldn't find that page.")
+
+    try:
+        days = int(request.GET.get("days", 30))
+    except ValueError:
+        days = 30
+    currency = request.GET.get("currency", "nuyen").lower()
+    start = timezone.now() - timedelta(days=days)
+
+    top = economy.top(currency, start=start)
+    names = NameCache.names([row.group for row in top])
+
+    return render(request, 'mechanics/economy_view.html',
+                  {'days': days,
+                   'currency': currency,
+                   'totals': economy.totals(start=start),
+                   'top': [(names[row.group], row) for row in top],
+                   'buckets': economy.buckets("day", currency, start=start)}
+                 )
+
+
+def ledger_export_view(request):
+    # Staff only. The export is streamed from the database as it's read, so
+    # it takes the same memory however much history there is.
+    if not request.user.is_staff:
+        raise Http404("I couldn't find that page.")
+
+    fmt = request.GET.get("format", "csv").lower()
+    if fmt not in export.FORMATS:
+        return HttpResponseBadRequest("The format has to be one of {}.".format(
+            ", ".join(export.FORMATS)))
+    try:
+        start = export.parse_day(request.GET.get("start"))
+        end = export.parse_day(request.GET.get("end"), after=True)
+    except ValueError as err:
+        return HttpResponseBadRequest(str(err))
+    gzip = request.GET.get("gzip") in ("1", "true", "yes")
+
+    response = StreamingHttpResponse(
+        export.export(fmt, owner=request.GET.get("owner"),
+                      currency=request.GET.get("currency"), start=start,
+                      end=end, gzip=gzip),
+        content_type="application/gzip" if gzip
+        else export.CONTENT_TYPES[fmt])
+    response["Content-Disposition"] = "attachment; filename={}".format(
+        export.filename(fmt, gzip))
+    return response
@@ -0,0 +1,461 @@
+import json
+import zlib
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from django.apps import apps
+from django.test.utils import override_settings
+from django.utils import timezone
+from evennia.utils.test_resources import EvenniaTest
+from evennia.utils.idmapper.models import flush_cache
+from sr5 import benchmark, economy, export
+from sr5.models import AccountingArchive, AccountingLog, AccountingIcetray, \
+    AccountingRollup, Ledger, LedgerCheckpoint, QuickLog, TxnKeys
+from sr5.names import NameCache
+from sr5.writebehind import IcetrayQueue
+
+
+class TestLedger(EvenniaTest):
+    "Test the class `Ledger` and the log models behind it."
+
+    def setUp(self):
+        super(TestLedger, self).setUp()
+        QuickLog.rings.clear()
+        NameCache.cache.clear()
+        TxnKeys.recent.clear()
+        Ledger.registry.clear()
+        self.ledger = Ledger()
+        self.ledger.configure(self.char1, "karma", 25)
+
+    def test_record(self):
+        self.ledger.record(5, "Finished a run.", origin=self.char2.dbref)
+        self.ledger.record(-2, "Bought a quality.")
+
+        self.assertEqual(self.ledger.value, 28)
+        self.assertEqual(self.ledger.accrued, 30)
+        self.assertEqual(AccountingIcetray.objects.count(), 2)
+        self.assertEqual(AccountingLog.objects.count(), 2)
+
+    def test_record_concurrent(self):
+        # Another process adds to the ledger behind this instance's back.
+        Ledger.objects.filter(pk=self.ledger.pk).update(db_value=35)
+        self.ledger.record(5, "Finished a run.")
+
+        # The increment happens in the database, so neither change is lost.
+        self.assertEqual(self.ledger.value, 40)
+        self.assertEqual(Ledger.objects.filter(pk=self.ledger.pk)
+                         .values_list("db_value", flat=True)[0], 40)
+
+    def test_quick_log_cap(self):
+        for i in range(0, Ledger.log_max + 3):
+            self.ledger.record(1, "Entry {}".format(i))
+
+        # Every entry is kept on ice, but only the newest are in the log.
+        self.assertEqual(AccountingIcetray.objects.count(), Ledger.log_max + 3)
+        self.assertEqual(AccountingLog.objects.count(), Ledger.log_max)
+        reasons = [entry[4] for entry in self.ledger.log()]
+        self.assertEqual(reasons, ["Entry {}".format(i) for i
+                                   in range(3, Ledger.log_max + 3)])
+        # Tests run inside a transaction, which could still be rolled back,
+        # so no ring is kept.
+        self.assertEqual(QuickLog.rings, {})
+
+    def test_quick_log_trim(self):
+        for i in range(0, Ledger.log_max):
+            self.ledger.record(1, "Entry {}".format(i))
+
+        # Entries written behind the ring's back are caught by the sweeper.
+        for i in range(0, 4):
+            AccountingLog.objects.create(db_owner=self.ledger.owner,
+                                         db_currency="karma", db_value=1,
+                                         db_reason="Stray", db_origin="")
+        self.assertEqual(QuickLog.trim(Ledger.log_max), 4)
+        self.assertEqual(AccountingLog.objects.count(), Ledger.log_max)
+
+        # However many owners and currencies, a trim is one statement.
+        for owner in (self.char1.dbref, self.char2.dbref):
+            for currency in ("karma", "nuyen"):
+                for i in range(0, Ledger.log_max + 2):
+                    AccountingLog.objects.create(db_owner=owner,
+                                                 db_currency=currency,
+                                                 db_value=1, db_reason="Stray",
+                                                 db_origin="")
+        with self.assertNumQueries(1):
+            deleted = QuickLog.trim(Ledger.log_max,
+                                    owners=[self.char1.dbref,
+                                            self.char2.dbref])
+        self.assertEqual(deleted, Ledger.log_max + 2 + 3 * 2)
+        self.assertEqual(AccountingLog.objects.count(), 4 * Ledger.log_max)
+
+    def test_record_many(self):
+        other = Ledger()
+        other.configure(self.char2, "karma", 0)
+
+        entries = Ledger.record_many([
+            (self.ledger, 5, "Scene award.", self.char2.dbref),
+            (other, 5, "Scene award.", self.char1.dbref),
+            (self.ledger, -3, "Bought a quality.")
+        ])
+
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(self.ledger.value, 27)
+        self.assertEqual(self.ledger.accrued, 30)
+        self.assertEqual(other.value, 5)
+        # The stored totals match the cached instances.
+        stored = Ledger.objects.filter(pk=self.ledger.pk).values_list(
+            "db_value", "db_accrued")[0]
+        self.assertEqual(stored, (27, 30))
+        self.assertEqual(AccountingLog.objects.count(), 3)
+
+    def test_keys(self):
+        AccountingIcetray.objects.create(db_owner=self.ledger.owner,
+                                         db_currency="KARMA", db_value=1,
+                                         db_reason="Stray", db_origin="")
+        self.ledger.record(1, "Finished a run.")
+
+        # Lookups match on the normalized keys regardless of case.
+        self.assertEqual(len(self.ledger.ice()), 2)
+        self.assertEqual(AccountingIcetray.objects.filter(
+            db_currency_key="karma").count(), 2)
+
+    def test_iter_ice(self):
+        Ledger.record_many([(self.ledger, 1, "Entry {}".format(i))
+                            for i in range(0, 7)])
+
+        # Small pages still walk the whole history in order.
+        reasons = [entry.reason for entry in self.ledger.iter_ice(page_size=3)]
+        self.assertEqual(reasons, ["Entry {}".format(i) for i in range(0, 7)])
+        self.assertEqual(self.ledger.ice()[0][4], "Entry 0")
+
+    def test_balance_at(self):
+        self.ledger.record(5, "Finished a run.")
+        self.ledger.record(-2, "Bought a quality.")
+        self.ledger.checkpoint()
+        middle = timezone.now()
+        self.ledger.record(4, "Finished another run.")
+
+        self.assertEqual(LedgerCheckpoint.objects.count(), 1)
+        self.assertEqual(self.ledger.balance_at(middle), (28, 30))
+        self.assertEqual(self.ledger.balance_at(timezone.now()), (32, 34))
+        # Nothing new has been recorded, so there's nothing to checkpoint.
+        other = Ledger()
+        other.configure(self.char2, "karma", 0)
+        self.assertEqual(Ledger.checkpoint_all(), 1)
+        self.assertEqual(Ledger.checkpoint_all(), 0)
+        self.assertIsNone(self.ledger.checkpoint())
+
+    def test_reconcile(self):
+        self.ledger.record(5, "Finished a run.")
+        self.assertEqual(Ledger.reconcile(), [])
+
+        # Change the totals behind the history's back.
+        self.ledger.value += 3
+        drift = Ledger.reconcile(repair=True)
+        self.assertEqual(len(drift), 1)
+        self.assertEqual(drift[0].expected_value, 30)
+        self.assertEqual(self.ledger.value, 30)
+        self.assertEqual(Ledger.reconcile(), [])
+
+        # Starting a Ledger over records an adjustment and keeps the history,
+        # so it still adds up and its keys can't be used again.
+        self.ledger.record(1, "Keyed.", txn_key="run-1")
+        self.ledger.checkpoint()
+        self.ledger.configure(self.char1, "karma", 10)
+        self.assertEqual(self.ledger.value, 10)
+        self.assertEqual(Ledger.reconcile(), [])
+        self.assertEqual([entry[4] for entry in self.ledger.ice()],
+                         ["Finished a run.", "Keyed.", "Started over at 10."])
+        self.assertEqual(self.ledger.balance_at(timezone.now()).value, 10)
+        self.ledger.record(1, "Keyed.", txn_key="run-1")
+        self.assertEqual(self.ledger.value, 10)
+
+    def test_archive(self):
+        self.ledger.record(5, "Finished a run.")
+        self.ledger.record(-2, "Bought a quality.")
+        self.ledger.record(4, "Finished another run.")
+        old = timezone.now() - timedelta(days=400)
+        AccountingIcetray.objects.exclude(db_reason="Finished another run.") \
+            .update(db_date_created=old)
+
+        self.assertEqual(Ledger.archive(), 2)
+        self.assertEqual(AccountingIcetray.objects.count(), 1)
+        self.assertEqual(AccountingArchive.objects.count(), 2)
+        rollup = AccountingRollup.objects.get()
+        self.assertEqual((rollup.db_total, rollup.db_gained, rollup.db_count),
+                         (3, 5, 2))
+
+        # History and totals still see the archived entries.
+        self.assertEqual([entry.value for entry in self.ledger.iter_ice()],
+                         [5, -2, 4])
+        self.assertEqual(Ledger.reconcile(), [])
+        self.assertEqual(self.ledger.balance_at(old), (28, 30))
+        self.assertEqual(economy.totals(), [("karma", 7, 9, -2, 3)])
+        self.assertEqual(economy.top("karma")[0].count, 3)
+        self.assertEqual(economy.totals(start=old + timedelta(days=40)),
+                         [("karma", 4, 4, 0, 1)])
+
+    def test_names(self):
+        entry = self.ledger.record(5, "Finished a run.",
+                                   origin=self.char2.dbref)[0]
+        self.assertIn("from " + self.char2.key, entry.display())
+
+        # Renaming forgets the cached name.
+        self.char2.key = "Renamed"
+        self.assertEqual(NameCache.name(self.char2.dbref), "Renamed")
+        self.assertEqual(NameCache.name("Chargen"), "Chargen")
+
+    def test_write_behind(self):
+        # Rows waiting in the queue are written before anything reads them.
+        IcetrayQueue.pending.extend([
+            AccountingIcetray(db_owner=self.ledger.owner, db_currency="karma",
+                              db_owner_key=self.ledger.owner.lower(),
+                              db_currency_key="karma", db_value=i,
+                              db_reason="Queued", db_origin="")
+            for i in range(1, 4)])
+        self.assertEqual(AccountingIcetray.objects.count(), 0)
+        self.assertEqual(len(self.ledger.ice()), 3)
+        self.assertEqual(IcetrayQueue.pending, [])
+
+        # A transaction that writes its own rows right away leaves the rest
+        # queued, so rolling it back can't lose them.
+        queued = AccountingIcetray(db_owner=self.ledger.owner,
+                                   db_currency="karma", db_value=1,
+                                   db_reason="Queued", db_origin="")
+        IcetrayQueue.pending.append(queued)
+        other = Ledger.fetch(self.char2, "karma", 0)
+        with self.assertRaises(ValueError):
+            Ledger.transfer(self.ledger, [(other, 1000)], "Too much.")
+        self.assertEqual(IcetrayQueue.pending, [queued])
+        IcetrayQueue.flush()
+        self.assertEqual(len(self.ledger.ice()), 4)
+
+        # While the queue is running, a flush inside a transaction waits for
+        # the commit, which never comes in a TestCase.
+        queued = AccountingIcetray(db_owner=self.ledger.owner,
+                                   db_currency="karma", db_value=1,
+                                   db_reason="Queued", db_origin="")
+        IcetrayQueue.pending.append(queued)
+        IcetrayQueue.loop = object()
+        try:
+            IcetrayQueue.flush()
+            self.assertEqual(IcetrayQueue.pending, [queued])
+            self.assertIsNone(queued.pk)
+        finally:
+            IcetrayQueue.loop = None
+            del IcetrayQueue.pending[:]
+
+        # A batch the worker couldn't write is retried by the next flush,
+        # and if stopping can't write it either, it's logged, not raised.
+        IcetrayQueue.failed.append(queued)
+        IcetrayQueue.flush()
+        self.assertEqual(IcetrayQueue.failed, [])
+        self.assertIsNotNone(queued.pk)
+        IcetrayQueue.failed.extend([
+            AccountingIcetray(db_owner=None, db_currency="karma", db_value=1,
+                              db_reason="Broken", db_origin="")
+            for i in range(2)])
+        IcetrayQueue.stop()
+        self.assertEqual(len(IcetrayQueue.pending), 2)
+        del IcetrayQueue.pending[:]
+
+    def test_economy(self):
+        other = Ledger()
+        other.configure(self.char2, "karma", 0)
+        Ledger.record_many([(self.ledger, 5, "Scene award."),
+                            (other, 8, "Scene award."),
+                            (self.ledger, -2, "Bought a quality.")])
+
+        self.assertEqual(economy.totals(),
+                         [("karma", 11, 13, -2, 3)])
+        top = economy.top("karma")
+        self.assertEqual([row.group for row in top],
+                         [self.char2.dbref, self.char1.dbref])
+        buckets = economy.buckets("day", "karma")
+        self.assertEqual(len(buckets), 1)
+        self.assertEqual(buckets[0].group.hour, 0)
+
+    @override_settings(SR5_LEDGER_FIXED_POINT=True)
+    def test_fixed_point(self):
+        essence = Ledger()
+        essence.configure(self.char1, "essence", 6)
+        essence.record(-0.1, "Datajack.")
+        essence.record(-0.205, "Cybereyes.")
+
+        # Amounts are rounded to the currency's places and kept in units.
+        self.assertEqual(essence.value, Decimal("5.70"))
+        self.assertEqual(essence.value_units, 570)
+        self.assertEqual(AccountingIcetray.objects.filter(
+            db_currency_key="essence").values_list("db_units", flat=True)[0],
+            -10)
+        self.assertEqual(Ledger.reconcile(), [])
+        self.assertEqual(economy.totals(currency="essence")[0].total,
+                         Decimal("-0.30"))
+
+        # Setting a total directly keeps its units in step.
+        essence.value = Decimal("5.5")
+        self.assertEqual(Ledger.objects.filter(pk=essence.pk).values_list(
+            "db_value_units", flat=True)[0], 550)
+        self.assertEqual(len(Ledger.reconcile()), 1)
+
+    def test_txn_key(self):
+        first = self.ledger.record(5, "Finished a run.", txn_key="run-1")
+        again = self.ledger.record(5, "Finished a run.", txn_key="run-1")
+        self.assertEqual(again, first)
+
+        # With the recent keys forgotten, the unique index still catches it.
+        TxnKeys.recent.clear()
+        again = self.ledger.record(5, "Finished a run.", txn_key="run-1")
+        self.assertEqual(again[1].pk, first[1].pk)
+        self.assertEqual(self.ledger.value, 30)
+        self.assertEqual(AccountingIcetray.objects.count(), 1)
+
+        batch = [(self.ledger, 1, "Scene award."),
+                 (self.ledger, 2, "Scene award.")]
+        recorded = Ledger.record_many(batch, txn_key="scene-1")
+        self.assertTrue(all(entry.pk for entry in recorded))
+        TxnKeys.recent.clear()
+        again = Ledger.record_many(batch, txn_key="scene-1")
+        self.assertEqual([entry.pk for entry in again],
+                         [entry.pk for entry in recorded])
+        self.assertEqual([entry.db_value for entry in again], [1, 2])
+        self.assertEqual(self.ledger.value, 33)
+        self.assertEqual(AccountingIcetray.objects.count(), 3)
+
+        # Keys still count once their entries have been archived.
+        AccountingIcetray.objects.update(
+            db_date_created=timezone.now() - timedelta(days=400))
+        Ledger.archive()
+        again = self.ledger.record(5, "Finished a run.", txn_key="run-1")
+        self.assertEqual(again[1].pk, first[1].pk)
+        again = Ledger.record_many(batch, txn_key="scene-1")
+        self.assertEqual([entry.db_value for entry in again], [1, 2])
+        self.assertEqual(self.ledger.value, 33)
+        self.assertEqual(AccountingIcetray.objects.count(), 0)
+
+        # Batch keys and record() keys are matched exactly, not by prefix.
+        self.ledger.record(1, "Keyed.", txn_key="k:0")
+        self.ledger.record(1, "Keyed.", txn_key="k:1")
+        Ledger.record_many(batch, txn_key="k")
+        self.assertEqual(self.ledger.value, 38)
+        Ledger.record_many(batch[0:1], txn_key="k:1")
+        TxnKeys.recent.clear()
+        again = Ledger.record_many(batch, txn_key="k")
+        self.assertEqual([entry.db_value for entry in again], [1, 2])
+        self.assertEqual(self.ledger.value, 39)
+
+    def test_transfer(self):
+        shop, fixer = Ledger(), Ledger()
+        shop.configure(self.char2, "karma", 0)
+        fixer.configure(self.obj1, "karma", 0)
+
+        entries = Ledger.transfer(self.ledger, [(shop, 15), (fixer, 5)],
+                                  "Bought a contact.")
+        self.assertEqual([entry.db_value for entry in entries], [-20, 15, 5])
+        self.assertTrue(all(entry.pk for entry in entries))
+        self.assertEqual(len(set(entry.db_transfer for entry in
+                                 AccountingIcetray.objects.all())), 1)
+        self.assertEqual((self.ledger.value, shop.value, fixer.value),
+                         (5, 15, 5))
+
+        # A transfer the source can't cover changes nothing.
+        with self.assertRaises(ValueError):
+            Ledger.transfer(self.ledger, [(shop, 10)], "Too much.")
+        self.assertEqual(self.ledger.value, 5)
+        self.assertEqual(AccountingIcetray.objects.count(), 3)
+        self.assertEqual(Ledger.reconcile(), [])
+
+    def test_registry(self):
+        self.assertIs(Ledger.fetch(self.char1, "KARMA"), self.ledger)
+        self.assertIsNone(Ledger.fetch(self.char1, "nuyen"))
+        nuyen = Ledger.fetch(self.char1, "nuyen", 500)
+        self.assertEqual(nuyen.value, 500)
+        self.assertIs(Ledger.fetch(self.char1, "nuyen", 0), nuyen)
+
+        # Once an owner has been looked up, their Ledgers are cached.
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(Ledger.for_owner(self.char1)),
+                             ["karma", "nuyen"])
+        nuyen.record(-100, "Bought a commlink.")
+        nuyen.delete()
+        self.assertEqual(list(Ledger.for_owner(self.char1)), ["karma"])
+
+        # The deleted Ledger's history goes with it, so a new one starts
+        # clean.
+        self.assertEqual(AccountingIcetray.objects.filter(
+            db_currency_key="nuyen").count(), 0)
+        Ledger.fetch(self.char1, "nuyen", 50)
+        self.assertEqual(Ledger.reconcile(), [])
+
+    def test_registry_migration(self):
+        migration = import_module("sr5.migrations.0010_ledger_registry")
+        self.ledger.record(5, "Finished a run.")
+        old = timezone.now() - timedelta(days=400)
+        AccountingIcetray.objects.update(db_date_created=old)
+        Ledger.archive()
+
+        # A second Ledger for the same owner and currency, from before keys
+        # were unique.
+        Ledger.objects.filter(pk=self.ledger.pk).update(
+            db_currency="Karma", db_owner_key="", db_date_created=old)
+        newest = Ledger()
+        newest.configure(self.char1, "karma", 10)
+        newest.record(2, "Finished another run.")
+
+        migration.drop_duplicates(apps)
+        self.assertEqual(list(Ledger.objects.values_list("pk", flat=True)),
+                         [newest.pk])
+        self.assertEqual([entry.value for entry in newest.iter_ice()], [2])
+        self.assertEqual(AccountingRollup.objects.count(), 0)
+        self.assertEqual(Ledger.reconcile(), [])
+
+    @override_settings(SR5_LOG_CACHE_MAX=3)
+    def test_cache_limit(self):
+        for i in range(0, Ledger.log_max):
+            self.ledger.record(1, "Entry {}".format(i))
+
+        # The idmapper only holds the most recently used entries, but every
+        # entry can still be read.
+        stats = AccountingLog.cache_stats()
+        self.assertEqual((stats.size, stats.limit), (3, 3))
+        self.assertGreater(stats.evictions, 0)
+        self.assertEqual(len(self.ledger.log_all()), Ledger.log_max)
+        self.assertEqual(AccountingLog.cache_stats().size, 3)
+
+    def test_benchmark(self):
+        report = benchmark.run(characters=2, transactions=3, samples=2)
+
+        self.assertEqual(report["results"]["record"]["count"], 2)
+        self.assertEqual(report["results"]["reconcile"]["count"], 1)
+        # The population is rolled back afterwards.
+        self.assertEqual(Ledger.objects.count(), 1)
+        self.assertEqual(AccountingIcetray.objects.count(), 0)
+        self.assertFalse(any(change[4] for change in
+                             benchmark.compare(report, report)))
+
+    def test_export(self):
+        self.ledger.record(5, "Finished a run, at last.")
+        nuyen = Ledger.fetch(self.char1, "nuyen", 0)
+        nuyen.record(100, "Sold a car.")
+
+        lines = "".join(export.export("csv", currency="karma")).splitlines()
+        self.assertEqual(lines[0],
+                         "date,owner,value,currency,reason,origin,key")
+        self.assertEqual(len(lines), 2)
+        self.assertIn('"Finished a run, at last."', lines[1])
+
+        rows = "".join(export.export("jsonl")).splitlines()
+        self.assertEqual([json.loads(row)["value"] for row in rows],
+                         ["5", "100"])
+        compressed = "".join(export.export("jsonl", gzip=True))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+                         "".join(export.export("jsonl")))
+        # Exports started in the same second still get their own files.
+        self.assertNotEqual(export.filename("csv"), export.filename("csv"))
+
+    def tearDown(self):
+        QuickLog.rings.clear()
+        NameCache.cache.clear()
+        TxnKeys.recent.clear()
+        Ledger.registry.clear()
+        flush_cache()
+        super(TestLedger, self).tearDown()
@@ -1,4 +1,5 @@
 from evennia.utils.test_resources import EvenniaTest
+from evennia.objects.models import ObjectDB
 from evennia.objects.objects import (DefaultObject, DefaultCharacter,
                                      DefaultRoom, DefaultExit)
 from evennia.players.players import DefaultPlayer
@@ -8,6 +9,7 @@ from evennia.server.sessionhandler import SESSIONS
 from evennia.utils import create
 from evennia.utils.idmapper.models import flush_cache
 from evennia.utils.utils import lazy_property
+from sr5 import benchmark
 from sr5.utils import *
 
 
@@ -109,9 +111,11 @@ class TestCatDbHolder(EvenniaTest):
         player.attributes.add("record", expected, category="Logs")
         self.assertEqual(expected, player.logs.record)
 
-        expected = "Someone set up us the bomb!!!"
-        player.attributes.add("result", expected, category="Ledgers")
-        self.assertEqual(expected, player.ldb.result)
+        player.ldb.karma = 5
+        self.assertEqual(5, player.ldb.karma.value)
+        self.assertEqual(["karma"], list(player.ldb.all))
+        del player.ldb.karma
+        self.assertIsNone(player.ldb.karma)
 
 
 class SlottedObject(DefaultObject):
@@ -174,7 +178,7 @@ class TestSlotsHandler(EvenniaTest):
         self.assertTrue(add)
 
         self.obj.slots.add({"addons": [3, "y"]})
-        self.assertEqual(self.obj.attributes.get("addons", category="slots"),
+        self.assertEqual(self.obj.slots.all()["addons"],
                          {1: "", 2: "", 3: "",
                          "left": "", "right": "", "y": ""})
 
@@ -183,7 +187,7 @@ class TestSlotsHandler(EvenniaTest):
 
         delete = self.obj.slots.delete({"addons": [1, "right"]})
         self.assertIsInstance(delete, dict)
-        self.assertEqual(self.obj.attributes.get("addons", category="slots"),
+        self.assertEqual(self.obj.slots.all()["addons"],
                          {1: "", 2: "", "left": "", "y": ""})
 
     def test_attach(self):
@@ -199,7 +203,7 @@ class TestSlotsHandler(EvenniaTest):
         self.assertEqual(attach, {"addons": {"left": self.slo1}})
 
         # What does the attribute look like?
-        real = self.obj.attributes.get("addons", category="slots")
+        real = self.obj.slots.all()["addons"]
         expected = {1: "", 2: "", 3: "",
                     "left": self.slo1, "right": "", "y": ""}
         self.assertEqual(expected, real)
@@ -227,7 +231,7 @@ class TestSlotsHandler(EvenniaTest):
         self.assertEqual(attach, {"addons": {"right": self.slo1}})
 
         # Check the end result.
-        real = self.obj.attributes.get("addons", category="slots")
+        real = self.obj.slots.all()["addons"]
         expected = {1: self.slo2, 2: self.slo3, 3: self.slo3,
                     "left": self.slo1, "right": self.slo1, "y": self.slo3}
         self.assertEqual(real, expected)
@@ -290,6 +294,168 @@ class TestSlotsHandler(EvenniaTest):
         self.assertEqual(self.obj.slots.where(self.slo2),
                          {})
 
+    def test_numbered(self):
+        self.obj.slots.add({"pool": [1000]})
+        for obj in (self.slo1, self.slo2, self.slo1, self.slo3):
+            self.obj.slots.attach(obj, {"pool": [2]})
+
+        # Dropping moves the highest filled slots into the gaps.
+        drop = self.obj.slots.drop(self.slo1, {"pool": [1]})
+        self.assertEqual(drop, {"pool": {1: self.slo1, 2: self.slo1,
+                                         5: self.slo1, 6: self.slo1}})
+        self.assertEqual(self.obj.slots.where(self.slo3), {"pool": [1, 2]})
+        self.assertEqual(self.obj.slots.where(self.slo2), {"pool": [3, 4]})
+
+        # Only the filled slots are stored one by one.
+        stored = self.obj.attributes.get("pool", category="slots")
+        self.assertEqual(stored["__size__"], 1000)
+        self.assertEqual(len(stored["__filled__"]), 4)
+
+    def test_old_format(self):
+        # Slots stored as `{slot: contents}` are still read.
+        self.obj.attributes.add("addons", {1: "", 2: self.slo1, "left": ""},
+                                category="slots")
+        self.assertEqual(self.obj.slots.where(self.slo1), {"addons": [1]})
+        self.assertEqual(self.obj.slots.all(),
+                         {"addons": {1: self.slo1, 2: "", "left": ""}})
+
+    def test_layout(self):
+        SlotsHandler.register("test", ["left", "right", 2])
+        self.obj.slots.add_layout("test", "addons")
+        self.obj.slots.attach(self.slo2)
+
+        # The object only stores the layout's name and what is attached.
+        stored = self.obj.attributes.get("addons", category="slots")
+        self.assertEqual(stored["__layout__"], "test")
+        self.assertNotIn("__names__", stored)
+        self.assertEqual(stored["__named__"],
+                         {"right": ("objects.objectdb", self.slo2.id)})
+        self.assertEqual(self.obj.slots.all(),
+                         {"addons": {1: self.slo2, 2: "",
+                                     "left": "", "right": self.slo2}})
+
+        # Adding slots stores the difference from the layout.
+        self.obj.slots.add({"addons": ["y"]})
+        self.assertIn("y", self.obj.slots.all()["addons"])
+        del SlotsHandler.layouts["test"]
+
+    def test_refs(self):
+        self.test_attach()
+
+        # Occupants are stored as references and looked up when returned.
+        stored = self.obj.attributes.get("addons", category="slots")
+        self.assertEqual(stored["__filled__"],
+                         [("objects.objectdb", self.slo2.id),
+                          ("objects.objectdb", self.slo3.id),
+                          ("objects.objectdb", self.slo3.id)])
+        self.assertEqual(self.obj.slots.all(refs=True)["addons"]["left"],
+                         ("objects.objectdb", self.slo1.id))
+        self.assertEqual(self.obj.slots.all()["addons"]["left"], self.slo1)
+
+        # Anything can be stored, and strings stay strings even if they look
+        # like a dbref.
+        self.obj.slots.add({"extras": ["script", "note"]})
+        self.obj.slots.attach(self.script, {"extras": ["script"]})
+        self.obj.slots.attach(self.slo1.dbref, {"extras": ["note"]})
+        self.assertEqual(self.obj.slots.all()["extras"],
+                         {"script": self.script, "note": self.slo1.dbref})
+
+    def test_batch(self):
+        self.test_add()
+
+        # Nothing is written until the batch ends.
+        with self.obj.slots.batch():
+            self.obj.slots.attach(self.slo1)
+            self.obj.slots.attach(self.slo2)
+            self.assertEqual(self.obj.attributes.get(
+                "addons", category="slots")["__filled__"], [])
+            self.assertEqual(self.obj.slots.where(self.slo2),
+                             {"addons": [1, "right"]})
+        self.assertEqual(self.obj.slots.all()["addons"]["right"], self.slo2)
+
+        # If anything fails, nothing in the batch is written.
+        with self.assertRaises(Exception):
+            with self.obj.slots.batch():
+                self.obj.slots.drop(self.slo2)
+                self.obj.slots.attach(self.slo3, {"addons": [5]})
+        self.assertEqual(self.obj.slots.where(self.slo2),
+                         {"addons": [1, "right"]})
+        self.assertEqual(self.obj.slots.where(self.slo3), {})
+
+        # A batch inside a batch that fails only undoes its own changes.
+        with self.obj.slots.batch():
+            self.obj.slots.drop(self.slo2)
+            with self.assertRaises(Exception):
+                with self.obj.slots.batch():
+                    self.obj.slots.attach(self.slo3, {"addons": ["y"]})
+                    self.obj.slots.attach(self.slo3, {"addons": [5]})
+        self.assertEqual(self.obj.slots.where(self.slo2), {})
+        self.assertEqual(self.obj.slots.where(self.slo3), {})
+        self.assertEqual(self.obj.slots.all()["addons"]["y"], "")
+
+    def test_groups(self):
+        SlotsHandler.register("test", ["upper", "lower", "hand"], groups={
+            "arm": ["upper", "forearm"], "forearm": ["lower", "hand"]})
+        self.obj.slots.add_layout("test", "arm")
+        self.obj.slots.attach(self.slo1, {"arm": ["hand"]})
+
+        # Asking for a group finds whatever is in any of its slots.
+        self.assertEqual(self.obj.slots.conflicts({"arm": ["arm"]}),
+                         {"arm": {"hand": self.slo1}})
+        self.assertEqual(self.obj.slots.conflicts({"arm": ["upper"]}), {})
+
+        # Replacing only empties the slots that are in the way.
+        drop, attach = self.obj.slots.replace(self.slo2, {"arm": ["forearm"]})
+        self.assertEqual(drop, {"arm": {"hand": self.slo1}})
+        self.assertEqual(self.obj.slots.where(self.slo2),
+                         {"arm": ["hand", "lower"]})
+        del SlotsHandler.layouts["test"]
+
+    def test_index(self):
+        self.test_attach()
+
+        # A new handler builds its reverse index from the stored slots.
+        self.assertEqual(SlotsHandler(self.obj).where(self.slo3),
+                         {"addons": [2, 3, "y"]})
+
+        # Deleting slots takes their contents out of the index.
+        self.obj.slots.delete({"addons": ["y"]})
+        self.assertEqual(self.obj.slots.where(self.slo3),
+                         {"addons": [2, 3]})
+
+    def test_buy_chargen(self):
+        # sr5.objects looks up a player on import, so it waits for the test
+        # database.
+        from sr5.objects import Extra
+
+        class Part(Extra):
+            "An Extra that skips the ware options and takes the left slot."
+
+            @classmethod
+            def at_pre_purchase(cls, caller, item, options, **kwargs):
+                return {"key": "new part",
+                        "typeclass": "sr5.test_utils.SlottableObjectThree",
+                        "slots": {"addons": ["left"]}}
+
+            @classmethod
+            def clean_delete(cls, obj, slots):
+                slots.drop(obj)
+                return True
+
+        self.test_add()
+        self.obj.slots.attach(self.slo1)
+        buyer = create.create_object(DefaultObject, key="buyer",
+                                     location=self.room1, home=self.room1)
+        # In chargen, purchases replace whatever is in the way.
+        buyer.cg = self.obj
+
+        purchase = Part.buy(buyer, "CYBERLIMB", [])
+        self.assertEqual(purchase.key, "new part")
+        self.assertEqual(purchase.location, buyer)
+        self.assertEqual(self.obj.slots.all()["addons"]["left"], "")
+        buyer.delete()
+        purchase.delete()
+
     def tearDown(self):
         flush_cache()
         self.obj.delete()
@@ -299,6 +465,21 @@ class TestSlotsHandler(EvenniaTest):
         super(TestSlotsHandler, self).tearDown()
 
 
+class TestSlotsBenchmark(EvenniaTest):
+    "Test the SlotsHandler benchmark in `sr5.benchmark`."
+
+    def test_slots_benchmark(self):
+        objects = ObjectDB.objects.count()
+        report = benchmark.slots(categories=3, numbered=20, objects=4,
+                                 named=2, samples=2)
+
+        self.assertEqual(report["results"]["add"]["count"], 4)
+        self.assertEqual(report["results"]["attach"]["count"], 4)
+        self.assertEqual(report["results"]["drop"]["count"], 2)
+        self.assertGreater(report["results"]["attach"]["writes"], 0)
+        self.assertEqual(ObjectDB.objects.count(), objects)
+
+
 class TestValidate(EvenniaTest):
     pass
     # validate = [
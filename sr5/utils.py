@@ -9,11 +9,15 @@ import math
 import string
 import re
 import pyparsing
-from collections import OrderedDict
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from dateutil import parser
 from decimal import Decimal
+from functools import wraps
 from pint import UnitRegistry
-from django.db.models import Q
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Model, Q
 import evennia
 from evennia.utils.dbserialize import _SaverDict, _SaverList, _SaverSet
 from sr5.models import AccountingLog, AccountingIcetray, Ledger
@@ -223,6 +227,38 @@ class CatDbHolder(object):
     all = property(get_all)
 
 
+class LedgerHolder(object):
+    """
+    Holder for allowing property access of an owner's Ledgers by currency.
+    Lookups go through the Ledger registry, so they're cached after the first.
+
+        ledger = obj.ldb.karma
+        obj.ldb.karma = 25  # Creates the Ledger, or starts it over at 25.
+        del obj.ldb.karma
+        ledgers = obj.ldb.all  # {currency: Ledger}
+    """
+    def __init__(self, owner):
+        _SA(self, 'owner', owner)
+
+    def __getattribute__(self, currency):
+        if currency == 'all':
+            return Ledger.for_owner(_GA(self, 'owner'))
+        return Ledger.fetch(_GA(self, 'owner'), currency)
+
+    def __setattr__(self, currency, value):
+        owner = _GA(self, 'owner')
+        ledger = Ledger.fetch(owner, currency)
+        if ledger:
+            ledger.configure(owner, currency, value)
+        else:
+            Ledger.fetch(owner, currency, value)
+
+    def __delattr__(self, currency):
+        ledger = Ledger.fetch(_GA(self, 'owner'), currency)
+        if ledger:
+            ledger.delete()
+
+
 class LogsHandler:
     """
     Handler for ledgers to compensate for Evennia having really weird behavior
@@ -269,39 +305,43 @@ class LogsHandler:
 
 class LedgerHandler:
     """
-    Handler for ledgers to compensate for Evennia having really weird behavior
-    regarding attributes that have categories.
+    Handler giving objects `.ldb` access to the Ledgers they own. Ledgers
+    are kept in their own table, keyed by owner and currency, rather than in
+    Attributes.
     """
 
     def __init__(self, obj):
         self.obj = obj
         self._objid = obj.id
 
+    @property
+    def ledger_owner(self):
+        "Whose Ledgers `ldb` gives access to. Override to point elsewhere."
+        return self
+
     # @property ldb
     def __ldb_get(self):
         """
-        Attribute handler wrapper. Allows for the syntax
-           obj.ldb.attrname = value
+        Ledger registry wrapper. Allows for the syntax
+           obj.ldb.currency = initial value
              and
-           value = obj.ldb.attrname
+           ledger = obj.ldb.currency
              and
-           del obj.ldb.attrname
+           del obj.ldb.currency
              and
-           all_attr = obj.ldb.all() (unless there is an attribute
-                named 'all', in which case that will be returned instead).
+           all_ledgers = obj.ldb.all
         """
         try:
             return self._ldb_holder
         except AttributeError:
-            self._ldb_holder = CatDbHolder(self, 'attributes',
-                                           category="Ledgers")
+            self._ldb_holder = LedgerHolder(self.ledger_owner)
             return self._ldb_holder
 
     # @db.setter
     def __ldb_set(self, value):
         "Stop accidentally replacing the db object"
         string = "Cannot assign directly to db object! "
-        string += "Use ldb.attr=value instead."
+        string += "Use ldb.currency=value instead."
         raise Exception(string)
 
     # @db.deleter
@@ -319,6 +359,41 @@ This class is designed to sit on typeclassed objects and allow for other objects
 # Built by DamnedScholar (https://github.com/damnedscholar)
 """
 
+class SlotLayout(namedtuple("SlotLayout", ["named", "size", "covers"])):
+    """
+    A shared layout of slots, made by `SlotsHandler.register()`.
+
+    Attributes:
+        named (tuple): The named slots.
+        size (int): How many numbered slots there are.
+        covers (dict): The named slots each group name stands for, worked out
+            when the layout is registered. Groups can contain groups.
+    """
+    __slots__ = ()
+
+    def expand(self, slots):
+        """
+        Swap the group names in a list of slots for the named slots they
+        cover, dropping numbers and repeats.
+        """
+        expanded = []
+        for slot in slots:
+            if not isinstance(slot, str):
+                continue
+            for s in self.covers.get(slot, (slot,)):
+                if s not in expanded:
+                    expanded.append(s)
+        return expanded
+
+
+def _batched(method):
+    "Run a SlotsHandler method in a batch, so that it writes at most once."
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.batch():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class SlotsHandler:
     """
@@ -349,57 +424,386 @@ class SlotsHandler:
     Using the custom `slots` in `attach()` and `drop()` provides some
     customization facility in that you can store *any* object in a slot, not
     just an object that has been set up for it.
+
+    Each category is stored as an Attribute in the "slots" category, holding
+    the named slots, the number of numbered slots and a list of what fills
+    them. Numbered slots are kept packed at the bottom, so slot `n` holds the
+    `n`th item in the list and everything above the list is free. `all()`
+    still returns `{category: {slot: contents}}`.
+
+    Occupants saved in the database are stored as a `(model, id)` tuple, so
+    reading slots doesn't load the objects in them. They are looked up, with
+    one query per model, only when a method has to return them. Anything
+    else is stored as it is.
+
+    Layouts that many objects share, like a body, can be registered once with
+    `SlotsHandler.register()` and given to an object with
+    `.slots.add_layout()`. The object then only stores the name of the layout
+    and whatever is attached, and takes its slots from the registered layout.
+
+    Every method that changes slots works on plain copies of the categories
+    and writes each category it changed once, when it is done. Several
+    changes can be made together with `.slots.batch()`:
+    ```
+    with self.slots.batch():
+        self.slots.drop(old_arm)
+        self.slots.attach(new_arm)
+    ```
+    They are written at the end of the block in one transaction, or not at
+    all if anything in the block raises.
     """
 
+    # Shared layouts by name, as SlotLayout namedtuples.
+    layouts = {}
+
     def __init__(self, obj):
         self.obj = obj
         self._objid = obj.id
+        # The reverse index, from occupant to a list of `(category, slot)`
+        # tuples. It is built from the stored slots the first time it's
+        # needed and kept up to date by every method that changes them, so
+        # slots should only be changed through the handler.
+        self._occupied = None
+        # Records changed in the current batch, by category, or None when no
+        # batch is open. Deleted categories are staged as None.
+        self._staged = None
+
+    @staticmethod
+    def _ref(contents):
+        """
+        What is stored for an occupant: a `(model, id)` tuple for anything
+        saved in the database, like an object, script or player, and the
+        contents themselves for anything else.
+        """
+        if isinstance(contents, Model) and contents.pk:
+            return (contents._meta.concrete_model._meta.label_lower,
+                    contents.pk)
+        return contents
 
-    def __defrag_nums(self, cats):
-        "Worker function to consolidate filled numbered slots."
-        if not isinstance(cats, list):
-            cats = [cats]
-
-        arrays = self.all(obj=True)
-        arrays = [a for a in arrays if a.key in cats]
-
-        for a in arrays:
-            slots = a.value
-            out = {k: v for k, v in slots.items() if isinstance(k, str)}
-            numbered = [(k, v) for k, v in slots.items() if isinstance(k, int)]
-            keys = [n[0] for n in numbered]
-            values = [n[1] for n in numbered]
-            d = len(values) - 1
-            empty = [values.pop(0) for i in range(0, d) if values[0] == ""]
-            numbered = zip(keys, values + empty)
-            out.update(numbered)
-            self.obj.attributes.add(a.key, out, category="slots")
+    @staticmethod
+    def _resolve(slots):
+        """
+        Swap the `(model, id)` references in `{category: {slot: contents}}`
+        for what they refer to, looking them up with one query per model.
+        References to things that no longer exist are left as they are.
+        """
+        ids = {}
+        for cat in slots.values():
+            for v in cat.values():
+                if isinstance(v, tuple) and len(v) == 2:
+                    ids.setdefault(v[0], set()).add(v[1])
+        found = {}
+        for label, pks in ids.items():
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError):
+                # A tuple that was stored as it is.
+                continue
+            found.update(((label, o.pk), o)
+                         for o in model.objects.filter(pk__in=pks))
+        if not found:
+            return slots
+        return {name: {slot: found.get(v, v) if isinstance(v, tuple) else v
+                       for slot, v in cat.items()}
+                for name, cat in slots.items()}
+
+    @classmethod
+    def _record(cls, value):
+        """
+        Copy a stored category into a plain record, filling in the empty
+        slots from its layout. Categories saved before numbered slots were
+        compacted hold `{slot: contents}` with numbers for keys, and are
+        converted here, as are occupants stored as objects.
+        """
+        ref = cls._ref
+        if "__filled__" not in value:
+            numbered = sorted(k for k in value if isinstance(k, int))
+            return {"__layout__": None,
+                    "__named__": {k: ref(v) for k, v in value.items()
+                                  if not isinstance(k, int)},
+                    "__size__": len(numbered),
+                    "__filled__": [ref(value[k]) for k in numbered
+                                   if value[k] != ""]}
+
+        layout = value.get("__layout__")
+        names = value.get("__names__")
+        size = value.get("__size__")
+        if layout:
+            template = cls.layout(layout)
+            if names is None:
+                names = template.named
+            if size is None:
+                size = template.size
+        named = dict.fromkeys(names or (), "")
+        named.update((k, ref(v)) for k, v in value["__named__"].items())
+        return {"__layout__": layout, "__named__": named, "__size__": size,
+                "__filled__": [ref(v) for v in value["__filled__"]]}
+
+    @classmethod
+    def _stored(cls, record):
+        """
+        What to store for a record: the occupied slots, and whatever part of
+        the layout doesn't come from a registered one.
+        """
+        value = {"__named__": {k: v for k, v in record["__named__"].items()
+                               if v != ""},
+                 "__filled__": record["__filled__"]}
+        layout = record["__layout__"]
+        template = cls.layout(layout) if layout else None
+        if layout:
+            value["__layout__"] = layout
+        if not template or set(template.named) != set(record["__named__"]):
+            value["__names__"] = record["__named__"].keys()
+        if not template or template.size != record["__size__"]:
+            value["__size__"] = record["__size__"]
+        return value
+
+    @staticmethod
+    def _occupants(record):
+        "The occupied slots of a record, as a `{slot: contents}` dict."
+        occupants = {k: v for k, v in record["__named__"].items() if v != ""}
+        occupants.update((i + 1, v)
+                         for i, v in enumerate(record["__filled__"]))
+        return occupants
+
+    @staticmethod
+    def _slots(record):
+        "Every slot of a record, as a `{slot: contents}` dict."
+        slots = dict(record["__named__"])
+        filled = record["__filled__"]
+        slots.update((i + 1, filled[i] if i < len(filled) else "")
+                     for i in range(record["__size__"]))
+        return slots
+
+    def _get(self, name):
+        "Load one category as a record, or None if it doesn't exist."
+        if self._staged and name in self._staged:
+            return self._staged[name]
+        value = self.obj.attributes.get(name, category="slots")
+        return self._record(value) if value is not None else None
+
+    def _put(self, name, record):
+        "Stage a record to be written at the end of the batch."
+        self._staged[name] = record
+
+    def _remove(self, name):
+        "Stage a category to be deleted at the end of the batch."
+        self._staged[name] = None
+
+    def _names(self):
+        "The names of every category, including those staged."
+        names = set(a.key for a in self.all(obj=True))
+        for name, record in (self._staged or {}).items():
+            if record is None:
+                names.discard(name)
+            else:
+                names.add(name)
+        return names
+
+    def _records(self):
+        "Load every category as a record."
+        return {name: self._get(name) for name in self._names()}
+
+    def _expand(self, record, slots):
+        "The named slots asked for in a category, with groups expanded."
+        if record["__layout__"]:
+            return self.layout(record["__layout__"]).expand(slots)
+        return [k for k in slots if isinstance(k, str)]
+
+    def _index(self):
+        "Return the reverse index, building it if needed."
+        if self._occupied is None:
+            self._occupied = {}
+            for name, record in self._records().items():
+                self._remember(name, self._occupants(record))
+        return self._occupied
+
+    def _remember(self, name, slots):
+        "Add the occupied slots in a dict of slots to the reverse index."
+        if self._occupied is None:
+            return
+        for slot, contents in slots.items():
+            if contents != "":
+                self._occupied.setdefault(
+                    self._ref(contents), []).append((name, slot))
+
+    def _forget(self, name, slots):
+        "Remove the occupied slots in a dict of slots from the reverse index."
+        if self._occupied is None:
+            return
+        for slot, contents in slots.items():
+            if contents == "":
+                continue
+            key = self._ref(contents)
+            places = [p for p in self._occupied.get(key, [])
+                      if p != (name, slot)]
+            if places:
+                self._occupied[key] = places
+            else:
+                self._occupied.pop(key, None)
+
+    def _free_numbers(self, name, record, numbers):
+        """
+        Empty numbered slots by moving the highest filled slot into each gap,
+        which keeps the filled slots at the bottom without a rewrite.
+
+        Returns:
+            slots (dict): The emptied slots and what they held.
+        """
+        filled = record["__filled__"]
+        freed = {}
+        for number in sorted(numbers, reverse=True):
+            freed[number] = filled[number - 1]
+            last = len(filled)
+            if number != last:
+                moved = filled[last - 1]
+                self._forget(name, {last: moved})
+                self._remember(name, {number: moved})
+                filled[number - 1] = moved
+            filled.pop()
+        self._forget(name, freed)
+        return freed
+
+    def _snapshot(self):
+        "Copy the staged records and the reverse index, to restore later."
+        staged = {name: record and dict(
+                      record, __named__=dict(record["__named__"]),
+                      __filled__=list(record["__filled__"]))
+                  for name, record in self._staged.items()}
+        occupied = None
+        if self._occupied is not None:
+            occupied = {k: list(v) for k, v in self._occupied.items()}
+        return (staged, occupied)
 
     # Public methods
-    def all(self, obj=False):
+    @contextmanager
+    def batch(self):
+        """
+        Stage every change made in the block and write each changed category
+        once at the end, in one transaction. If anything raises, nothing is
+        written. Batches inside a batch are part of the outer one, except
+        that one which raises undoes its own changes, so that the outer
+        batch can catch the error and carry on.
+        """
+        if self._staged is not None:
+            saved = self._snapshot()
+            try:
+                yield self
+            except:
+                self._staged, self._occupied = saved
+                raise
+            return
+
+        self._staged = {}
+        try:
+            yield self
+            with transaction.atomic():
+                for name, record in self._staged.items():
+                    if record is None:
+                        self.obj.attributes.remove(name, category="slots")
+                    else:
+                        self.obj.attributes.add(
+                            name, self._stored(record), category="slots")
+        except:
+            # The reverse index has the abandoned changes in it.
+            self._occupied = None
+            raise
+        finally:
+            self._staged = None
+
+    @classmethod
+    def register(cls, name, slots, groups=None):
+        """
+        Register a shared layout. Registering a name again replaces the
+        layout for every object that uses it.
+
+        Args:
+            name (str): The name of the layout.
+            slots (list): Slot names and numbers of numbered slots, as for one
+                category in `add()`.
+            groups (dict, optional): Names for sets of slots, like an arm for
+                its upper arm, lower arm and hand, as `{group: [slots]}`. A
+                group can name other groups. Asking for a group anywhere a
+                slot can be asked for means all of its slots.
+
+        Returns:
+            layout (SlotLayout): The registered layout.
+        """
+        named = tuple(k for k in slots if isinstance(k, str))
+        groups = groups or {}
+
+        def cover(slot, seen=()):
+            if slot not in groups:
+                return (slot,)
+            if slot in seen:
+                raise Exception("The slot group {} contains "
+                                "itself.".format(slot))
+            return tuple(s for member in groups[slot]
+                         for s in cover(member, seen + (slot,)))
+
+        covers = {group: cover(group) for group in groups}
+        layout = SlotLayout(
+            named, sum([n for n in slots if isinstance(n, int)] + [0]),
+            covers)
+        cls.layouts[name] = layout
+        return layout
+
+    @classmethod
+    def layout(cls, name):
+        "Return a registered layout."
+        try:
+            return cls.layouts[name]
+        except KeyError:
+            raise Exception("There is no slot layout named {}.".format(name))
+
+    @_batched
+    def add_layout(self, layout, category=None):
+        """
+        Create a category of slots from a registered layout.
+
+        Args:
+            layout (str): The name of the layout.
+            category (str, optional): The name of the category, if it isn't
+                the name of the layout.
+
+        Returns:
+            slots (dict): The new category's slots.
+        """
+        name = category or layout
+        if self._get(name):
+            raise Exception("There are already {} slots.".format(name))
+        template = self.layout(layout)
+        record = {"__layout__": layout,
+                  "__named__": dict.fromkeys(template.named, ""),
+                  "__size__": template.size, "__filled__": []}
+        self._put(name, record)
+        return {name: self._slots(record)}
+
+    def all(self, obj=False, refs=False):
         """
         Args:
             obj (bool): Whether or not to return the attribute objects.
                 (Default: False)
+            refs (bool): Return the `(model, id)` references of occupants
+                instead of looking up the objects. (Default: False)
 
         Returns:
             slots (dict): A dict of all slots.
         """
-        d = self.obj.attributes.get(category="slots", return_obj=True)
-
-        if not d:
-            return {}
-        elif not isinstance(d, list):
-            d = [d]
-
         if obj:
             # Return attribute objects if requested.
-            return d
-        else:
-            # Return a dict detached from the database.
-            r = {s.key: s.value for s in d}
-            return r
-
+            d = self.obj.attributes.get(category="slots", return_obj=True)
+            if not d:
+                return {}
+            return d if isinstance(d, list) else [d]
+
+        # Return a dict detached from the database, with anything staged in
+        # an open batch.
+        r = {name: self._slots(record)
+             for name, record in self._records().items()}
+        return r if refs else self._resolve(r)
+
+    @_batched
     def add(self, slots):
         """
         Create arrays of slots, or add additional slots to existing arrays.
@@ -417,37 +821,27 @@ class SlotsHandler:
             raise Exception("You have to declare slots in the form "
                             "`{key: [values]}`.")
 
-        wiz.msg("Gonna add some slots! Yeah!")
-
-        arrays = {a.key: a for a in self.obj.slots.all(obj=True)}
         modified = {}
         for name in slots:
-            existing = arrays.get(name, False)
-            self.obj.location.msg("-> Inspecting {}: {}".format(name, existing))
+            record = self._get(name) or {"__layout__": None, "__named__": {},
+                                         "__size__": 0, "__filled__": []}
             # Add all string values to the slot list.
-            to_add = [k for k in slots[name] if isinstance(k, str)]
-            # Iterate through numerical values in the input and store the sum.
-            requirement = [n for n in slots[name] if isinstance(n, int)] + [0]
-            requirement = sum(requirement)
-            highest = 0
-            if existing:
-                array = existing.value
-                numbered = [k for k in array if isinstance(k, int)] + [0]
-                highest = sorted(numbered)[-1]
-            for i in range(highest, highest + requirement):
-                to_add.append(i+1)
-            to_add = {slot: "" for slot in to_add}
-
-            if not existing:
-                self.obj.attributes.add(name, to_add, category="slots")
-                new = self.obj.attributes.get(name, category="slots")
-                modified.update({name: new})
-            else:
-                array.update(to_add)
-                modified.update({name: array})
-
-        return modified
-
+            to_add = {k: "" for k in slots[name] if isinstance(k, str)}
+            # Anything in a slot that is added again is cleared out.
+            self._forget(name, {k: record["__named__"][k] for k in to_add
+                                if k in record["__named__"]})
+            record["__named__"].update(to_add)
+            # Numerical values in the input are summed and added to the
+            # numbered slots.
+            record["__size__"] += sum(
+                [n for n in slots[name] if isinstance(n, int)] + [0])
+
+            self._put(name, record)
+            modified.update({name: self._slots(record)})
+
+        return self._resolve(modified)
+
+    @_batched
     def delete(self, slots):
         """
         This will delete slots from an existing array.
@@ -470,40 +864,44 @@ class SlotsHandler:
                             "`{key: [values]}`, or categories in the form "
                             "`[values]`.")
 
-        arrays = {a.key: a for a in self.obj.slots.all(obj=True)}
         deleted = {}
         for name in slots:
-            existing = arrays.get(name, False)
-            del_temp = {}
-            if not existing:
+            record = self._get(name)
+            if not record:
                 # If the named array isn't there, skip to the next one.
                 break
-            array = existing.value
 
             if isinstance(slots, (list, _SaverList)):
                 # If the input is a list, it is interpreted as a list of
                 # category names and all slots are deleted.
-                deleted.update({name: array})
-                self.obj.attributes.remove(name, category="slots")
+                deleted.update({name: self._slots(record)})
+                self._forget(name, self._occupants(record))
+                self._remove(name)
             elif isinstance(slots, (dict, _SaverDict)):
                 # If the input is a dict, only the specific slots indicated
-                # will be deleted.
-                self.__defrag_nums(existing.key)  # Just in case.
-                named = {k: v for k, v in array.items()
-                         if isinstance(k, str)}
-                numbered = {k: v for k, v in array.items()
-                            if isinstance(k, int)}
-                to_del = [s for s in slots[name] if isinstance(s, str)]
-                highest = sorted(numbered.keys() + [0])[-1]
+                # will be deleted. Numbered slots come off the top, along
+                # with anything in them.
+                del_temp = {}
+                for slot in [s for s in slots[name] if isinstance(s, str)]:
+                    del_temp[slot] = record["__named__"].pop(slot)
+                    self._forget(name, {slot: del_temp[slot]})
+                size = record["__size__"]
                 del_num = sum([n for n in slots[name] if isinstance(n, int)])
-                to_del = to_del + [i for i
-                                   in range(highest, highest - del_num, -1)]
-
-                del_temp = {d: array.pop(d) for d in to_del}
+                del_num = min(del_num, size)
+                filled = record["__filled__"]
+                for number in range(size, size - del_num, -1):
+                    del_temp[number] = ""
+                    if number <= len(filled):
+                        del_temp[number] = filled.pop()
+                        self._forget(name, {number: del_temp[number]})
+                record["__size__"] = size - del_num
+
+                self._put(name, record)
                 deleted.update({name: del_temp})
 
-        return deleted
+        return self._resolve(deleted)
 
+    @_batched
     def attach(self, target, slots=None):
         """
         Attempt to attach the target in all slots it consumes. Optionally, the
@@ -535,57 +933,53 @@ class SlotsHandler:
                             "`{key: [values]}`, or categories in the form "
                             "`[values]`.")
 
-        arrays = {a.key: a for a in self.obj.slots.all(obj=True)}
         for name in slots:
-            array = arrays.get(name, False)
-            if not array:
+            record = self._get(name)
+            if not record:
                 raise Exception("You need to add slots before you can "
                                 "attach things to them.")
-            else:
-                array = array.value
 
-            new = {}
+            named = record["__named__"]
+            filled = record["__filled__"]
+            free = record["__size__"] - len(filled)
 
             if isinstance(slots, (dict, _SaverDict)):
-                # Get the number of open slots, then count to see if there are
-                # enough for the attachment.
-                numbered = [n for n in array.keys()
-                            if isinstance(n, int) and not array[n]]
+                # Count the open numbered slots to see if there are enough
+                # for the attachment. Open slots are always the ones above
+                # the filled ones.
                 requirement = [n for n in slots[name] if isinstance(n, int)]
                 requirement = sum(requirement + [0])
-                if len(numbered) < requirement:
+                if free < requirement:
                     raise Exception("You're running out of numbered "
                                     "slots. You need to add or free up slots "
                                     "before you can attach this.")
 
-                if numbered:
-                    new.update({numbered[i]: target
-                                for i in range(0, requirement)})
-
                 # Get the list of open named slots and check to see if all of
                 # the requested slots are members of them.
-                named = [n for n in array.keys()
-                         if isinstance(n, str) and not array[n]]
-                requirement = [n for n in slots[name] if isinstance(n, str)]
-                if requirement and not set(requirement).issubset(named):
+                requested = self._expand(record, slots[name])
+                if requested and not set(requested).issubset(
+                        [n for n, c in named.items() if not c]):
                     raise Exception("You're running out of named slots. "
                                     "You need to add or free up slots before "
                                     "you can attach this.")
 
-                if named:
-                    new.update({req: target
-                                for req in requirement})
-
             elif isinstance(slots, (list, _SaverList)):
-                for slot, contents in array.items():
-                    if contents == "":
-                        new.update({slot: target})
+                requirement = free
+                requested = [n for n, c in named.items() if c == ""]
 
-            array.update(new)
-            modified.update({name: new})
+            ref = self._ref(target)
+            new = {len(filled) + i + 1: ref for i in range(requirement)}
+            new.update({req: ref for req in requested})
+            filled.extend([ref] * requirement)
+            named.update({req: ref for req in requested})
+
+            self._put(name, record)
+            self._remember(name, new)
+            modified.update({name: {slot: target for slot in new}})
 
         return modified
 
+    @_batched
     def drop(self, target, slots=None):
         """
         Attempt to drop the target from all slots it occupies, or the slots
@@ -594,6 +988,9 @@ class SlotsHandler:
         function will return a dict of any emptied slots, so it can act as a
         pop(), but if you don't catch that data, it WILL be lost.
 
+        Emptying a numbered slot moves the contents of the highest filled
+        numbered slot into it, so numbered slots may change number.
+
         Args:
             target (object or `None`): The object being dropped.
             slots (dict or list, optional): Slot categories or individual slots
@@ -603,9 +1000,9 @@ class SlotsHandler:
             slots (dict): A dict of slots that have been emptied.
         """
 
-        arrays = self.obj.slots.all()
+        arrays = self._names()
         if not slots:
-            slots = arrays.keys()
+            slots = list(arrays)
 
         if not isinstance(slots, (dict, _SaverDict, list, _SaverList)):
             raise Exception("You have to declare slots in the form "
@@ -619,49 +1016,67 @@ class SlotsHandler:
         # occupying.
         if not arrays:
             raise Exception("You don't seem to have any slots to use.")
-        if not slots:
-            slots = [cat for cat in arrays.keys()]
+
+        # When there is a target, the reverse index says which slots it is in,
+        # and only the categories it occupies are loaded.
+        if target:
+            occupied = self._index().get(self._ref(target), [])
 
         for name in slots:
-            new = {}
-            mod = {}
-            array = arrays[name]
+            if name not in arrays:
+                raise KeyError(name)
+            held = []
+            if target:
+                held = [slot for cat, slot in occupied if cat == name]
 
             if isinstance(slots, (list, _SaverList)):
                 # If the input is a list, it is interpreted as a list of
                 # category names and all slots are emptied of the target.
-                for slot, contents in array.items():
-                    if (target and contents is target) or not target:
-                        new.update({slot: ''})
-                        mod.update({slot: contents})
+                if target:
+                    to_drop = held
+                else:
+                    to_drop = None
             elif isinstance(slots, (dict, _SaverDict)):
                 # If the input is a dict, only named slots will be emptied.
                 # Numbered slots should be specified as a single number.
-                i = 0
+                named = self._expand(self._get(name), slots[name])
                 numbered = [k for k in slots[name] if isinstance(k, int)]
-                numbered = [i + 1 for k in numbered for i in range(i, k)]
-                named = [k for k in slots[name] if isinstance(k, str)]
-                for slot in named:
-                    if (target and array[slot] is target) or not target:
-                        new.update({slot: ''})
-                        mod.update({slot: array[slot]})
-                for i in range(0, len(numbered)):
-                    for check in array:
-                        if isinstance(check, int) and array[check] is target:
-                            new.update({check: ''})
-                            mod.update({check: array[check]})
-
+                if target:
+                    to_drop = [k for k in named if k in held]
+                    if numbered:
+                        to_drop += [k for k in held if isinstance(k, int)]
+                else:
+                    to_drop = named
             else:
                 raise Exception("The slots requested are not in an "
                                 "appropriate type (a list of attribute names, "
                                 "or a dict of category and slot names).")
 
-            arrays[name].update(new)
+            if to_drop == []:
+                continue
+            record = self._get(name)
+            if to_drop is None:
+                # Everything in the category goes.
+                to_drop = self._occupants(record).keys()
+            mod = {}
+            for slot in [s for s in to_drop if not isinstance(s, int)]:
+                if record["__named__"][slot] != "":
+                    mod[slot] = record["__named__"][slot]
+                    record["__named__"][slot] = ""
+            self._forget(name, mod)
+            mod.update(self._free_numbers(
+                name, record, [s for s in to_drop if isinstance(s, int)]))
+            if not mod:
+                continue
+            self._put(name, record)
             modified.update({name: mod})
 
-        self.__defrag_nums(modified.keys())
-        return {k: v for k, v in modified.items() if v}
+        if target:
+            return {name: {slot: target for slot in mod}
+                    for name, mod in modified.items()}
+        return self._resolve(modified)
 
+    @_batched
     def replace(self, target, slots=None):
         """
         Works exactly like `.slots.attach`, but first invokes `.slots.drop` on
@@ -689,24 +1104,67 @@ class SlotsHandler:
                                         "the target or declare them in the "
                                         "method call.")
 
-        drop = self.obj.slots.drop(None, slots)
-        attach = self.obj.slots.attach(target, slots)
+        if isinstance(slots, (dict, _SaverDict)):
+            # Only empty the named slots that are in the way.
+            in_way = self.conflicts(slots, refs=True)
+            drop = {}
+            if in_way:
+                drop = self.drop(None, {name: in_way[name].keys()
+                                        for name in in_way})
+        else:
+            drop = self.drop(None, slots)
+        attach = self.attach(target, slots)
 
         return (drop, attach)
 
+    def conflicts(self, slots, refs=False):
+        """
+        Find what is in the way of attaching something to `slots`. Group
+        names are expanded using the category's layout, so asking for an arm
+        finds whatever is in the hand. Numbered slots are interchangeable, so
+        they are never in the way; `attach()` says if there are too few.
+
+        Args:
+            slots (dict): Slots in the form `{category: [slots]}`.
+            refs (bool): Return the `(model, id)` references of occupants
+                instead of looking up the objects. (Default: False)
+
+        Returns:
+            conflicts (dict): The occupied slots that were asked for and
+                their contents, as `{category: {slot: contents}}`.
+
+        Raises:
+            KeyError: If a category or slot doesn't exist.
+        """
+
+        if not isinstance(slots, (dict, _SaverDict)):
+            raise Exception("You have to declare slots in the form "
+                            "`{key: [values]}`.")
+
+        conflicts = {}
+        for name in slots:
+            record = self._get(name)
+            if not record:
+                raise KeyError(name)
+            named = record["__named__"]
+            in_way = {slot: named[slot]
+                      for slot in self._expand(record, slots[name])
+                      if named[slot] != ""}
+            if in_way:
+                conflicts[name] = in_way
+
+        return conflicts if refs else self._resolve(conflicts)
+
     def where(self, target):
         """
         Returns:
             slots (dict): Slots where `target` is attached.
         """
 
-        arrays = self.obj.slots.all()
-        # Filter out all empty entries.
-        r = {name: [s for s, c in slots.items() if c is target]
-             for name, slots in arrays.items()}
-        r = {name: contents for name, contents in r.items() if contents}
-
-        return r
+        where = {}
+        for name, slot in self._index().get(self._ref(target), []):
+            where.setdefault(name, []).append(slot)
+        return {name: sorted(slots) for name, slots in where.items()}
 
 
 def validate(target, validate, result_categories):
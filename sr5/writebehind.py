@@ -0,0 +1,186 @@
+"""
+Write-behind
+
+An optional queue that takes AccountingIcetray inserts off the reactor
+thread. While it is running, `Ledger.record()` and `Ledger.record_many()`
+append their icetray rows here and a LoopingCall hands them to a worker
+thread in batches. When it isn't running, which is the default and what the
+tests see, every row is written before `record()` returns.
+
+Turn it on with `SR5_LEDGER_WRITE_BEHIND = True` in the settings. It is
+started and flushed by the hooks in `server/conf/at_server_startstop.py`.
+
+"""
+
+import threading
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import blockingCallFromThread, deferToThread
+from twisted.python import threadable
+from evennia.utils import logger
+
+
+class IcetrayQueue(object):
+    """
+    Pending icetray rows, written in batches by a background thread.
+
+    Attributes:
+        pending (list): Unsaved AccountingIcetray entries, oldest first.
+        interval (float): Seconds between flushes.
+        batch_size (int): A flush is started early once this many rows are
+            waiting, and no batch is larger than this.
+        loop (LoopingCall): The running flush loop, or None when rows are
+            written synchronously.
+        in_flight (int): How many batches the worker is still writing.
+        failed (list): Entries from batches the worker couldn't write. They
+            go back to the front of `pending` before the next write.
+
+    Methods:
+        add(entries, wait=False): Queues entries, or writes them now if the
+            queue isn't running or `wait` is True.
+        flush(): Writes everything pending before returning. Anything that
+            reads the icetray calls this first. It can be called from any
+            thread; the queue itself is only touched by the reactor. Inside
+            a transaction it waits for the commit instead.
+        start(): Starts the flush loop if write-behind is turned on.
+        stop(): Stops the flush loop and writes everything pending, logging
+            any entries that still can't be written.
+    """
+
+    pending = []
+    interval = getattr(settings, "SR5_LEDGER_WRITE_BEHIND_INTERVAL", 0.05)
+    batch_size = getattr(settings, "SR5_LEDGER_WRITE_BEHIND_BATCH", 500)
+    loop = None
+    in_flight = 0
+    failed = []
+    # Guards `in_flight` and `failed`, and is notified as each batch
+    # finishes, so that a flush can wait for all of them.
+    done = threading.Condition()
+
+    @classmethod
+    def add(cls, entries, wait=False):
+        if cls.loop is None or wait:
+            # Only these entries are written. This usually runs inside the
+            # caller's transaction, and if that rolls back, anything else
+            # taken from the queue here would be lost with it.
+            cls._write(entries)
+            return
+
+        cls.pending.extend(entries)
+        if len(cls.pending) >= cls.batch_size:
+            cls._tick()
+
+    @classmethod
+    def _take(cls):
+        batch = cls.pending[0:cls.batch_size]
+        del cls.pending[0:len(batch)]
+        return batch
+
+    @classmethod
+    def _write(cls, batch):
+        if not batch:
+            return
+        if len(batch) == 1:
+            # save() fills in the key, which bulk_create() doesn't on every
+            # backend.
+            batch[0].save()
+        else:
+            with transaction.atomic():
+                type(batch[0]).objects.bulk_create(batch)
+
+    @classmethod
+    def _requeue(cls):
+        with cls.done:
+            batch, cls.failed = cls.failed, []
+        cls.pending[0:0] = batch
+
+    @classmethod
+    def _write_in_thread(cls, batch):
+        try:
+            cls._write(batch)
+        except Exception:
+            # Kept before the batch counts as finished, so a flush waiting
+            # on it is sure to find and retry it.
+            with cls.done:
+                cls.failed.extend(batch)
+            raise
+        finally:
+            close_old_connections()
+            with cls.done:
+                cls.in_flight -= 1
+                cls.done.notify_all()
+
+    @classmethod
+    def _tick(cls):
+        cls._requeue()
+        batch = cls._take()
+        if not batch:
+            return
+        with cls.done:
+            cls.in_flight += 1
+
+        def failed(failure):
+            # The batch is already back in `failed`, for the next write.
+            logger.log_trace("Ledger write-behind failed: {}".format(
+                failure.getErrorMessage()))
+
+        deferToThread(cls._write_in_thread, batch).addErrback(failed)
+
+    @classmethod
+    def flush(cls):
+        """
+        Write every pending row and wait out every batch the worker is still
+        writing. Called from another thread, such as a web view, the flush
+        is handed to the reactor and waited for.
+
+        Inside a transaction, the flush is put off until it commits, so other
+        callers' rows aren't written as part of it and lost if it rolls back.
+        Reads made before then see only the rows already written.
+        """
+        if cls.loop is not None and \
+                transaction.get_connection().in_atomic_block:
+            transaction.on_commit(cls.flush)
+            return
+        if cls.loop is not None and not threadable.isInIOThread():
+            from twisted.internet import reactor
+            blockingCallFromThread(reactor, cls.flush)
+            return
+
+        # Batches the worker is writing are older than anything pending, and
+        # any that fail are retried first.
+        with cls.done:
+            while cls.in_flight:
+                cls.done.wait()
+        cls._requeue()
+        while cls.pending:
+            batch = cls._take()
+            try:
+                cls._write(batch)
+            except Exception:
+                cls.pending[0:0] = batch
+                raise
+
+    @classmethod
+    def start(cls):
+        if cls.loop is None and getattr(settings, "SR5_LEDGER_WRITE_BEHIND",
+                                        False):
+            cls.loop = LoopingCall(cls._tick)
+            cls.loop.start(cls.interval, now=False)
+
+    @classmethod
+    def stop(cls):
+        if cls.loop is not None:
+            if cls.loop.running:
+                cls.loop.stop()
+            cls.loop = None
+        try:
+            cls.flush()
+        except Exception:
+            # Nothing is left to retry them, so at least leave a record.
+            logger.log_trace("Ledger write-behind couldn't write {} entries:"
+                             "\n{}".format(len(cls.pending), "\n".join(
+                                 "{} {} {}: {}".format(
+                                     entry.db_owner, entry.db_value,
+                                     entry.db_currency, entry.db_reason)
+                                 for entry in cls.pending)))